@@ -1,9 +1,17 @@
-from flask import Flask, request, Response, stream_with_context
+from flask import Flask, request, Response, stream_with_context, jsonify
+from pathlib import Path
 import asyncio
 import logging
 import functools
+import os
+import shutil
+import socket
+import threading
+import time
+import requests
 
 from main import main
+from progress import load_progress_snapshot, get_events_file_path, get_snapshot_file_path, emit_run_failed
 
 
 app = Flask(__name__)
@@ -12,10 +20,68 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# Runs in progress on this worker, reported as its queue depth
+running_runs = set()
+
+# Registration to the REST API, if its URL is given: the worker then receives runs according to its free resources
+REST_API_URL = os.environ.get("REST_API_URL", None)
+WORKER_NAME = os.environ.get("WORKER_NAME", socket.gethostname())
+WORKER_ENDPOINT = os.environ.get("WORKER_ENDPOINT", f"http://{socket.gethostname()}:5000/worker")
+WORKER_HEARTBEAT_INTERVAL = int(os.environ.get("WORKER_HEARTBEAT_INTERVAL", 15))
+WORKER_DATA_DIR = os.environ.get("WORKER_DATA_DIR", "/results" if Path("/results").exists() else "/")
+
+
+def get_memory_info():
+    # Total and available memory in bytes, from /proc/meminfo
+    meminfo = dict()
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+    return meminfo.get("MemTotal"), meminfo.get("MemAvailable", meminfo.get("MemFree"))
+
+
+def get_worker_resources():
+    cpu_count = os.cpu_count()
+    try:
+        total_memory, free_memory = get_memory_info()
+    except OSError:
+        total_memory, free_memory = None, None
+    return dict(
+        name=WORKER_NAME,
+        endpoint=WORKER_ENDPOINT,
+        cpu_count=cpu_count,
+        free_cores=max(cpu_count - os.getloadavg()[0], 0),
+        total_memory=total_memory,
+        free_memory=free_memory,
+        free_disk=shutil.disk_usage(WORKER_DATA_DIR).free,
+        queue_depth=len(running_runs),
+    )
+
+
+def send_heartbeats_forever():
+    session = requests.Session()
+    while True:
+        try:
+            response = session.post(f"{REST_API_URL}/api/workers/heartbeat", json=get_worker_resources(), timeout=10)
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Error sending heartbeat: {e}")
+        time.sleep(WORKER_HEARTBEAT_INTERVAL)
+
+
 async def run_async(**kwargs):
     for k,v in kwargs.items():
         logger.info(f"{k}: {v}")
-    main(**kwargs)
+    running_runs.add(kwargs.get("run_identifier"))
+    try:
+        main(**kwargs)
+    except Exception:
+        if kwargs.get("run_identifier"):
+            emit_run_failed(run_identifier=kwargs["run_identifier"])
+        raise
+    finally:
+        running_runs.discard(kwargs.get("run_identifier"))
 
 
 @app.route('/worker/run', methods=['POST'])
@@ -50,10 +116,23 @@ def get_logs():
     return logs
 
 
+@app.route('/worker/status', methods=['GET'])
+def get_status():
+    run_identifier = request.args.get('run_identifier')
+    # The snapshot is kept up to date by the run, so status reads do not replay its events
+    snapshot_filename = get_snapshot_file_path(get_events_file_path(run_identifier))
+    if not Path(snapshot_filename).exists():
+        return jsonify({"error": f"No progress events for run: {run_identifier}"}), 404
+    return jsonify(load_progress_snapshot(snapshot_filename))
+
+
 @app.route('/worker/ping')
 def ping():
     return 'Pong!'
 
 
 if __name__ == '__main__':
+    # Only from the process serving requests, not from the debug reloader watching it
+    if REST_API_URL and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        threading.Thread(target=send_heartbeats_forever, daemon=True).start()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -1,7 +1,6 @@
 import boto3
 import os
-import ast
-import subprocess
+import inspect
 from warnings import filterwarnings
 from datetime import datetime
 from pathlib import Path
@@ -12,9 +11,6 @@ from neuroconv.tools.spikeinterface import write_sorting, write_recording
 from nwbinspector import inspect_nwbfile_object
 from pynwb import NWBHDF5IO, NWBFile
 from dandi.validate import validate
-from dandi.organize import organize
-from dandi.upload import upload
-from dandi.download import download
 
 from utils import (
     make_logger,
@@ -22,7 +18,19 @@ from utils import (
     upload_file_to_bucket,
     upload_all_files_to_bucket_folder,
     download_file_from_url,
+    download_dandiset_metadata,
+    organize_nwb_files,
+    upload_files_to_dandiset,
+    get_s3_object_size,
+    get_url_content_length,
+    read_json_from_s3,
+    load_job_spec,
+    parse_env_value,
 )
+from spikeglx_s3 import read_spikeglx_s3, select_spikeglx_stream_urls
+from shared_binary import SharedBinaryRecording, get_shared_binary_sorters
+from scratch import ScratchManager
+from progress import ProgressReporter, ProgressRecording, emit_run_failed
 
 
 def main(
@@ -46,7 +54,9 @@ def main(
     2. run a SpikeInterface pipeline on the raw traces
     3. save the results in a target S3 bucket
 
-    The arguments for this script can be passsed as ENV variables:
+    The arguments for this script can be passed in a JSON job spec, fetched from JOB_SPEC_URL (s3:// or https://)
+    and validated against JOB_SPEC_SHA256, with the same keys as the arguments below in lower case. 
+    Otherwise, they can be passed as ENV variables:
     - RUN_IDENTIFIER : Unique identifier for this run.
     - SOURCE : Source of input data. Choose from: local, s3, dandi.
     - SOURCE_DATA_PATHS : Dictionary with paths to source data. Keys are names of data files, values are urls.
@@ -63,6 +73,8 @@ def main(
     - TEST_WITH_SUB_RECORDING : Runs script with the first 4 seconds of target dataset.
     - TEST_SUB_RECORDING_N_FRAMES : Number of frames to use for sub-recording.
     - LOG_TO_FILE : If True, logs will be saved to a file in /logs folder.
+    - SWEEP_GRID_URL : For parameter sweeps run as an AWS Batch array job, S3 url of the JSON list of sorters kwargs.
+        Each child job runs with the item at its AWS_BATCH_JOB_ARRAY_INDEX, as run RUN_IDENTIFIER-{index:04d}.
 
     If running this in any AWS service (e.g. Batch, ECS, EC2...) the access to other AWS services 
     such as S3 storage can be given to the container by an IAM role.
@@ -87,11 +99,11 @@ def main(
         if source == "None":
             source = None
     if not source_data_paths:
-        source_data_paths = eval(os.environ.get("SOURCE_DATA_PATHS", "{}"))
+        source_data_paths = parse_env_value(os.environ.get("SOURCE_DATA_PATHS", "{}"))
     if not source_data_type:
         source_data_type = os.environ.get("SOURCE_DATA_TYPE", "nwb")
     if not recording_kwargs:
-        recording_kwargs = ast.literal_eval(os.environ.get("RECORDING_KWARGS", "{}"))
+        recording_kwargs = parse_env_value(os.environ.get("RECORDING_KWARGS", "{}"))
     if not output_destination:
         output_destination = os.environ.get("OUTPUT_DESTINATION", "s3")
     if not output_path:
@@ -102,7 +114,7 @@ def main(
         sorters_names_list = os.environ.get("SORTERS_NAMES_LIST", '["kilosort3"]')
         sorters_names_list = [s.strip().replace("\"", "").replace("\'", "") for s in sorters_names_list.strip('][').split(',')]
     if not sorters_kwargs:
-        sorters_kwargs = eval(os.environ.get("SORTERS_KWARGS", "{}"))
+        sorters_kwargs = parse_env_value(os.environ.get("SORTERS_KWARGS", "{}"))
     if test_with_toy_recording is None:
         test_with_toy_recording = os.environ.get("TEST_WITH_TOY_RECORDING", "False").lower() in ('true', '1', 't')
     if test_with_subrecording is None:
@@ -114,6 +126,9 @@ def main(
 
     # Set up logging
     logger = make_logger(run_identifier=run_identifier, log_to_file=log_to_file)
+
+    # Structured progress events, written to /logs/sorting_worker_{run_identifier}.events.jsonl
+    progress = ProgressReporter(run_identifier=run_identifier, logger=logger)
     
     filterwarnings(action="ignore", message="No cached namespaces found in .*")
     filterwarnings(action="ignore", message="Ignoring cached namespace .*")
@@ -145,6 +160,9 @@ def main(
 
     s3_client = boto3.client('s3')
 
+    # Scratch disk manager - removes intermediate artifacts as soon as later stages no longer need them
+    scratch = ScratchManager(logger=logger)
+
     # Test with toy recording
     if test_with_toy_recording:
         logger.info("Generating toy recording...")
@@ -162,24 +180,42 @@ def main(
             if not data_url.startswith("s3://"):
                 logger.error(f"Data url {data_url} is not a valid S3 path. E.g. s3://...")
                 raise ValueError(f"Data url {data_url} is not a valid S3 path. E.g. s3://...")
-            logger.info(f"Downloading data from S3: {data_url}")
-            data_path = data_url.split("s3://")[-1]
-            bucket_name = data_path.split("/")[0]
-            file_path = "/".join(data_path.split("/")[1:])
-            file_name = download_file_from_s3(
-                client=s3_client,
-                bucket_name=bucket_name, 
-                file_path=file_path,
-            )
 
-        logger.info("Reading recording...")
         # E.g.: se.read_spikeglx(folder_path="/data", stream_id="imec.ap")
         if source_data_type == "spikeglx":
-            recording = se.read_spikeglx(
-                folder_path="/data",
-                **recording_kwargs
+            # SpikeGLX binaries are streamed from S3 with ranged reads, instead of being downloaded
+            try:
+                file_bin_url, file_meta_url = select_spikeglx_stream_urls(
+                    urls=list(source_data_paths.values()),
+                    stream_id=recording_kwargs.get("stream_id", None) or recording_kwargs.get("stream_name", None),
+                )
+            except ValueError as e:
+                logger.error(str(e))
+                raise
+            logger.info(f"Reading recording from S3: {file_bin_url}")
+            recording = read_spikeglx_s3(
+                file_bin_url=file_bin_url,
+                file_meta_url=file_meta_url,
+                **{k: v for k, v in recording_kwargs.items() if k not in ["stream_id", "stream_name", "all_annotations"]}
             )
         elif source_data_type == "nwb":
+            download_size = sum(get_s3_object_size(client=s3_client, s3_url=v) for v in source_data_paths.values())
+            scratch.check_free_space(stage="download", path="/data", required_bytes=download_size)
+            progress.stage_start(stage="download", total=download_size, unit="bytes")
+            for k, data_url in source_data_paths.items():
+                logger.info(f"Downloading data from S3: {data_url}")
+                data_path = data_url.split("s3://")[-1]
+                bucket_name = data_path.split("/")[0]
+                file_path = "/".join(data_path.split("/")[1:])
+                file_name = download_file_from_s3(
+                    client=s3_client,
+                    bucket_name=bucket_name, 
+                    file_path=file_path,
+                    callback=progress.bytes_callback(stage="download"),
+                )
+                scratch.register(f"/data/{file_name}", needed_by=["sorting"])
+            progress.stage_end(stage="download")
+            logger.info("Reading recording...")
             recording = se.read_nwb_recording(
                 file_path=f"/data/{file_name}",
                 **recording_kwargs
@@ -192,7 +228,12 @@ def main(
 
         if not test_with_subrecording:            
             logger.info(f"Downloading dataset: {dandiset_s3_file_url}")
-            download_file_from_url(dandiset_s3_file_url)
+            download_size = get_url_content_length(dandiset_s3_file_url)
+            scratch.check_free_space(stage="download", path="/data", required_bytes=download_size)
+            progress.stage_start(stage="download", total=download_size, unit="bytes")
+            download_file_from_url(dandiset_s3_file_url, callback=progress.bytes_callback(stage="download"))
+            scratch.register("/data/filename.nwb", needed_by=["sorting"])
+            progress.stage_end(stage="download")
             
             logger.info("Reading recording from NWB...")
             recording = se.read_nwb_recording(
@@ -222,15 +263,39 @@ def main(
         n_jobs = int(os.cpu_count())
     sorting_list = list()
     sorters_names_list = [s.lower().strip() for s in sorters_names_list]
+
+    # Sorters reading binary data share a single binary copy of the recording, written once
+    binary_sorters = get_shared_binary_sorters(recording=recording, sorters_names_list=sorters_names_list)
+    # Estimated disk usage: a int16 binary copy written by sorters, plus the shared binary copy when used
+    binary_size = recording.get_total_samples() * recording.get_num_channels() * 2
+    scratch.check_free_space(
+        stage="sorting",
+        path="/results",
+        required_bytes=binary_size * (2 if len(binary_sorters) > 0 else 1),
+    )
+    # Frames read by chunked job execution are reported as progress of the current sorting stage.
+    # Binary recordings are not wrapped, so that sorters can still use their file directly
+    if not recording.is_binary_compatible():
+        recording = ProgressRecording(recording=recording, events_file_path=progress.events_file_path)
+    shared_binary_recording = SharedBinaryRecording(
+        recording=recording,
+        folder=f"/results/sorting/{run_identifier}_binary",
+        users=binary_sorters,
+        logger=logger,
+        n_jobs=n_jobs,
+        chunk_duration="1s",
+        progress_bar=False,
+    )
     for sorter_name in sorters_names_list:
         try:
             logger.info(f"Running {sorter_name}...")
+            progress.stage_start(stage=f"sorting_{sorter_name}", total=recording.get_total_samples(), unit="frames")
             sorter_job_kwargs = sorters_kwargs.get(sorter_name, {})
             sorter_job_kwargs["n_jobs"] = min(n_jobs, sorter_job_kwargs.get("n_jobs", n_jobs))
             output_results_folder = f"/results/sorting/{run_identifier}_{sorter_name}"
             sorting = run_sorter_local(
                 sorter_name, 
-                recording, 
+                shared_binary_recording.acquire(sorter_name), 
                 output_folder=output_results_folder,
                 remove_existing_folder=True, 
                 delete_output_folder=True,
@@ -241,6 +306,11 @@ def main(
             )
             sorting_list.append(sorting)
             sorting.save_to_folder(folder=f'/results/sorting/{run_identifier}_{sorter_name}/sorter_exported')
+            scratch.register(
+                output_results_folder, 
+                needed_by=["upload"] if output_destination == "s3" else ["nwb"],
+                keep=output_destination == "local",
+            )
 
             if output_destination == "local":
                 # Copy sorting results to local - already done by mounted volume
@@ -252,11 +322,14 @@ def main(
                     client=s3_client, 
                     bucket_name=output_s3_bucket, 
                     bucket_folder=output_s3_bucket_folder,
-                    local_folder=f'/results/sorting/{run_identifier}_{sorter_name}/sorter_exported'
+                    local_folder=f'/results/sorting/{run_identifier}_{sorter_name}/sorter_exported',
+                    callback=progress.bytes_callback(stage="upload"),
                 )
+                scratch.consume(output_results_folder, stage="upload")
         except Exception as e:
             logger.info(f"Error running sorter {sorter_name}: {e}")
             print(f"Error running sorter {sorter_name}: {e}")
+            progress.stage_end(stage=f"sorting_{sorter_name}", status="fail")
             if output_destination == "local":
                 # Copy error logs to local - already done by mounted volume
                 pass
@@ -267,8 +340,17 @@ def main(
                     client=s3_client,
                     bucket_name=output_s3_bucket,
                     bucket_folder=output_s3_bucket_folder,
-                    local_folder=output_results_folder
+                    local_folder=output_results_folder,
+                    callback=progress.bytes_callback(stage="upload"),
                 )
+                scratch.release(output_results_folder)
+        else:
+            progress.stage_end(stage=f"sorting_{sorter_name}")
+        finally:
+            shared_binary_recording.release(sorter_name)
+
+    # Input data is no longer needed after sorting
+    scratch.consume_stage("sorting")
 
     # Post sorting operations
     if len(sorters_names_list) > 1:
@@ -284,6 +366,7 @@ def main(
 
     # Write sorting results to NWB
     logger.info("Writing sorting results to NWB...")
+    progress.stage_start(stage="write_nwb")
     metadata = {
         "NWBFile": {
             "session_start_time": datetime.now().isoformat(),
@@ -316,8 +399,13 @@ def main(
     if len(critical_violations) > 0:
         logger.info(f"Found critical violations in resulting NWB file: {critical_violations}")
         raise Exception(f"Found critical violations in resulting NWB file: {critical_violations}")
+    progress.stage_end(stage="write_nwb")
+    scratch.consume_stage("nwb")
+    scratch.register(output_nwbfile_path, needed_by=["upload"], keep=output_destination == "local")
 
     # Upload results
+    if output_destination in ["s3", "dandi"]:
+        progress.stage_start(stage="upload", total=Path(output_nwbfile_path).stat().st_size, unit="bytes")
     if output_destination == "s3":
         # Upload results to S3
         upload_file_to_bucket(
@@ -326,7 +414,10 @@ def main(
             bucket_name=output_s3_bucket,
             bucket_folder=output_s3_bucket_folder,
             local_file_path=output_nwbfile_path,
+            callback=progress.bytes_callback(stage="upload"),
         )
+        progress.stage_end(stage="upload")
+        scratch.consume(output_nwbfile_path, stage="upload")
 
     elif output_destination == "dandi":
         # Check if DANDI_API_KEY is present in ENV variables
@@ -334,61 +425,107 @@ def main(
         if DANDI_API_KEY is None:
             raise Exception("DANDI_API_KEY not found in ENV variables. Cannot upload results to DANDI.")
         
-        # Download DANDI dataset
-        logger.info(f"Downloading dandiset: {output_path}")
-        dandiset_id_number = output_path.split("/")[-1]
-        dandiset_local_base_path = Path("dandiset").resolve()
-        dandiset_local_full_path = dandiset_local_base_path / dandiset_id_number
-        if not dandiset_local_base_path.exists():
-            dandiset_local_base_path.mkdir(parents=True)
+        dandi_instance = "dandi-staging" if "staging" in output_path else "dandi"
+        if dandi_instance == "dandi-staging":
+            DANDI_API_KEY = os.environ.get("DANDI_API_KEY_STAGING", None)
+            if DANDI_API_KEY is None:
+                raise Exception("DANDI_API_KEY_STAGING not found in ENV variables. Cannot upload results to DANDI staging.")
+
+        # Get DANDI dataset metadata - cached between runs in the mounted results volume, unless configured otherwise
+        dandiset_local_base_path = Path(os.environ.get("DANDISET_CACHE_DIR", "/results/dandiset"))
         try:
-            download(
-                urls=[output_path],
-                output_dir=str(dandiset_local_base_path),
-                get_metadata=True,
-                get_assets=False,
-                sync=False,
+            dandiset_local_full_path = download_dandiset_metadata(
+                logger=logger,
+                dandiset_url=output_path,
+                dandiset_local_base_path=dandiset_local_base_path,
             )
-        except subprocess.CalledProcessError as e:
-            raise Exception("Error downloading DANDI dataset.\n{e}")
-        
+        except Exception as e:
+            raise Exception(f"Error downloading DANDI dataset metadata: {output_path}\n{e}") from e
+
         # Organize DANDI dataset
-        logger.info(f"Organizing dandiset: {dandiset_id_number}")
-        organize(
-            paths=output_nwbfile_path,
-            dandiset_path=str(dandiset_local_full_path),
+        logger.info(f"Organizing dandiset: {dandiset_local_full_path.name}")
+        new_nwb_files = organize_nwb_files(
+            nwb_files_paths=[output_nwbfile_path],
+            dandiset_local_full_path=dandiset_local_full_path,
         )
+        if len(new_nwb_files) == 0:
+            raise Exception(f"No new NWB files were organized into dandiset: {dandiset_local_full_path.name}")
 
-        # Validate nwb file for DANDI
-        logger.info("Validating NWB file for DANDI...")
-        validation_errors = [v for v in validate(str(dandiset_local_full_path))]
+        # Validate only the newly organized nwb files for DANDI
+        logger.info(f"Validating {len(new_nwb_files)} NWB files for DANDI...")
+        validation_errors = [v for v in validate(*new_nwb_files)]
         if len(validation_errors) > 0:
             logger.info(f"Found DANDI validation errors in resulting NWB file: {validation_errors}")
             raise Exception(f"Found DANDI validation errors in resulting NWB file: {validation_errors}")
 
         # Upload results to DANDI
         logger.info(f"Uploading results to DANDI: {output_path}")
-        dandi_instance = "dandi-staging" if "staging" in output_path else "dandi"
-        if dandi_instance == "dandi-staging":
-            DANDI_API_KEY = os.environ.get("DANDI_API_KEY_STAGING", None)
-            if DANDI_API_KEY is None:
-                raise Exception("DANDI_API_KEY_STAGING not found in ENV variables. Cannot upload results to DANDI staging.")
-        # upload(
-        #     paths=[str(dandiset_local_full_path)],
-        #     existing="refresh",
-        #     validation="require",
-        #     dandi_instance=dandi_instance,
-        #     sync=True,
-        # )
+        upload_files_to_dandiset(
+            logger=logger,
+            files_paths=new_nwb_files,
+            dandiset_local_full_path=dandiset_local_full_path,
+            dandi_instance=dandi_instance,
+            dandi_api_key=DANDI_API_KEY,
+        )
+        progress.stage_end(stage="upload")
+        # Uploaded files are removed from the local dandiset copy, only its cached metadata is kept
+        for f in new_nwb_files:
+            scratch.release(f)
+        scratch.consume(output_nwbfile_path, stage="upload")
     else:
         # Upload results to local - already done by mounted volume
         pass
 
+    # Runs with failed sorters are reported as failed
+    failed_sorters = [k for k, v in progress.snapshot["stages"].items() if k.startswith("sorting_") and v == "fail"]
+    progress.run_end(status="fail" if len(failed_sorters) > 0 else "success")
     logger.info("Sorting job completed successfully!")
 
 
+def get_job_spec_arguments() -> dict:
+    """
+    Get the arguments of main() from the job spec at JOB_SPEC_URL, if any.
+    """
+    job_spec_url = os.environ.get("JOB_SPEC_URL", None)
+    if not job_spec_url or job_spec_url == "None":
+        return dict()
+    job_spec = load_job_spec(
+        client=boto3.client('s3'),
+        job_spec_url=job_spec_url,
+        job_spec_sha256=os.environ.get("JOB_SPEC_SHA256", None),
+    )
+    parameters = inspect.signature(main).parameters
+    return {k: v for k, v in job_spec.items() if k in parameters and v is not None}
+
+
+def get_array_job_child(run_identifier:str):
+    """
+    For a child of a parameter sweep array job, get its run identifier and its sorters kwargs,
+    selected by AWS_BATCH_JOB_ARRAY_INDEX from the grid stored once at SWEEP_GRID_URL.
+    Other jobs are returned unchanged, with no sorters kwargs.
+    """
+    array_index = os.environ.get("AWS_BATCH_JOB_ARRAY_INDEX", None)
+    sweep_grid_url = os.environ.get("SWEEP_GRID_URL", None)
+    if array_index is None or not sweep_grid_url or sweep_grid_url == "None":
+        return run_identifier, None
+    array_index = int(array_index)
+    grid = read_json_from_s3(client=boto3.client('s3'), s3_url=sweep_grid_url)
+    return f"{run_identifier}-{array_index:04d}", grid[array_index]
+
+
 if __name__ == '__main__':
-    main()
+    run_identifier = os.environ.get("RUN_IDENTIFIER", datetime.now().strftime("%Y%m%d%H%M%S"))
+    try:
+        job_spec_arguments = get_job_spec_arguments()
+        run_identifier, sorters_kwargs = get_array_job_child(run_identifier)
+        main(**{
+            **job_spec_arguments,
+            "run_identifier": run_identifier,
+            "sorters_kwargs": sorters_kwargs or job_spec_arguments.get("sorters_kwargs", None),
+        })
+    except Exception:
+        emit_run_failed(run_identifier=run_identifier)
+        raise
 
 # Known issues:
 #
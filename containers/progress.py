@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import threading
+import logging
+import multiprocessing.util
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+from spikeinterface.preprocessing.basepreprocessor import BasePreprocessor, BasePreprocessorSegment
+
+
+def get_events_file_path(run_identifier: str) -> str:
+    return f"/logs/sorting_worker_{run_identifier}.events.jsonl"
+
+
+def append_event(events_file_path: str, event: dict) -> None:
+    # Small appends are atomic, so events can be written concurrently by job processes
+    line = json.dumps(event, separators=(",", ":")) + "\n"
+    with open(events_file_path, "a") as f:
+        f.write(line)
+
+
+def get_snapshot_file_path(events_file_path: str) -> str:
+    return str(Path(events_file_path).with_suffix(".json"))
+
+
+def write_progress_snapshot(snapshot_file_path: str, snapshot: dict) -> None:
+    # Written to a temporary file then renamed, so that readers never see a partial snapshot
+    tmp_file_path = f"{snapshot_file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file_path, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(tmp_file_path, snapshot_file_path)
+
+
+def emit_run_failed(run_identifier: str) -> None:
+    """
+    Mark a run as failed, for runs interrupted by an unhandled exception.
+    """
+    events_file_path = get_events_file_path(run_identifier)
+    if Path(events_file_path).exists():
+        event = dict(t=round(time.time(), 3), ev="run_end", status="fail")
+        append_event(events_file_path, event)
+        snapshot_file_path = get_snapshot_file_path(events_file_path)
+        if Path(snapshot_file_path).exists():
+            write_progress_snapshot(snapshot_file_path, apply_event(load_progress_snapshot(snapshot_file_path), event))
+
+
+def new_progress_snapshot() -> dict:
+    return dict(
+        status="running",
+        stage=None,
+        stage_done=0,
+        stage_total=None,
+        unit=None,
+        stage_started_at=None,
+        bytes_transferred=0,
+        started_at=None,
+        updated_at=None,
+        eta_seconds=None,
+        stages=dict(),
+    )
+
+
+def load_progress_snapshot(snapshot_file_path: str) -> dict:
+    """
+    Read the latest progress snapshot of a run, as written by its ProgressReporter.
+
+    Returns:
+        dict: Snapshot with run status, current stage, stage progress, bytes transferred and ETA.
+    """
+    with open(snapshot_file_path, "r") as f:
+        return json.load(f)
+
+
+def fold_progress_events(events_file_path: str, snapshot: dict = None, offset: int = 0) -> Tuple[dict, int]:
+    """
+    Fold the events of a JSONL events file written after a byte offset into a progress snapshot.
+
+    Returns:
+        tuple: (snapshot, offset after the last complete event read)
+    """
+    snapshot = snapshot if snapshot is not None else new_progress_snapshot()
+    with open(events_file_path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    # Last line might still be being written, it is read on the next call
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines():
+        try:
+            event = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        apply_event(snapshot, event)
+    return snapshot, offset + end
+
+
+def apply_event(snapshot: dict, event: dict) -> dict:
+    ev = event.get("ev")
+    t = event.get("t")
+    snapshot["updated_at"] = t
+    if ev == "run_start":
+        snapshot["started_at"] = t
+        snapshot["run_identifier"] = event.get("run_identifier")
+    elif ev == "stage_start":
+        snapshot["stage"] = event["stage"]
+        snapshot["stage_done"] = 0
+        snapshot["stage_total"] = event.get("total")
+        snapshot["unit"] = event.get("unit")
+        snapshot["stage_started_at"] = t
+        snapshot["stages"][event["stage"]] = "running"
+    elif ev == "progress":
+        # Progress events without a stage count towards the current stage
+        if event.get("stage") in (None, snapshot["stage"]) and event.get("unit") == snapshot["unit"]:
+            snapshot["stage_done"] += event.get("inc", 0)
+        if event.get("unit") == "bytes":
+            snapshot["bytes_transferred"] += event.get("inc", 0)
+    elif ev == "stage_end":
+        snapshot["stages"][event["stage"]] = event.get("status", "success")
+    elif ev == "run_end":
+        snapshot["status"] = event.get("status", "success")
+
+    # ETA from the average rate of the current stage
+    snapshot["eta_seconds"] = None
+    if snapshot["status"] == "running" and snapshot["stage_total"] and snapshot["stage_done"] > 0:
+        elapsed = t - snapshot["stage_started_at"]
+        remaining = max(snapshot["stage_total"] - snapshot["stage_done"], 0)
+        snapshot["eta_seconds"] = round(elapsed / snapshot["stage_done"] * remaining, 1)
+    return snapshot
+
+
+# Frames read by chunked job execution, accumulated in each process and appended to the events file
+# at most every PROGRESS_EMIT_INTERVAL seconds, instead of one event per chunk
+PROGRESS_EMIT_INTERVAL = 1.
+_pending_progress: Dict[Tuple[str, str, str], int] = dict()
+_pending_progress_lock = threading.Lock()
+_pending_progress_emitted_at = 0.
+_pending_progress_finalizer = None
+
+
+def add_pending_progress(events_file_path: str, stage: str, inc: int, unit: str) -> None:
+    global _pending_progress_finalizer
+    with _pending_progress_lock:
+        key = (events_file_path, stage, unit)
+        _pending_progress[key] = _pending_progress.get(key, 0) + inc
+        if _pending_progress_finalizer is None:
+            # Run when the process exits, including job processes, so that their last chunks are counted
+            _pending_progress_finalizer = multiprocessing.util.Finalize(None, flush_pending_progress, exitpriority=10)
+        if time.time() - _pending_progress_emitted_at < PROGRESS_EMIT_INTERVAL:
+            return
+    flush_pending_progress()
+
+
+def flush_pending_progress() -> None:
+    """
+    Append the frames accumulated by this process to the events files.
+    """
+    global _pending_progress_emitted_at
+    with _pending_progress_lock:
+        pending_progress = dict(_pending_progress)
+        _pending_progress.clear()
+        _pending_progress_emitted_at = time.time()
+    for (events_file_path, stage, unit), inc in pending_progress.items():
+        append_event(
+            events_file_path,
+            dict(t=round(time.time(), 3), ev="progress", stage=stage, inc=inc, unit=unit),
+        )
+
+
+def _reset_pending_progress() -> None:
+    # Forked processes start with no pending frames, and register their own finalizer
+    global _pending_progress_lock, _pending_progress_finalizer
+    _pending_progress_lock = threading.Lock()
+    _pending_progress.clear()
+    _pending_progress_finalizer = None
+
+
+os.register_at_fork(after_in_child=_reset_pending_progress)
+
+
+class ProgressReporter:
+    """
+    Emits a compact JSONL stream of progress events for a run: run and stage start/end,
+    chunk progress and bytes transferred. The events are folded incrementally into a snapshot,
+    which is written to a small JSON file for status reads. The snapshot is also logged
+    on stage changes and periodically, so it can be recovered from the container
+    logs (e.g. CloudWatch).
+    """
+
+    def __init__(
+        self, 
+        run_identifier: str, 
+        logger: logging.Logger, 
+        events_file_path: str = None,
+        log_interval: float = 30.,
+        snapshot_interval: float = 1.,
+    ):
+        self.run_identifier = run_identifier
+        self.logger = logger
+        self.events_file_path = events_file_path or get_events_file_path(run_identifier)
+        self.snapshot_file_path = get_snapshot_file_path(self.events_file_path)
+        Path(self.events_file_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(self.events_file_path).unlink(missing_ok=True)
+        Path(self.snapshot_file_path).unlink(missing_ok=True)
+        self._lock = threading.RLock()
+        self._snapshot = new_progress_snapshot()
+        self._events_offset = 0
+        self._pending_bytes = dict()
+        self._last_emitted = 0.
+        self._finished = threading.Event()
+        self.emit(ev="run_start", run_identifier=run_identifier)
+
+        # Periodically refresh the snapshot with the chunk progress written by job processes, and log it
+        self._refresh_thread = threading.Thread(target=self._refresh_periodically, args=(snapshot_interval, log_interval), daemon=True)
+        self._refresh_thread.start()
+
+    @property
+    def snapshot(self) -> dict:
+        return self.refresh_snapshot()
+
+    def refresh_snapshot(self) -> dict:
+        """
+        Fold the events written since the last refresh into the snapshot, and write it to the snapshot file.
+        """
+        with self._lock:
+            self._snapshot, self._events_offset = fold_progress_events(
+                self.events_file_path,
+                snapshot=self._snapshot,
+                offset=self._events_offset,
+            )
+            write_progress_snapshot(self.snapshot_file_path, self._snapshot)
+            return json.loads(json.dumps(self._snapshot))
+
+    def log_snapshot(self) -> None:
+        self.logger.info(f"PROGRESS {json.dumps(self.snapshot, separators=(',', ':'))}")
+
+    def _refresh_periodically(self, snapshot_interval: float, log_interval: float) -> None:
+        logged_at = time.time()
+        while not self._finished.wait(timeout=snapshot_interval):
+            if time.time() - logged_at >= log_interval:
+                logged_at = time.time()
+                self.log_snapshot()
+            else:
+                self.refresh_snapshot()
+
+    def emit(self, log_snapshot: bool = True, **event) -> None:
+        with self._lock:
+            event["t"] = round(time.time(), 3)
+            append_event(self.events_file_path, event)
+            if log_snapshot:
+                self.log_snapshot()
+            else:
+                self.refresh_snapshot()
+
+    def stage_start(self, stage: str, total: int = None, unit: str = None) -> None:
+        self.flush()
+        self.emit(ev="stage_start", stage=stage, total=total, unit=unit)
+
+    def stage_end(self, stage: str, status: str = "success") -> None:
+        self.flush()
+        self.emit(ev="stage_end", stage=stage, status=status)
+
+    def run_end(self, status: str = "success") -> None:
+        self.flush()
+        self._finished.set()
+        self.emit(ev="run_end", status=status)
+
+    def flush(self) -> None:
+        # Chunk progress of this process counts towards the stage it was read in
+        flush_pending_progress()
+        self.flush_bytes()
+
+    def flush_bytes(self) -> None:
+        with self._lock:
+            pending_bytes = self._pending_bytes
+            self._pending_bytes = dict()
+            for stage, pending in pending_bytes.items():
+                self.emit(log_snapshot=False, ev="progress", stage=stage, inc=pending, unit="bytes")
+
+    def bytes_callback(self, stage: str):
+        """
+        Callback for boto3 transfers (and other chunked transfers) reporting transferred bytes.
+        Bytes are accumulated and emitted at most every second.
+        """
+        def callback(bytes_amount: int):
+            with self._lock:
+                self._pending_bytes[stage] = self._pending_bytes.get(stage, 0) + bytes_amount
+                now = time.time()
+                if now - self._last_emitted >= 1:
+                    self._last_emitted = now
+                    self.flush_bytes()
+
+        return callback
+
+
+class ProgressRecording(BasePreprocessor):
+    """
+    Pass-through recording that reports the frames read by chunked job execution
+    to the run events file, from any of the job processes, aggregated in each process.
+    If stage is None, frames count towards the current stage of the run.
+    """
+
+    name = "progress"
+
+    def __init__(self, recording, events_file_path: str, stage: str = None):
+        BasePreprocessor.__init__(self, recording)
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(ProgressRecordingSegment(parent_segment, events_file_path, stage))
+        self._kwargs = dict(recording=recording, events_file_path=events_file_path, stage=stage)
+
+
+class ProgressRecordingSegment(BasePreprocessorSegment):
+    def __init__(self, parent_recording_segment, events_file_path: str, stage: str):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+        self.events_file_path = events_file_path
+        self.stage = stage
+
+    def get_traces(
+        self,
+        start_frame: Union[int, None] = None,
+        end_frame: Union[int, None] = None,
+        channel_indices: Union[List, None] = None,
+    ):
+        traces = self.parent_recording_segment.get_traces(start_frame, end_frame, channel_indices)
+        add_pending_progress(self.events_file_path, stage=self.stage, inc=traces.shape[0], unit="frames")
+        return traces
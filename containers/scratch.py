@@ -0,0 +1,94 @@
+import shutil
+import logging
+from pathlib import Path
+from typing import Dict, List, Set, Union
+
+
+def get_path_size(path: Union[str, Path]) -> int:
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+class InsufficientDiskSpaceError(Exception):
+    pass
+
+
+class ScratchManager:
+    """
+    Tracks the artifacts written to scratch disk during a run and which stages still need them,
+    so that each artifact is deleted as soon as it has been consumed by its last stage or uploaded.
+    Peak disk usage then follows the largest stage, instead of the sum of all stages.
+
+    Artifacts registered with keep=True (e.g. results saved to a mounted local volume) are demoted
+    instead: they stop being tracked, but are never deleted.
+    """
+
+    def __init__(self, logger: logging.Logger, safety_margin: float = 1.1):
+        self.logger = logger
+        self.safety_margin = safety_margin
+        self.artifacts: Dict[str, Set[str]] = dict()
+        self.keep: Set[str] = set()
+
+    def check_free_space(self, stage: str, path: Union[str, Path], required_bytes: int) -> None:
+        """
+        Fail early if the disk holding path does not have enough free space for a stage.
+        """
+        path = Path(path)
+        while not path.exists():
+            path = path.parent
+        free_bytes = shutil.disk_usage(path).free
+        required_bytes = int(required_bytes * self.safety_margin)
+        self.logger.info(f"Stage {stage}: {required_bytes / 1e9:.2f} GB required, {free_bytes / 1e9:.2f} GB free on {path}")
+        if free_bytes < required_bytes:
+            raise InsufficientDiskSpaceError(
+                f"Not enough disk space for stage {stage}: {required_bytes / 1e9:.2f} GB required, {free_bytes / 1e9:.2f} GB free on {path}"
+            )
+
+    def register(self, path: Union[str, Path], needed_by: List[str], keep: bool = False) -> None:
+        """
+        Register an artifact, and the stages that still need it.
+        """
+        path = str(path)
+        self.artifacts.setdefault(path, set()).update(needed_by)
+        if keep:
+            self.keep.add(path)
+
+    def consume(self, path: Union[str, Path], stage: str) -> None:
+        """
+        Mark an artifact as consumed by a stage, releasing it when no other stage needs it.
+        """
+        path = str(path)
+        if path not in self.artifacts:
+            return
+        self.artifacts[path].discard(stage)
+        if len(self.artifacts[path]) == 0:
+            self.release(path)
+
+    def consume_stage(self, stage: str) -> None:
+        """
+        Mark all artifacts as consumed by a stage.
+        """
+        for path in list(self.artifacts.keys()):
+            self.consume(path, stage)
+
+    def release(self, path: Union[str, Path]) -> None:
+        """
+        Delete an artifact, or demote it if it should be kept.
+        """
+        path = str(path)
+        self.artifacts.pop(path, None)
+        if path in self.keep:
+            self.keep.discard(path)
+            self.logger.info(f"Keeping artifact: {path}")
+            return
+        p = Path(path)
+        if not p.exists():
+            return
+        size = get_path_size(p)
+        if p.is_dir():
+            shutil.rmtree(p, ignore_errors=True)
+        else:
+            p.unlink(missing_ok=True)
+        self.logger.info(f"Removed artifact {path}, freed {size / 1e9:.2f} GB")
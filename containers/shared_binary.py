@@ -0,0 +1,93 @@
+import shutil
+import logging
+import threading
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from spikeinterface.core import BaseRecording
+from spikeinterface.sorters import sorter_dict
+
+
+def get_binary_sorters(sorters_names_list: List[str]) -> List[str]:
+    """
+    Get the sorters, from a list of sorters names, that read the recording from a binary file.
+    """
+    return [s for s in sorters_names_list if s in sorter_dict and sorter_dict[s].requires_binary_data]
+
+
+def get_shared_binary_sorters(recording: BaseRecording, sorters_names_list: List[str]) -> List[str]:
+    """
+    Get the sorters that share a single binary copy of the recording. Copies are only shared for int16
+    recordings, the dtype expected by all binary sorters: other dtypes are left to the copies written by each sorter,
+    as casting them to int16 without their gain and offset would corrupt the traces. A copy is only worth sharing
+    between at least two sorters, and not needed when the recording already has the binary layout.
+    """
+    binary_sorters = get_binary_sorters(sorters_names_list)
+    if len(binary_sorters) < 2 or np.dtype(recording.get_dtype()) != np.dtype("int16"):
+        return []
+    if recording.binary_compatible_with(dtype="int16", time_axis=0, file_paths_lenght=1):
+        return []
+    return binary_sorters
+
+
+class SharedBinaryRecording:
+    """
+    Writes a recording once to the common binary layout (single file, time axis 0, in its own dtype),
+    and hands the resulting binary recording to every sorter that reads binary data, so that compatible
+    sorters (e.g. kilosort) use it directly instead of writing their own recording.dat copy.
+
+    The binary folder is reference counted by the sorters registered as users, and it is deleted
+    when the last of them releases it.
+    """
+
+    def __init__(
+        self,
+        recording: BaseRecording,
+        folder: str,
+        users: List[str],
+        logger: logging.Logger,
+        **job_kwargs,
+    ):
+        self.recording = recording
+        self.folder = Path(folder)
+        self.users = set(users)
+        self.logger = logger
+        self.job_kwargs = job_kwargs
+        self.binary_recording = None
+        self._lock = threading.Lock()
+
+    def _materialize(self):
+        self.logger.info(f"Writing shared binary recording to {self.folder} for sorters: {sorted(self.users)}")
+        if self.folder.exists():
+            shutil.rmtree(self.folder)
+        self.binary_recording = self.recording.save(
+            format="binary",
+            folder=self.folder,
+            dtype=self.recording.get_dtype(),
+            **self.job_kwargs
+        )
+
+    def acquire(self, sorter_name: str) -> BaseRecording:
+        """
+        Get the recording to be used by a sorter. Sorters not registered as users get the original recording.
+        """
+        with self._lock:
+            if sorter_name not in self.users:
+                return self.recording
+            if self.binary_recording is None:
+                self._materialize()
+            return self.binary_recording
+
+    def release(self, sorter_name: str) -> None:
+        """
+        Release the shared binary recording for a sorter, deleting it after the last user releases it.
+        """
+        with self._lock:
+            if sorter_name not in self.users:
+                return
+            self.users.discard(sorter_name)
+            if len(self.users) == 0 and self.folder.exists():
+                self.logger.info(f"Removing shared binary recording: {self.folder}")
+                self.binary_recording = None
+                shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,345 @@
+import os
+import re
+import threading
+import tempfile
+import concurrent.futures
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Union
+
+import boto3
+import numpy as np
+import probeinterface as pi
+from spikeinterface.core import BaseRecording, BaseRecordingSegment
+from spikeinterface.core.core_tools import define_function_from_class
+from spikeinterface.extractors.neuropixels_utils import get_neuropixels_sample_shifts
+
+
+def parse_s3_url(url: str):
+    url_parsed = url.split("s3://")[-1]
+    bucket_name = url_parsed.split("/")[0]
+    key = "/".join(url_parsed.split("/")[1:])
+    return bucket_name, key
+
+
+def get_spikeglx_stream_name(file_url: str) -> str:
+    """
+    Stream name of a SpikeGLX file, from its name. E.g. run_g0_t0.imec0.ap.bin -> imec0.ap, run_g0_t0.nidq.bin -> nidq
+    """
+    match = re.search(r"\.(imec\d*\.(?:ap|lf)|nidq)\.(?:bin|meta)$", file_url.split("/")[-1])
+    return match.group(1) if match else None
+
+
+def select_spikeglx_stream_urls(urls: List[str], stream_id: str = None):
+    """
+    Select the .bin and .meta urls of a SpikeGLX stream (e.g. imec0.ap) among the urls of a recording.
+    Without stream_id, the recording must have a single stream.
+
+    Returns:
+        tuple: (file_bin_url, file_meta_url)
+    """
+    bin_urls = {get_spikeglx_stream_name(u): u for u in urls if u.endswith(".bin")}
+    meta_urls = {get_spikeglx_stream_name(u): u for u in urls if u.endswith(".meta")}
+    if stream_id is None:
+        if len(bin_urls) != 1:
+            raise ValueError(f"SpikeGLX recording has {len(bin_urls)} streams, a stream_id is required. Streams: {sorted(bin_urls, key=str)}")
+        stream_id = next(iter(bin_urls))
+    if stream_id not in bin_urls:
+        raise ValueError(f"No .bin file for SpikeGLX stream {stream_id}. Streams: {sorted(bin_urls, key=str)}")
+    if stream_id not in meta_urls:
+        raise ValueError(f"No .meta file for SpikeGLX stream {stream_id}.")
+    return bin_urls[stream_id], meta_urls[stream_id]
+
+
+def parse_spikeglx_meta(meta_text: str) -> dict:
+    """
+    Parse the content of a SpikeGLX .meta file into a dictionary.
+    Keys starting with "~" (e.g. "~imroTbl") are stored without the "~".
+    """
+    meta = dict()
+    for line in meta_text.splitlines():
+        line = line.strip()
+        if "=" not in line:
+            continue
+        k, v = line.split("=", 1)
+        meta[k.strip().lstrip("~")] = v.strip()
+    return meta
+
+
+def get_spikeglx_channels_info(meta: dict, stream_kind: str, load_sync_channel: bool = False):
+    """
+    Get the names and gains (in uV) of the saved channels described in a SpikeGLX .meta file,
+    following the same conventions as neo's SpikeGLXRawIO.
+    """
+    num_saved_channels = int(meta["nSavedChans"])
+    channel_names = [
+        e.strip("()").split(";")[0]
+        for e in meta["snsChanMap"].split(")(")[1:]
+    ][:num_saved_channels]
+
+    if meta["typeThis"] == "imec":
+        ap_count, lf_count, sy_count = [int(c) for c in meta["snsApLfSy"].split(",")]
+        num_signal_channels = ap_count + lf_count
+        max_int = int(meta.get("imMaxInt", 512))
+        range_max = float(meta["imAiRangeMax"])
+        imro_entries = [e.strip("()").split(" ") for e in meta.get("imroTbl", "").split(")(")[1:]]
+        gains = np.ones(num_saved_channels, dtype="float64")
+        for i in range(num_signal_channels):
+            # NP1.0 imro entries hold per channel AP and LF gains, NP2.0 have a fixed gain of 80
+            if i < len(imro_entries) and len(imro_entries[i]) == 6:
+                gain = float(imro_entries[i][3] if stream_kind == "ap" else imro_entries[i][4])
+            else:
+                gain = 80.0
+            gains[i] = range_max / max_int / gain * 1e6
+    else:
+        num_signal_channels = num_saved_channels - int(meta["snsMnMaXaDw"].split(",")[-1])
+        range_max = float(meta["niAiRangeMax"])
+        gains = np.full(num_saved_channels, range_max / 32768 * 1e6, dtype="float64")
+
+    if not load_sync_channel:
+        channel_names = channel_names[:num_signal_channels]
+        gains = gains[:num_signal_channels]
+    return channel_names, gains
+
+
+class SpikeGLXS3RecordingExtractor(BaseRecording):
+    """
+    Recording extractor that reads a SpikeGLX binary file directly from S3, without downloading it.
+
+    Traces are served by concurrent ranged GET requests over fixed size blocks, kept in a LRU cache.
+    When consecutive calls read the file sequentially (as chunked job execution does), the following
+    blocks are prefetched in the background.
+
+    Parameters
+    ----------
+    file_bin_url: str
+        S3 url of the binary file. E.g. s3://bucket/path/to/file.imec0.ap.bin
+    file_meta_url: str
+        S3 url of the meta file. E.g. s3://bucket/path/to/file.imec0.ap.meta
+    load_sync_channel: bool
+        If True, the sync channel is also loaded. Default False.
+    block_size: int
+        Size in bytes of each ranged read. Rounded down to a multiple of the frame size. Default 8 MiB.
+    cache_size: int
+        Max number of blocks kept in memory, per process. Default 32.
+    read_ahead: int
+        Number of blocks prefetched after a sequential read. Default 4.
+    n_threads: int
+        Number of threads used for concurrent ranged reads. Default 8.
+    """
+
+    extractor_name = "SpikeGLXS3"
+    mode = "file"
+    name = "spikeglx_s3"
+
+    def __init__(
+        self,
+        file_bin_url: str,
+        file_meta_url: str,
+        load_sync_channel: bool = False,
+        block_size: int = 8 * 1024 * 1024,
+        cache_size: int = 32,
+        read_ahead: int = 4,
+        n_threads: int = 8,
+    ):
+        s3_client = boto3.client("s3")
+
+        meta_bucket_name, meta_key = parse_s3_url(file_meta_url)
+        meta_text = s3_client.get_object(Bucket=meta_bucket_name, Key=meta_key)["Body"].read().decode("utf-8")
+        meta = parse_spikeglx_meta(meta_text)
+
+        # e.g. file.imec0.ap.meta -> stream_name: imec0.ap
+        file_name = file_meta_url.split("/")[-1]
+        stream_name = ".".join(file_name.split(".")[-3:-1]) if meta["typeThis"] == "imec" else "nidq"
+        stream_kind = stream_name.split(".")[-1]
+
+        sampling_frequency = float(meta["imSampRate"] if meta["typeThis"] == "imec" else meta["niSampRate"])
+        num_saved_channels = int(meta["nSavedChans"])
+        channel_names, gains = get_spikeglx_channels_info(
+            meta=meta,
+            stream_kind=stream_kind,
+            load_sync_channel=load_sync_channel,
+        )
+        channel_ids = [f"{stream_name}#{c}" for c in channel_names]
+
+        BaseRecording.__init__(self, sampling_frequency, channel_ids, "int16")
+
+        bin_bucket_name, bin_key = parse_s3_url(file_bin_url)
+        file_size = s3_client.head_object(Bucket=bin_bucket_name, Key=bin_key)["ContentLength"]
+        rec_segment = SpikeGLXS3RecordingSegment(
+            bucket_name=bin_bucket_name,
+            key=bin_key,
+            file_size=file_size,
+            sampling_frequency=sampling_frequency,
+            num_saved_channels=num_saved_channels,
+            num_channels=len(channel_ids),
+            block_size=block_size,
+            cache_size=cache_size,
+            read_ahead=read_ahead,
+            n_threads=n_threads,
+        )
+        self.add_recording_segment(rec_segment)
+
+        self.set_channel_gains(gains)
+        self.set_channel_offsets(np.zeros(len(channel_ids)))
+
+        # Probe geometry, read by probeinterface from a local copy of the (small) meta file
+        if meta["typeThis"] == "imec" and not load_sync_channel:
+            meta_local_path = Path(tempfile.gettempdir()) / file_name
+            meta_local_path.write_text(meta_text)
+            probe = pi.read_spikeglx(meta_local_path)
+            if probe.shank_ids is not None:
+                self.set_probe(probe, in_place=True, group_mode="by_shank")
+            else:
+                self.set_probe(probe, in_place=True)
+
+            ptype = probe.annotations["probe_type"]
+            if ptype in [21, 24]:  # NP2.0
+                num_channels_per_adc = 16
+                num_cycles_in_adc = 16
+            else:  # NP1.0
+                num_channels_per_adc = 12
+                num_cycles_in_adc = 13 if stream_kind == "ap" else 12
+            total_channels = 384
+            sample_shifts = get_neuropixels_sample_shifts(total_channels, num_channels_per_adc, num_cycles_in_adc)
+            if self.get_num_channels() != total_channels:
+                chans = pi.get_saved_channel_indices_from_spikeglx_meta(meta_local_path)
+                chans = chans[chans < total_channels]
+                sample_shifts = sample_shifts[chans]
+            self.set_property("inter_sample_shift", sample_shifts)
+
+        self._kwargs = dict(
+            file_bin_url=file_bin_url,
+            file_meta_url=file_meta_url,
+            load_sync_channel=load_sync_channel,
+            block_size=block_size,
+            cache_size=cache_size,
+            read_ahead=read_ahead,
+            n_threads=n_threads,
+        )
+
+
+class SpikeGLXS3RecordingSegment(BaseRecordingSegment):
+    def __init__(
+        self,
+        bucket_name: str,
+        key: str,
+        file_size: int,
+        sampling_frequency: float,
+        num_saved_channels: int,
+        num_channels: int,
+        block_size: int,
+        cache_size: int,
+        read_ahead: int,
+        n_threads: int,
+    ):
+        BaseRecordingSegment.__init__(self, sampling_frequency=sampling_frequency)
+        self.bucket_name = bucket_name
+        self.key = key
+        self.num_saved_channels = num_saved_channels
+        self.num_channels = num_channels
+        self.frame_size = num_saved_channels * np.dtype("int16").itemsize
+        self.num_samples = file_size // self.frame_size
+        self.frames_per_block = max(1, block_size // self.frame_size)
+        self.num_blocks = int(np.ceil(self.num_samples / self.frames_per_block))
+        self.cache_size = max(cache_size, read_ahead + 1)
+        self.read_ahead = read_ahead
+        self.n_threads = n_threads
+
+        self._cache = OrderedDict()
+        self._pending = dict()
+        self._lock = threading.RLock()
+        self._last_end_frame = None
+        # S3 client and thread pool are created lazily, so that each process spawned by job tools gets its own
+        self._client = None
+        self._executor = None
+        self._pid = None
+
+    def get_num_samples(self) -> int:
+        return self.num_samples
+
+    def _ensure_resources(self):
+        if self._pid != os.getpid():
+            self._client = boto3.session.Session().client("s3")
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_threads)
+            self._cache = OrderedDict()
+            self._pending = dict()
+            self._lock = threading.RLock()
+            self._pid = os.getpid()
+
+    def _fetch_block(self, block_index: int) -> np.ndarray:
+        start_frame = block_index * self.frames_per_block
+        end_frame = min(start_frame + self.frames_per_block, self.num_samples)
+        byte_start = start_frame * self.frame_size
+        byte_end = end_frame * self.frame_size - 1
+        response = self._client.get_object(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            Range=f"bytes={byte_start}-{byte_end}",
+        )
+        buffer = response["Body"].read()
+        return np.frombuffer(buffer, dtype="int16").reshape(-1, self.num_saved_channels)
+
+    def _get_block_futures(self, block_indices: List[int]) -> dict:
+        # Return cached blocks as completed futures and submit the missing ones, all under the lock
+        futures = dict()
+        with self._lock:
+            for block_index in block_indices:
+                if block_index in self._cache:
+                    self._cache.move_to_end(block_index)
+                    future = concurrent.futures.Future()
+                    future.set_result(self._cache[block_index])
+                elif block_index in self._pending:
+                    future = self._pending[block_index]
+                else:
+                    future = self._executor.submit(self._fetch_block, block_index)
+                    self._pending[block_index] = future
+                    future.add_done_callback(lambda f, b=block_index: self._store_block(b, f))
+                futures[block_index] = future
+        return futures
+
+    def _store_block(self, block_index: int, future: concurrent.futures.Future):
+        with self._lock:
+            self._pending.pop(block_index, None)
+            if future.exception() is not None:
+                return
+            self._cache[block_index] = future.result()
+            self._cache.move_to_end(block_index)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def get_traces(
+        self,
+        start_frame: Union[int, None] = None,
+        end_frame: Union[int, None] = None,
+        channel_indices: Union[List, None] = None,
+    ) -> np.ndarray:
+        self._ensure_resources()
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = self.num_samples
+        end_frame = min(end_frame, self.num_samples)
+        if channel_indices is None:
+            channel_indices = slice(None)
+        if end_frame <= start_frame:
+            return np.empty((0, self.num_channels), dtype="int16")[:, channel_indices]
+
+        first_block = start_frame // self.frames_per_block
+        last_block = (end_frame - 1) // self.frames_per_block
+        block_indices = list(range(first_block, last_block + 1))
+        futures = self._get_block_futures(block_indices)
+
+        # Sequential access: prefetch the next blocks in the background
+        if self._last_end_frame == start_frame and self.read_ahead > 0:
+            next_blocks = range(last_block + 1, min(last_block + 1 + self.read_ahead, self.num_blocks))
+            self._get_block_futures(list(next_blocks))
+        self._last_end_frame = end_frame
+
+        traces = np.concatenate([futures[b].result() for b in block_indices], axis=0)
+        offset = first_block * self.frames_per_block
+        traces = traces[start_frame - offset:end_frame - offset]
+        return traces[:, :self.num_channels][:, channel_indices]
+
+
+read_spikeglx_s3 = define_function_from_class(source_class=SpikeGLXS3RecordingExtractor, name="read_spikeglx_s3")
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules of the worker are imported from the containers folder, as when it runs
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,60 @@
+import json
+import logging
+
+import numpy as np
+from spikeinterface.core import NumpyRecording
+
+import progress
+from progress import ProgressReporter, ProgressRecording, emit_run_failed, fold_progress_events, load_progress_snapshot
+
+
+def read_events(events_file_path):
+    with open(events_file_path, "r") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_chunk_progress_is_aggregated_in_each_process(tmp_path):
+    reporter = ProgressReporter(run_identifier="run", logger=logging.getLogger("test"), events_file_path=str(tmp_path / "run.events.jsonl"))
+    recording = NumpyRecording(traces_list=[np.zeros((10000, 4), dtype="int16")], sampling_frequency=30000.)
+    recording = ProgressRecording(recording=recording, events_file_path=reporter.events_file_path)
+
+    reporter.stage_start(stage="sorting_kilosort3", total=10000, unit="frames")
+    recording.save(format="binary", folder=tmp_path / "binary", n_jobs=2, chunk_size=100, progress_bar=False)
+    reporter.stage_end(stage="sorting_kilosort3")
+
+    # 100 chunks are read, in a few progress events per process
+    progress_events = [e for e in read_events(reporter.events_file_path) if e["ev"] == "progress"]
+    assert sum(e["inc"] for e in progress_events) == 10000
+    assert len(progress_events) < 10
+    snapshot = load_progress_snapshot(reporter.snapshot_file_path)
+    assert snapshot["stage_done"] == 10000
+    assert snapshot["stages"] == {"sorting_kilosort3": "success"}
+    reporter.run_end()
+
+
+def test_snapshot_is_folded_incrementally(tmp_path):
+    events_file_path = tmp_path / "run.events.jsonl"
+    events_file_path.write_text(
+        '{"t":1,"ev":"stage_start","stage":"download","total":100,"unit":"bytes"}\n'
+        '{"t":2,"ev":"progress","inc":40,"unit":"bytes"}\n'
+        '{"t":3,"ev":"progress","inc"'
+    )
+    snapshot, offset = fold_progress_events(str(events_file_path))
+    assert snapshot["stage_done"] == 40
+    # The partially written last event is read once complete
+    with open(events_file_path, "a") as f:
+        f.write(':10,"unit":"bytes"}\n')
+    snapshot, offset = fold_progress_events(str(events_file_path), snapshot=snapshot, offset=offset)
+    assert snapshot["stage_done"] == 50
+    assert offset == events_file_path.stat().st_size
+
+
+def test_failed_runs_are_marked_in_the_snapshot(tmp_path, monkeypatch):
+    events_file_path = str(tmp_path / "run.events.jsonl")
+    monkeypatch.setattr(progress, "get_events_file_path", lambda run_identifier: events_file_path)
+    reporter = ProgressReporter(run_identifier="run", logger=logging.getLogger("test"), events_file_path=events_file_path)
+    reporter.stage_start(stage="sorting_kilosort3", total=100, unit="frames")
+
+    emit_run_failed(run_identifier="run")
+    assert load_progress_snapshot(reporter.snapshot_file_path)["status"] == "fail"
+    assert reporter.snapshot["status"] == "fail"
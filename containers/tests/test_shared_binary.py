@@ -0,0 +1,40 @@
+import logging
+
+import numpy as np
+from spikeinterface.core import NumpyRecording
+
+from shared_binary import SharedBinaryRecording, get_shared_binary_sorters
+
+
+def make_recording(dtype: str, value: int) -> NumpyRecording:
+    traces = np.full((1000, 4), value, dtype=dtype)
+    return NumpyRecording(traces_list=[traces], sampling_frequency=30000.)
+
+
+def test_only_int16_recordings_are_shared():
+    sorters = ["kilosort2_5", "kilosort3", "mountainsort4"]
+    assert get_shared_binary_sorters(make_recording("int16", 100), sorters) == ["kilosort2_5", "kilosort3"]
+    # Casting these to int16 would wrap their samples around
+    assert get_shared_binary_sorters(make_recording("uint16", 40000), sorters) == []
+    assert get_shared_binary_sorters(make_recording("int32", 70000), sorters) == []
+    assert get_shared_binary_sorters(make_recording("int16", 100), ["kilosort3"]) == []
+
+
+def test_shared_binary_recording_keeps_the_recording_dtype(tmp_path):
+    recording = make_recording("uint16", 40000)
+    shared_binary_recording = SharedBinaryRecording(
+        recording=recording,
+        folder=tmp_path / "binary",
+        users=["kilosort2_5", "kilosort3"],
+        logger=logging.getLogger("test"),
+    )
+    binary_recording = shared_binary_recording.acquire("kilosort3")
+    assert shared_binary_recording.acquire("kilosort2_5") is binary_recording
+    assert binary_recording.get_dtype() == np.dtype("uint16")
+    np.testing.assert_array_equal(binary_recording.get_traces(), recording.get_traces())
+    assert shared_binary_recording.acquire("mountainsort4") is recording
+
+    shared_binary_recording.release("kilosort3")
+    assert (tmp_path / "binary").exists()
+    shared_binary_recording.release("kilosort2_5")
+    assert not (tmp_path / "binary").exists()
@@ -0,0 +1,106 @@
+import boto3
+import numpy as np
+import pytest
+from moto import mock_aws
+
+from spikeglx_s3 import SpikeGLXS3RecordingSegment, get_spikeglx_stream_name, select_spikeglx_stream_urls
+
+
+NUM_SAVED_CHANNELS = 5
+NUM_SAMPLES = 1000
+
+
+@pytest.fixture
+def traces(monkeypatch):
+    # Interleaved int16 samples of a recording with a sync channel, stored on a mocked S3 bucket
+    for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        monkeypatch.setenv(key, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    traces = np.arange(NUM_SAMPLES * NUM_SAVED_CHANNELS, dtype="int16").reshape(NUM_SAMPLES, NUM_SAVED_CHANNELS)
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="recordings")
+        s3.put_object(Bucket="recordings", Key="run_g0_t0.imec0.ap.bin", Body=traces.tobytes())
+        yield traces
+
+
+def make_segment(block_size: int, read_ahead: int = 0) -> SpikeGLXS3RecordingSegment:
+    return SpikeGLXS3RecordingSegment(
+        bucket_name="recordings",
+        key="run_g0_t0.imec0.ap.bin",
+        file_size=NUM_SAMPLES * NUM_SAVED_CHANNELS * 2,
+        sampling_frequency=30000.,
+        num_saved_channels=NUM_SAVED_CHANNELS,
+        num_channels=NUM_SAVED_CHANNELS - 1,
+        block_size=block_size,
+        cache_size=4,
+        read_ahead=read_ahead,
+        n_threads=2,
+    )
+
+
+def test_blocks_are_aligned_on_frames(traces):
+    # 10 bytes per frame: 1000 bytes blocks hold 100 frames, 1005 bytes blocks are rounded down to them too
+    for block_size in [1000, 1005]:
+        segment = make_segment(block_size=block_size)
+        assert segment.frames_per_block == 100
+        assert segment.num_blocks == 10
+    segment = make_segment(block_size=3000)
+    assert segment.num_blocks == 4
+    segment._ensure_resources()
+    np.testing.assert_array_equal(segment._fetch_block(0), traces[0:300])
+    # The last block holds the remaining frames only
+    np.testing.assert_array_equal(segment._fetch_block(3), traces[900:1000])
+
+
+@pytest.mark.parametrize("start_frame, end_frame", [(0, 1000), (0, 1), (150, 150 + 1), (99, 101), (250, 730), (950, 1000), (990, 2000)])
+def test_get_traces_range(traces, start_frame, end_frame):
+    segment = make_segment(block_size=1000)
+    expected = traces[start_frame:min(end_frame, NUM_SAMPLES), :NUM_SAVED_CHANNELS - 1]
+    np.testing.assert_array_equal(segment.get_traces(start_frame, end_frame), expected)
+    np.testing.assert_array_equal(segment.get_traces(start_frame, end_frame, channel_indices=[3, 0]), expected[:, [3, 0]])
+
+
+def test_get_traces_empty_range(traces):
+    segment = make_segment(block_size=1000)
+    assert segment.get_traces(500, 500).shape == (0, NUM_SAVED_CHANNELS - 1)
+    assert segment.get_traces(1000, None).shape == (0, NUM_SAVED_CHANNELS - 1)
+    assert segment.get_traces(500, 500, channel_indices=[1]).shape == (0, 1)
+    assert segment.get_traces(500, 500).dtype == np.int16
+
+
+def test_sequential_reads_prefetch_next_blocks(traces):
+    segment = make_segment(block_size=1000, read_ahead=2)
+    segment.get_traces(0, 100)
+    segment.get_traces(100, 200)
+    for future in list(segment._pending.values()):
+        future.result()
+    assert sorted(segment._cache) == [0, 1, 2, 3]
+
+
+def test_select_spikeglx_stream_urls():
+    urls = [
+        "s3://recordings/run_g0/run_g0_t0.imec0.ap.bin",
+        "s3://recordings/run_g0/run_g0_t0.imec0.ap.meta",
+        "s3://recordings/run_g0/run_g0_t0.imec0.lf.bin",
+        "s3://recordings/run_g0/run_g0_t0.imec0.lf.meta",
+        "s3://recordings/run_g0/run_g0_t0.imec1.ap.bin",
+        "s3://recordings/run_g0/run_g0_t0.imec1.ap.meta",
+    ]
+    assert select_spikeglx_stream_urls(urls, stream_id="imec0.lf") == (urls[2], urls[3])
+    assert select_spikeglx_stream_urls(urls, stream_id="imec1.ap") == (urls[4], urls[5])
+    with pytest.raises(ValueError, match="imec2.ap"):
+        select_spikeglx_stream_urls(urls, stream_id="imec2.ap")
+    # Several streams, none selected
+    with pytest.raises(ValueError, match="stream_id is required"):
+        select_spikeglx_stream_urls(urls)
+    assert select_spikeglx_stream_urls(urls[:2]) == (urls[0], urls[1])
+    with pytest.raises(ValueError, match=".meta"):
+        select_spikeglx_stream_urls(urls[:1], stream_id="imec0.ap")
+
+
+def test_get_spikeglx_stream_name():
+    assert get_spikeglx_stream_name("s3://recordings/run_g0_t0.imec0.ap.bin") == "imec0.ap"
+    assert get_spikeglx_stream_name("run_g0_t0.imec.lf.meta") == "imec.lf"
+    assert get_spikeglx_stream_name("run_g0_t0.nidq.bin") == "nidq"
+    assert get_spikeglx_stream_name("recording.bin") is None
@@ -0,0 +1,95 @@
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from unittest import mock
+
+import pytest
+from pynwb import NWBHDF5IO, NWBFile
+from pynwb.file import Subject
+
+import utils
+from utils import download_dandiset_metadata, organize_nwb_files, upload_files_to_dandiset
+
+
+def test_download_dandiset_metadata_is_cached_between_runs(tmp_path, monkeypatch):
+    downloads = list()
+
+    def fake_download(urls, output_dir, **kwargs):
+        downloads.append((urls, output_dir, kwargs))
+        dandiset_path = tmp_path / "cache" / urls[0].split("/")[-1]
+        dandiset_path.mkdir(parents=True)
+        (dandiset_path / "dandiset.yaml").write_text("identifier: DANDI:000123\n")
+
+    monkeypatch.setattr(utils, "download", fake_download)
+    logger = logging.getLogger("test")
+    dandiset_url = "https://dandiarchive.org/dandiset/000123"
+
+    dandiset_path = download_dandiset_metadata(logger=logger, dandiset_url=dandiset_url, dandiset_local_base_path=tmp_path / "cache")
+    assert dandiset_path == tmp_path / "cache" / "000123"
+    assert downloads == [([dandiset_url], str(tmp_path / "cache"), dict(get_metadata=True, get_assets=False, sync=False))]
+
+    # The metadata of a previous run is reused, without downloading it again
+    assert download_dandiset_metadata(logger=logger, dandiset_url=dandiset_url, dandiset_local_base_path=tmp_path / "cache") == dandiset_path
+    assert len(downloads) == 1
+
+
+def write_nwbfile(path, subject_id: str):
+    nwbfile = NWBFile(
+        session_description="test",
+        identifier=str(uuid.uuid4()),
+        session_start_time=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        subject=Subject(subject_id=subject_id, species="Mus musculus", sex="M", age="P90D"),
+    )
+    with NWBHDF5IO(str(path), "w") as io:
+        io.write(nwbfile)
+
+
+def test_organize_nwb_files_gets_the_new_files_inside_the_dandiset(tmp_path):
+    dandiset_path = tmp_path / "dandiset" / "000123"
+    dandiset_path.mkdir(parents=True)
+    (dandiset_path / "dandiset.yaml").write_text("identifier: DANDI:000123\n")
+    write_nwbfile(tmp_path / "previous.nwb", subject_id="previous")
+    organize_nwb_files(nwb_files_paths=[tmp_path / "previous.nwb"], dandiset_local_full_path=dandiset_path)
+
+    write_nwbfile(tmp_path / "result.nwb", subject_id="mouse1")
+    new_nwb_files = organize_nwb_files(nwb_files_paths=[tmp_path / "result.nwb"], dandiset_local_full_path=dandiset_path)
+
+    assert [f.relative_to(dandiset_path).parts[0] for f in new_nwb_files] == ["sub-mouse1"]
+    # Organized files are real files in the dandiset, not links back to the results folder
+    assert not new_nwb_files[0].is_symlink()
+    assert dandiset_path in new_nwb_files[0].parents
+
+
+def test_upload_files_to_dandiset_calls_dandi_upload(tmp_path, monkeypatch):
+    dandiset_path = tmp_path / "000123"
+    nwb_file = dandiset_path / "sub-mouse1" / "sub-mouse1_ecephys.nwb"
+    nwb_file.parent.mkdir(parents=True)
+    nwb_file.write_bytes(b"nwb")
+    monkeypatch.setattr(utils, "compute_dandi_digests", lambda **kwargs: dict())
+    monkeypatch.delenv("DANDI_API_KEY", raising=False)
+
+    # Autospec makes the call fail on arguments that dandi.upload.upload does not accept
+    with mock.patch("utils.upload", autospec=True) as upload:
+        upload_files_to_dandiset(
+            logger=logging.getLogger("test"),
+            files_paths=[nwb_file],
+            dandiset_local_full_path=dandiset_path,
+            dandi_instance="dandi-staging",
+            dandi_api_key="key",
+            n_jobs=1,
+        )
+    upload.assert_called_once()
+    assert upload.call_args.kwargs["paths"] == [str(nwb_file)]
+    assert upload.call_args.kwargs["dandi_instance"] == "dandi-staging"
+    assert os.environ["DANDI_API_KEY"] == "key"
+
+    with pytest.raises(ValueError):
+        upload_files_to_dandiset(
+            logger=logging.getLogger("test"),
+            files_paths=[tmp_path / "outside.nwb"],
+            dandiset_local_full_path=dandiset_path,
+            dandi_instance="dandi-staging",
+            dandi_api_key="key",
+            n_jobs=1,
+        )
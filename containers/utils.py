@@ -1,9 +1,19 @@
+import os
+import ast
+import json
+import hashlib
 import shutil
 import requests
 import logging
 import sys
-import botocore
+import botocore.client
+import concurrent.futures
 from pathlib import Path
+from typing import List, Union
+from dandi.download import download
+from dandi.organize import organize
+from dandi.upload import upload
+from dandi.support.digests import get_digest
 
 
 class Tee(object):
@@ -56,24 +66,95 @@ def make_logger(run_identifier: str, log_to_file: bool):
     return logger
 
 
-def download_file_from_url(url):
+def download_file_from_url(url, callback=None):
     # ref: https://stackoverflow.com/a/39217788/11483674
     local_filename = "/data/filename.nwb"
     with requests.get(url, stream=True) as r:
         with open(local_filename, 'wb') as f:
-            shutil.copyfileobj(r.raw, f)
+            if callback is None:
+                shutil.copyfileobj(r.raw, f)
+            else:
+                for chunk in r.iter_content(chunk_size=8 * 1024 * 1024):
+                    f.write(chunk)
+                    callback(len(chunk))
+
+
+def get_url_content_length(url):
+    response = requests.head(url, allow_redirects=True)
+    return int(response.headers.get("Content-Length", 0))
+
+
+def get_s3_object_size(
+    client:botocore.client.BaseClient, 
+    s3_url:str
+):
+    s3_path = s3_url.split("s3://")[-1]
+    bucket_name = s3_path.split("/")[0]
+    file_path = "/".join(s3_path.split("/")[1:])
+    return client.head_object(Bucket=bucket_name, Key=file_path)["ContentLength"]
+
+
+def read_json_from_s3(
+    client:botocore.client.BaseClient, 
+    s3_url:str
+):
+    s3_path = s3_url.split("s3://")[-1]
+    bucket_name = s3_path.split("/")[0]
+    file_path = "/".join(s3_path.split("/")[1:])
+    return json.loads(client.get_object(Bucket=bucket_name, Key=file_path)["Body"].read())
+
+
+def read_bytes_from_url(
+    client:botocore.client.BaseClient, 
+    url:str
+) -> bytes:
+    if url.startswith("s3://"):
+        s3_path = url.split("s3://")[-1]
+        bucket_name = s3_path.split("/")[0]
+        file_path = "/".join(s3_path.split("/")[1:])
+        return client.get_object(Bucket=bucket_name, Key=file_path)["Body"].read()
+    response = requests.get(url, timeout=(5, 60))
+    response.raise_for_status()
+    return response.content
+
+
+def load_job_spec(
+    client:botocore.client.BaseClient, 
+    job_spec_url:str,
+    job_spec_sha256:str = None,
+) -> dict:
+    """
+    Fetch the JSON job spec of a run, and validate it against its SHA-256 checksum if given.
+    """
+    body = read_bytes_from_url(client=client, url=job_spec_url)
+    if job_spec_sha256 and hashlib.sha256(body).hexdigest() != job_spec_sha256:
+        raise ValueError(f"Job spec checksum mismatch: {job_spec_url}")
+    job_spec = json.loads(body)
+    if not isinstance(job_spec, dict):
+        raise ValueError(f"Job spec should be a JSON object: {job_spec_url}")
+    return job_spec
+
+
+def parse_env_value(value:str):
+    # Values are JSON, or Python literals (e.g. with True/None) as formerly written by the REST API - never evaluated
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return ast.literal_eval(value)
 
 
 def download_file_from_s3(
     client:botocore.client.BaseClient, 
     bucket_name:str, 
-    file_path:str
+    file_path:str,
+    callback=None,
 ):    
     file_name = file_path.split("/")[-1]
     client.download_file(
         Bucket=bucket_name, 
         Key=file_path, 
-        Filename=f"/data/{file_name}"
+        Filename=f"/data/{file_name}",
+        Callback=callback,
     )
     return file_name       
 
@@ -100,7 +181,8 @@ def upload_file_to_bucket(
     client:botocore.client.BaseClient, 
     bucket_name:str, 
     bucket_folder:str,
-    local_file_path:str
+    local_file_path:str,
+    callback=None,
 ):
     # Upload file to S3
     logger.info(f"Uploading {local_file_path}...")
@@ -108,6 +190,7 @@ def upload_file_to_bucket(
         Filename=local_file_path,
         Bucket=bucket_name,
         Key=f"{bucket_folder}/{local_file_path}",
+        Callback=callback,
     )
 
 
@@ -116,7 +199,8 @@ def upload_all_files_to_bucket_folder(
     client:botocore.client.BaseClient, 
     bucket_name:str, 
     bucket_folder:str,
-    local_folder:str
+    local_folder:str,
+    callback=None,
 ):
     # List files from results, upload them to S3
     files_list = [f for f in Path(local_folder).rglob("*") if f.is_file()]
@@ -126,4 +210,99 @@ def upload_all_files_to_bucket_folder(
             Filename=str(f),
             Bucket=bucket_name,
             Key=f"{bucket_folder}{str(f)}",
+            Callback=callback,
         )
+
+
+def download_dandiset_metadata(
+    logger:logging.Logger,
+    dandiset_url:str,
+    dandiset_local_base_path:Path,
+):
+    # Only fetch dandiset.yaml when it is not yet cached from a previous run
+    dandiset_id_number = dandiset_url.split("/")[-1]
+    dandiset_local_full_path = dandiset_local_base_path / dandiset_id_number
+    if (dandiset_local_full_path / "dandiset.yaml").exists():
+        logger.info(f"Using cached dandiset metadata: {dandiset_local_full_path}")
+        return dandiset_local_full_path
+    logger.info(f"Downloading dandiset metadata: {dandiset_url}")
+    dandiset_local_base_path.mkdir(parents=True, exist_ok=True)
+    download(
+        urls=[dandiset_url],
+        output_dir=str(dandiset_local_base_path),
+        get_metadata=True,
+        get_assets=False,
+        sync=False,
+    )
+    return dandiset_local_full_path
+
+
+def list_nwb_files(folder:Path) -> List[Path]:
+    # Paths are not resolved: organized files must stay under the dandiset folder holding dandiset.yaml
+    return sorted(f.absolute() for f in Path(folder).rglob("*.nwb") if f.is_file())
+
+
+def organize_nwb_files(
+    nwb_files_paths:List[Union[str, Path]],
+    dandiset_local_full_path:Path,
+) -> List[Path]:
+    """
+    Organize NWB files into a local dandiset, and get the paths of the newly organized files.
+    Files are moved rather than symlinked, so that validation and upload read them from inside the dandiset.
+    """
+    existing_nwb_files = {f: f.stat().st_mtime_ns for f in list_nwb_files(dandiset_local_full_path)}
+    organize(
+        paths=[str(f) for f in nwb_files_paths],
+        dandiset_path=str(dandiset_local_full_path),
+        files_mode="move",
+    )
+    return [
+        f for f in list_nwb_files(dandiset_local_full_path)
+        if existing_nwb_files.get(f, None) != f.stat().st_mtime_ns
+    ]
+
+
+def compute_dandi_digests(
+    logger:logging.Logger,
+    files_paths:List[Path],
+    n_jobs:int = None,
+) -> dict:
+    # Digests are memoized on disk by dandi (fscacher), so upload() reuses them instead of hashing again
+    digests = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(get_digest, str(f), "dandi-etag"): f for f in files_paths}
+        for future in concurrent.futures.as_completed(futures):
+            f = futures[future]
+            digests[str(f)] = future.result()
+            logger.info(f"Computed digest for {str(f)}: {digests[str(f)]}")
+    return digests
+
+
+def upload_files_to_dandiset(
+    logger:logging.Logger,
+    files_paths:List[Path],
+    dandiset_local_full_path:Path,
+    dandi_instance:str,
+    dandi_api_key:str,
+    n_jobs:int = None,
+):
+    n_jobs = n_jobs or min(len(files_paths), os.cpu_count() or 1)
+    compute_dandi_digests(logger=logger, files_paths=files_paths, n_jobs=n_jobs)
+    # dandi reads the API key from the environment
+    os.environ["DANDI_API_KEY"] = dandi_api_key
+    logger.info(f"Uploading {len(files_paths)} files to {dandi_instance}...")
+    # Files were already validated, and sync is disabled so that remote assets
+    # not present in the local (metadata-only) dandiset copy are left untouched
+    # dandi finds the dandiset from the dandiset.yaml above each file, so files must be inside the local dandiset
+    outside_files = [f for f in files_paths if Path(dandiset_local_full_path).absolute() not in Path(f).absolute().parents]
+    if len(outside_files) > 0:
+        raise ValueError(f"Files are not in dandiset {dandiset_local_full_path}: {outside_files}")
+    upload(
+        paths=[str(f) for f in files_paths],
+        existing="refresh",
+        validation="skip",
+        dandi_instance=dandi_instance,
+        jobs=n_jobs,
+        jobs_per_file=max(1, (os.cpu_count() or 1) // n_jobs),
+        sync=False,
+    )
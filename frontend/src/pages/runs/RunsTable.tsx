@@ -19,6 +19,7 @@ import DeleteOutlinedIcon from '@material-ui/icons/DeleteOutlined';
 import { makeStyles } from "@mui/styles";
 import { TableRowDataType } from "./types";
 import { restApiClient } from '../../services/clients/restapi.client';
+import { endpoints } from '../../services/config/endpoints.config';
 
 
 const useStyles = makeStyles({
@@ -34,13 +35,15 @@ const RunsTable: React.FC = () => {
     const [tabValue, setTabValue] = useState(0);
 
     const [loadingTableData, setLoadingTableData] = useState(true);
+    const [nextAfterId, setNextAfterId] = useState<number | null>(null);
 
 
-    // Fetch data from backend
-    const fetchData = async () => {
+    // Fetch data from backend - runs are paginated, logs and metadata are fetched for the selected run only
+    const fetchData = async (afterId: number | null = null) => {
         try {
-            const response = await restApiClient.get('/runs/list');
-            setTableData(response.data.runs);
+            const response = await restApiClient.get('/runs/list', { params: { after_id: afterId ?? undefined } });
+            setTableData((prevData) => afterId ? [...prevData, ...response.data.runs] : response.data.runs);
+            setNextAfterId(response.data.next_after_id);
             setLoadingTableData(false);
         } catch (error) {
             console.error("Error fetching data:", error);
@@ -49,10 +52,42 @@ const RunsTable: React.FC = () => {
 
     useEffect(() => {
         fetchData();
+
+        // Subscribe once to runs changes - the browser reconnects and resumes from the last event by itself
+        const eventSource = new EventSource(`${endpoints?.api ?? ''}/runs/events`);
+        const updateRow = (id: number, update: Partial<TableRowDataType>) => {
+            setTableData((prevData) => prevData.map((row) => row.id === id ? { ...row, ...update } : row));
+            setSelectedRow((prevRow) => prevRow?.id === id ? { ...prevRow, ...update } : prevRow);
+        };
+        eventSource.addEventListener('run', (event) => {
+            const { id, ...update } = JSON.parse((event as MessageEvent).data);
+            updateRow(id, update);
+        });
+        eventSource.addEventListener('logs', (event) => {
+            const { id, lines } = JSON.parse((event as MessageEvent).data);
+            setSelectedRow((prevRow) => prevRow?.id === id ? { ...prevRow, logs: (prevRow.logs ?? '') + lines.join('\n') + '\n' } : prevRow);
+        });
+        eventSource.addEventListener('run_created', (event) => {
+            const run = JSON.parse((event as MessageEvent).data);
+            setTableData((prevData) => prevData.some((row) => row.id === run.id) ? prevData : [run, ...prevData]);
+        });
+        eventSource.addEventListener('run_deleted', (event) => {
+            const { id } = JSON.parse((event as MessageEvent).data);
+            setTableData((prevData) => prevData.filter((row) => row.id !== id));
+        });
+        // Missed events can not be replayed, reload the runs
+        eventSource.addEventListener('reset', () => fetchData());
+        return () => eventSource.close();
     }, []);
 
-    const handleSelectRow = (row: TableRowDataType): void => {
+    const handleSelectRow = async (row: TableRowDataType) => {
         setSelectedRow(row);
+        try {
+            const response = await restApiClient.get('/runs/info', { params: { run_id: row.id } });
+            setSelectedRow(response.data.run);
+        } catch (error) {
+            console.error("Error fetching run info:", error);
+        }
     };
 
     const handleDeleteRow = async (index: number) => {
@@ -142,6 +177,11 @@ const RunsTable: React.FC = () => {
                     </Table>
                 )}
             </TableContainer>
+            {nextAfterId && (
+                <Button onClick={() => fetchData(nextAfterId)}>
+                    Load more
+                </Button>
+            )}
 
             {selectedRow && (
                 <Box>
@@ -1,9 +1,11 @@
 export interface TableRowDataType {
+    id: number;
     identifier: string;
     description: string;
     lastRun: string;
     status: 'running' | 'success' | 'fail';
     datasetName: string;
-    metadata: Record<string, string>;
-    logs: string;
+    metadata?: Record<string, string>;
+    logs?: string;
+    progress?: Record<string, any> | null;
 }
\ No newline at end of file
@@ -220,7 +220,8 @@ const SpikeSorting: React.FC<SpikeSortingProps> = ({ dandisets_labels }) => {
             const ESNames = Object.keys(response.data.file_info.acquisition);
             setListOfES(ESNames)
             setSelectedDandiFileInfo(response.data.file_info);
-            setSourceDataPaths({ 'file': response.data.file_info.url });
+            // The dandiset and path are stored with the run, to filter runs by them
+            setSourceDataPaths({ 'file': response.data.file_info.url, 'dandiset_id': dandiset_id, 'path': filepath });
             updateSubjectMetadata(response.data.file_info);
         } catch (error) {
             console.error('Error fetching DANDIset metadata:', error);
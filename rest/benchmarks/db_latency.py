@@ -0,0 +1,124 @@
+"""
+Latency of the runs list route under concurrent requests, reading from a SQLite database:
+
+- per-request engine: as before the shared engines, a sync route building its engine (and pool) on each request,
+  run in the threadpool
+- pooled async: the /api/runs/list route, reading with a session from the shared async (aiosqlite) engine
+
+On PostgreSQL, each request of the per-request engine also opens a new connection, which SQLite does not show.
+
+Run from the rest folder:
+    python benchmarks/db_latency.py --runs 2000 --requests 1000 --concurrency 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+import numpy as np
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from core.settings import settings
+from clients.database import DatabaseClient, select_runs_info, run_row_to_dict
+from db.models import Base, User, Run
+from db.session import dispose_engines
+
+
+def create_database(connection_string: str, num_runs: int) -> None:
+    db_client = DatabaseClient(connection_string=connection_string)
+    Base.metadata.create_all(db_client.engine)
+    with db_client.session_scope() as session:
+        user = User(username="admin", password="admin")
+        session.add(user)
+        session.flush()
+        session.add_all([
+            Run(
+                run_at="local",
+                identifier=f"run-{i}",
+                description="benchmark",
+                last_run="2023/01/01 00:00:00",
+                status="success",
+                user_id=user.id,
+                metadata_={"sorters_names_list": ["kilosort3"], "source_data_paths": {"file": f"https://example.org/{i}.nwb"}},
+            )
+            for i in range(num_runs)
+        ])
+
+
+def get_per_request_engine_app(connection_string: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/api/runs/list")
+    def route_get_runs_list(limit: int = 100) -> JSONResponse:
+        engine = create_engine(connection_string)
+        try:
+            with sessionmaker(bind=engine)() as session:
+                user = session.execute(select(User).where(User.username == "admin")).scalar_one()
+                query = select_runs_info(user_id=user.id, limit=limit, include_logs=False, include_metadata=False)
+                runs = [run_row_to_dict(row) for row in session.execute(query)]
+        finally:
+            engine.dispose()
+        return JSONResponse({"message": "Success", "runs": runs})
+
+    return app
+
+
+async def measure(app: FastAPI, num_requests: int, concurrency: int) -> np.ndarray:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = list()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+
+        async def request():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.get("/api/runs/list", params={"limit": 100})
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        # Warm up, e.g. the pooled connections
+        await asyncio.gather(*[request() for _ in range(concurrency)])
+        latencies.clear()
+        await asyncio.gather(*[request() for _ in range(num_requests)])
+    return np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        connection_string = f"sqlite:///{os.path.join(tmp_dir, 'benchmark.db')}"
+        settings.DB_CONNECTION_STRING = connection_string
+        create_database(connection_string, num_runs=args.runs)
+
+        from main import app
+        # Each request logs at the INFO level
+        logging.disable(logging.INFO)
+        apps = {
+            "per-request engine": get_per_request_engine_app(connection_string),
+            "pooled async": app,
+        }
+        print(f"{args.requests} requests, {args.concurrency} concurrent, {args.runs} runs")
+        print(f"{'':<20}{'p50 (ms)':>10}{'p99 (ms)':>10}{'max (ms)':>10}")
+        for name, benchmarked_app in apps.items():
+            latencies = asyncio.run(measure(benchmarked_app, num_requests=args.requests, concurrency=args.concurrency))
+            print(f"{name:<20}{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 99):>10.1f}{latencies.max():>10.1f}")
+            asyncio.run(dispose_engines())
+
+
+if __name__ == "__main__":
+    main()
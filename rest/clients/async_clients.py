@@ -0,0 +1,61 @@
+import functools
+from typing import Any, Callable
+
+import anyio
+import anyio.to_thread
+
+from core.settings import settings
+
+
+# Maximum concurrent calls to each dependency, from the event loop. Each dependency has its own limit, so that
+# slow calls to one dependency never take the threads of the others, nor those of the default threadpool
+def get_dependency_concurrency() -> dict:
+    return {
+        "database": settings.DB_POOL_SIZE + settings.DB_MAX_OVERFLOW,
+        "dandi": settings.DANDI_CONCURRENCY,
+        "nwb": settings.NWB_READS_CONCURRENCY,
+        "aws": settings.AWS_CONCURRENCY,
+        "worker": settings.WORKER_CONCURRENCY,
+        "unit_summary": settings.UNIT_SUMMARY_CONCURRENCY,
+    }
+
+
+_limiters = dict()
+
+
+def get_limiter(dependency: str) -> anyio.CapacityLimiter:
+    # Created on first use, from the event loop
+    if dependency not in _limiters:
+        _limiters[dependency] = anyio.CapacityLimiter(get_dependency_concurrency()[dependency])
+    return _limiters[dependency]
+
+
+async def run_in_dependency_pool(dependency: str, func: Callable, *args, **kwargs) -> Any:
+    """
+    Run a blocking call to a dependency in a thread, without blocking the event loop,
+    waiting for a slot if the dependency already has as many calls in progress as its limit.
+    """
+    return await anyio.to_thread.run_sync(functools.partial(func, *args, **kwargs), limiter=get_limiter(dependency))
+
+
+class AsyncClient:
+    """
+    Async view of a blocking client: calling any of its methods returns an awaitable, running the
+    method in a thread bounded by the concurrency limit of the dependency. E.g.:
+
+        dandi_client = AsyncClient(DandiClient(token=settings.DANDI_API_KEY), dependency="dandi")
+        metadata = await dandi_client.get_dandiset_metadata(dandiset_id)
+    """
+
+    def __init__(self, client, dependency: str):
+        self._client = client
+        self._dependency = dependency
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        async def method(*args, **kwargs):
+            return await run_in_dependency_pool(self._dependency, attribute, *args, **kwargs)
+        return method
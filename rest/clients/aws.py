@@ -1,7 +1,10 @@
 import boto3
 import enum
+import hashlib
+import json
 
-from core import settings
+from core.settings import settings
+from core.metrics import instrumented
 
 
 class JobStatus(enum.Enum):
@@ -14,6 +17,7 @@ class JobStatus(enum.Enum):
     FAILED = 'FAILED'
 
 
+@instrumented("aws")
 class AWSClient(object):
  
     def __init__(self, profile_name: str=None):
@@ -24,11 +28,11 @@ class AWSClient(object):
         - https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/logs.html
         """
         self.session = boto3.Session(profile_name=profile_name)
-        self.client_batch = self.session.client("batch")
-        self.client_s3 = self.session.client("s3")
-        self.client_logs = self.session.client("logs")
-
-        # self.sorting_logs_s3_bucket = settings.SORTING_LOGS_S3_BUCKET
+        # A custom endpoint (e.g. a moto server) can be used to run without AWS
+        endpoint_url = settings.AWS_ENDPOINT_URL
+        self.client_batch = self.session.client("batch", endpoint_url=endpoint_url)
+        self.client_s3 = self.session.client("s3", endpoint_url=endpoint_url)
+        self.client_logs = self.session.client("logs", endpoint_url=endpoint_url)
 
 
     def list_job_queues(self):
@@ -50,6 +54,7 @@ class AWSClient(object):
         job_definition :str,
         job_kwargs: dict = None, 
         attempt_duration_seconds: int = 1800,
+        array_size: int = None,
     ):  
         kwargs = dict(
             jobName=job_name,
@@ -58,6 +63,10 @@ class AWSClient(object):
             timeout={'attemptDurationSeconds': attempt_duration_seconds},
         )
 
+        # Array jobs run array_size children, with ids "{jobId}:{index}" and AWS_BATCH_JOB_ARRAY_INDEX set to their index
+        if array_size is not None:
+            kwargs['arrayProperties'] = {'size': array_size}
+
         if job_kwargs:
             kwargs['containerOverrides'] = dict()
             kwargs['containerOverrides']['environment'] = [{'name': k, 'value': str(v).replace("'", "\"")} for k, v in job_kwargs.items()]
@@ -69,19 +78,63 @@ class AWSClient(object):
     def describe_job(self, job_id: str):
         return self.client_batch.describe_jobs(jobs=[job_id])["jobs"][0]
 
+
+    def describe_jobs(self, job_ids: list, batch_size: int = 100):
+        """Describe many jobs, in batches of up to 100 jobs per call (the AWS Batch limit)"""
+        jobs = list()
+        for i in range(0, len(job_ids), batch_size):
+            jobs.extend(self.client_batch.describe_jobs(jobs=job_ids[i:i + batch_size])["jobs"])
+        return jobs
+
+
+    def list_job_ids_by_name_prefix(self, job_queue: str, prefix: str):
+        """Map job names to job ids, for all jobs in a queue whose name starts with prefix"""
+        job_ids = dict()
+        paginator = self.client_batch.get_paginator("list_jobs")
+        for page in paginator.paginate(
+            jobQueue=job_queue,
+            filters=[{'name': 'JOB_NAME', 'values': [f"{prefix}*"]}]
+        ):
+            for job in page["jobSummaryList"]:
+                # Most recent jobs are listed first
+                job_ids.setdefault(job["jobName"], job["jobId"])
+        return job_ids
+
+
+    def get_log_stream_events_since(self, log_stream_name: str, next_token: str = None):
+        """
+        Get the log events written after a cursor, following all pages of the stream.
+        Pass the returned nextForwardToken as next_token to only get the following events.
+
+        Returns:
+            tuple: (list of messages, nextForwardToken)
+        """
+        kwargs = dict(logGroupName="/aws/batch/job", logStreamName=log_stream_name, startFromHead=True)
+        messages = list()
+        while True:
+            if next_token is not None:
+                kwargs["nextToken"] = next_token
+            response = self.client_logs.get_log_events(**kwargs)
+            messages.extend([log["message"] for log in response["events"]])
+            # The same token is returned once the end of the stream is reached
+            if response["nextForwardToken"] == next_token:
+                return messages, next_token
+            next_token = response["nextForwardToken"]
+
+
+    def get_log_stream_events(self, log_stream_name: str):
+        try:
+            messages, _ = self.get_log_stream_events_since(log_stream_name=log_stream_name)
+            return "\n".join(messages)
+        except:
+            return "Logs not available yet for this job."
+
     
     def get_job_status_and_logs(self, job_id: str):
         job = self.describe_job(job_id=job_id)
         job_status = job["status"]
         log_stream_name = job["container"].get("logStreamName", None)
-        try:
-            logs = self.client_logs.get_log_events(
-                logGroupName="/aws/batch/job",
-                logStreamName=log_stream_name,
-            )["events"]
-            return job_status, "\n".join([log["message"] for log in logs])
-        except:
-            return job_status, "Logs not available yet for this job."
+        return job_status, self.get_log_stream_events(log_stream_name=log_stream_name)
     
 
     def get_job_status_and_logs_by_name(self, job_name: str, job_queue: str):
@@ -93,15 +146,65 @@ class AWSClient(object):
         return self.get_job_status_and_logs(job_id=job_id)
     
 
-    def get_run_logs_s3(self, run_id: str) -> str:
-        """Get the logs for a specific run ID from the S3 bucket"""
-        log_key = f"{run_id}.log"
-
-        # Download the log file as a stream
-        response = self.client_s3.get_object(Bucket=self.bucket_name, Key=log_key)
+    def get_run_logs_s3(self, run_id: str, start: int = None, end: int = None, tail: int = None) -> str:
+        """
+        Get the logs for a specific run ID from the S3 bucket.
+        Only the byte range [start, end), or the last tail bytes, are read if given.
+        """
+        # Empty ranges make invalid Range headers (e.g. bytes=-0), and read nothing
+        if (tail is not None and tail <= 0) or (tail is None and end is not None and end <= (start or 0)):
+            return ""
+        kwargs = dict(Bucket=settings.SORTING_LOGS_S3_BUCKET, Key=f"{run_id}.log")
+        if tail is not None:
+            kwargs["Range"] = f"bytes=-{tail}"
+        elif start is not None or end is not None:
+            kwargs["Range"] = f"bytes={start or 0}-{end - 1 if end is not None else ''}"
+
+        # Download the log file (or range) as a stream
+        response = self.client_s3.get_object(**kwargs)
         log_stream = response["Body"]
 
         # Read the contents of the stream as text
-        log_text = log_stream.read().decode("utf-8")
+        log_text = log_stream.read().decode("utf-8", errors="replace")
+
+        return log_text
+
+
+    def put_s3_json(self, s3_url: str, data) -> str:
+        """Store data as a JSON document on S3, returning its SHA-256 checksum"""
+        bucket_name, _, key = s3_url.split("s3://")[-1].partition("/")
+        body = json.dumps(data, sort_keys=True).encode("utf-8")
+        self.client_s3.put_object(Bucket=bucket_name, Key=key, Body=body, ContentType="application/json")
+        return hashlib.sha256(body).hexdigest()
+
+
+    def put_job_spec(self, job_name: str, job_spec: dict) -> dict:
+        """
+        Store the spec of a job on S3, and get the environment passing it by reference to the job. 
+        Container overrides are limited in size, so only the spec url and checksum are passed.
+        """
+        job_spec_url = f"s3://{settings.SORTING_JOB_SPECS_S3_BUCKET}/job-specs/{job_name}.json"
+        job_spec_sha256 = self.put_s3_json(job_spec_url, job_spec)
+        return {"JOB_SPEC_URL": job_spec_url, "JOB_SPEC_SHA256": job_spec_sha256}
+
+
+    def get_presigned_url(self, s3_url: str, expires_in: int = 3600) -> str:
+        """Get a signed URL to read an S3 object over HTTP"""
+        bucket_name, _, key = s3_url.split("s3://")[-1].partition("/")
+        return self.client_s3.generate_presigned_url("get_object", Params={"Bucket": bucket_name, "Key": key}, ExpiresIn=expires_in)
+
+
+    def get_s3_object_etag(self, s3_url: str) -> str:
+        """Get the ETag of an S3 object, which changes with its content"""
+        bucket_name, _, key = s3_url.split("s3://")[-1].partition("/")
+        return self.client_s3.head_object(Bucket=bucket_name, Key=key)["ETag"].strip('"')
+
 
-        return log_text
\ No newline at end of file
+    def list_s3_keys(self, s3_prefix: str) -> tuple:
+        """List the bucket name and the keys of all objects under an S3 prefix, e.g. s3://bucket/path/to/"""
+        bucket_name, _, prefix = s3_prefix.split("s3://")[-1].partition("/")
+        keys = list()
+        paginator = self.client_s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            keys.extend(o["Key"] for o in page.get("Contents", []))
+        return bucket_name, keys
@@ -1,26 +1,58 @@
 import concurrent.futures
+import bisect
+import fnmatch
+import time
 from dandi.dandiapi import DandiAPIClient
 from dandischema.models import Dandiset
 from pynwb import NWBHDF5IO, NWBFile
-import fsspec
-import pynwb
 import h5py
 import json
-import requests
-from fsspec.implementations.cached import CachingFileSystem
-from typing import List
-
-
+import threading
+from typing import Callable, List, Tuple
+from datetime import datetime
+
+from core.cache import TTLCache
+from core.block_cache import get_nwb_block_cache
+from core.metrics import instrumented
+from clients.http import CircuitBreaker, ResilientSession, get_signed_url_ttl
+
+
+# Shared by all clients: one DANDI API client (with its pooled HTTP session) per token, behind one circuit breaker
+_dandi_api_clients = dict()
+_dandi_api_clients_lock = threading.Lock()
+_dandi_circuit_breaker = CircuitBreaker(name="dandi")
+
+# Assets resolved from dandiset paths (until shortly before their signed URL expires), NWB assets listings
+# by dandiset version, and NWB files info by asset id and version
+ASSETS_REVALIDATE_INTERVAL = 30
+_assets_cache = TTLCache(maxsize=4096, ttl=300)
+_assets_listings_cache = TTLCache(maxsize=256)
+_nwbfile_info_cache = TTLCache(maxsize=4096)
+
+
+def get_dandi_api_client(token: str = None) -> DandiAPIClient:
+    with _dandi_api_clients_lock:
+        if token not in _dandi_api_clients:
+            client = DandiAPIClient(token=token)
+            # The DANDI client already retries failed requests, so its session only adds pooling and the circuit breaker
+            session = ResilientSession(name="dandi", retries=0, circuit_breaker=_dandi_circuit_breaker)
+            session.headers.update(client.session.headers)
+            client.session.close()
+            client.session = session
+            _dandi_api_clients[token] = client
+        return _dandi_api_clients[token]
+
+
+# Metadata checks and extraction from already read files make no call to DANDI
+@instrumented("dandi", exclude=["has_nwb", "has_ecephys", "extract_nwbfile_info", "extract_nwbfile_info_h5py"])
 class DandiClient:
 
     def __init__(self, token: str = None):
         """
         Initialize DandiClient object, to interact with DANDI API.
         """
-        self.fs = CachingFileSystem(
-            fs=fsspec.filesystem("http"),
-            cache_storage="data/nwb-cache",  # Local folder for the cache
-        )
+        # Remote files are read through the block-level disk cache shared by all clients
+        self.fs = get_nwb_block_cache()
         self.token = token
 
 
@@ -66,20 +98,75 @@ class DandiClient:
         Returns:
             List: List of dandisets metadata.
         """
-        with DandiAPIClient(token=self.token) as client:
-            all_metadata = dict()
-            dandisets_list = list(client.get_dandisets())
-            total_dandisets = len(dandisets_list)
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = [executor.submit(self.process_dandiset, dandiset) for dandiset in dandisets_list]
-                for future in concurrent.futures.as_completed(futures):
-                    metadata = future.result()
-                    if metadata:
-                        all_metadata[metadata["id"].split(":")[-1].split("/")[0].strip()] = metadata
-                    print(f"Processed {len(all_metadata)} of {total_dandisets} dandisets.")
+        client = get_dandi_api_client(token=self.token)
+        all_metadata = dict()
+        dandisets_list = list(client.get_dandisets())
+        total_dandisets = len(dandisets_list)
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [executor.submit(self.process_dandiset, dandiset) for dandiset in dandisets_list]
+            for future in concurrent.futures.as_completed(futures):
+                metadata = future.result()
+                if metadata:
+                    all_metadata[metadata["id"].split(":")[-1].split("/")[0].strip()] = metadata
+                print(f"Processed {len(all_metadata)} of {total_dandisets} dandisets.")
         return all_metadata
     
 
+    def get_dandisets_metadata_modified_since(
+        self, 
+        since: datetime = None, 
+        known_modified: dict = None,
+        callback: Callable[[str, str, dict], None] = None,
+    ) -> Tuple[dict, List[str], datetime]:
+        """
+        Get metadata for the dandisets modified since a date, directly from DANDI.
+        Dandisets are listed by descending modification date, so listing stops at the first one not modified since.
+
+        Args:
+            since (datetime): Only dandisets modified after this date are fetched. All dandisets if None.
+            known_modified (dict): Modification dates of dandisets already fetched, by id. These are skipped if unchanged.
+            callback (Callable): Called with (dandiset_id, modified, metadata) as each dandiset is fetched. 
+                metadata is None for dandisets without NWB ecephys data.
+
+        Returns:
+            Tuple[dict, List[str], datetime]: Metadata of the modified dandisets with NWB ecephys data, ids of the modified
+            dandisets without it, and the latest modification date.
+        """
+        known_modified = known_modified or dict()
+        client = get_dandi_api_client(token=self.token)
+        modified_dates = dict()
+        latest_modified = since
+        for data in client.paginate("/dandisets/", params={"ordering": "-modified"}):
+            modified = datetime.fromisoformat(data["modified"].replace("Z", "+00:00"))
+            if since is not None and modified <= since:
+                break
+            latest_modified = max(latest_modified, modified) if latest_modified else modified
+            if known_modified.get(data["identifier"], None) != data["modified"]:
+                modified_dates[data["identifier"]] = data["modified"]
+        all_metadata = dict()
+        removed_ids = list()
+        failed_ids = list()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = {executor.submit(client.get_dandiset, dandiset_id, "draft"): dandiset_id for dandiset_id in modified_dates}
+            for future in concurrent.futures.as_completed(futures):
+                dandiset_id = futures[future]
+                try:
+                    metadata = self.process_dandiset(future.result())
+                except:
+                    failed_ids.append(dandiset_id)
+                    continue
+                if metadata:
+                    all_metadata[dandiset_id] = metadata
+                else:
+                    removed_ids.append(dandiset_id)
+                if callback is not None:
+                    callback(dandiset_id, modified_dates[dandiset_id], metadata)
+        if len(failed_ids) > 0:
+            # Dandisets that could not be fetched are fetched again on the next sync
+            latest_modified = since
+        return all_metadata, removed_ids, latest_modified
+    
+
     def process_dandiset(self, dandiset):
         try:
             metadata = dandiset.get_raw_metadata()
@@ -90,57 +177,171 @@ class DandiClient:
         return None
     
 
-    def get_dandiset_metadata(self, dandiset_id: str) -> dict:
+    def get_dandiset_metadata(self, dandiset_id: str, version_id: str = "draft") -> dict:
         """
         Get metadata for a dandiset.
 
         Args:
             dandiset_id (str): Numerical ID of the dandiset. E.g. 000001
+            version_id (str): Version of the dandiset. E.g. draft
 
         Returns:
             dict: Metadata for the dandiset.
         """
-        with DandiAPIClient(token=self.token) as client:
-            dandiset = client.get_dandiset(dandiset_id=dandiset_id, version_id="draft")
-            return dandiset.get_raw_metadata()
+        client = get_dandi_api_client(token=self.token)
+        dandiset = client.get_dandiset(dandiset_id=dandiset_id, version_id=version_id)
+        return dandiset.get_raw_metadata()
 
 
-    def list_dandiset_files(self, dandiset_id: str) -> List[str]:
+    def list_dandiset_files(self, dandiset_id: str, version_id: str = "draft") -> List[str]:
         """
         List all files in a dandiset.
 
         Args:
             dandiset_id (str): Numerical ID of the dandiset. E.g. 000001
+            version_id (str): Version of the dandiset. E.g. draft
 
         Returns:
             List[str]: List of files in the dandiset.
         """
-        with DandiAPIClient(token=self.token) as client:
-            dandiset = client.get_dandiset(dandiset_id=dandiset_id, version_id="draft")
-            return [i.dict().get("path") for i in dandiset.get_assets() if i.dict().get("path").endswith(".nwb")]
-        
+        _, assets = self.list_dandiset_assets(dandiset_id, version_id)
+        return [a["path"] for a in assets]
+
 
-    def get_nwbfile_info_fsspec(self, dandiset_id: str, file_path: str) -> dict:
+    def list_dandiset_assets(self, dandiset_id: str, version_id: str = "draft") -> Tuple[str, List[dict]]:
         """
-        Uses fsspec to read the file from S3.
+        List the NWB assets of a dandiset version, sorted by path. Listings are cached by dandiset version, 
+        and revalidated against the version modification date: published versions never change, and draft 
+        versions are checked at most every ASSETS_REVALIDATE_INTERVAL seconds.
+
+        Args:
+            dandiset_id (str): Numerical ID of the dandiset. E.g. 000001
+            version_id (str): Version of the dandiset. E.g. draft
+
+        Returns:
+            Tuple[str, List[dict]]: Modification date of the version, and its NWB assets with "asset_id", "path" and "size".
+        """
+        key = (dandiset_id, version_id)
+        entry = _assets_listings_cache.get(key, None)
+        now = time.monotonic()
+        if entry is not None and (version_id != "draft" or now - entry["checked_at"] < ASSETS_REVALIDATE_INTERVAL):
+            return entry["modified"], entry["assets"]
+        client = get_dandi_api_client(token=self.token)
+        modified = client.get(f"/dandisets/{dandiset_id}/versions/{version_id}/info/")["modified"]
+        if entry is None or entry["modified"] != modified:
+            # Raw pages of the API, without building an asset object per asset
+            assets = [
+                {"asset_id": a["asset_id"], "path": a["path"], "size": a["size"]}
+                for a in client.paginate(
+                    f"/dandisets/{dandiset_id}/versions/{version_id}/assets/",
+                    params={"order": "path", "page_size": 1000},
+                )
+                if a["path"].endswith(".nwb")
+            ]
+            entry = {"modified": modified, "assets": sorted(assets, key=lambda a: a["path"])}
+        _assets_listings_cache.set(key, {**entry, "checked_at": now})
+        return entry["modified"], entry["assets"]
+
+
+    def get_nwbfile_info_h5py(self, dandiset_id: str, file_path: str, version_id: str = "draft") -> dict:
+        """
+        Reads only the HDF5 attributes and dataset shapes needed, with h5py over small ranged reads,
+        without building the pynwb objects. Results are cached by asset id and version.
 
         Args:
             dandiset_id (str): Numerical ID of the dandiset. E.g. 000001
             file_path (str): File path within Dandiset. E.g. sub-000001/sub-000001.nwb
+            version_id (str): Version of the dandiset. E.g. draft
 
         Returns:
-            dict: Information extracted from the NWBFile object.
+            dict: Information extracted from the NWB file.
         """
-        file_s3_url = self.get_file_url(dandiset_id, file_path)
-        if "dandiarchive-embargo" in file_s3_url:
-            file_s3_url = self.get_file_url_embargo(dandiset_id, file_path)
+        asset_id, file_s3_url = self.get_asset_id_and_url(dandiset_id, file_path, version_id)
+        file_info = _nwbfile_info_cache.get((asset_id, version_id), None)
+        if file_info is not None:
+            return file_info
         with self.fs.open(file_s3_url, "rb") as f:
-            with h5py.File(f) as file:
-                with pynwb.NWBHDF5IO(file=file, load_namespaces=True) as io:
-                    nwbfile = io.read()
-                    file_info = self.extract_nwbfile_info(nwbfile=nwbfile)
-                    file_info["url"] = file_s3_url
-                    return file_info
+            with h5py.File(f, "r") as file:
+                file_info = self.extract_nwbfile_info_h5py(file=file)
+        file_info["url"] = file_s3_url
+        _nwbfile_info_cache.set((asset_id, version_id), file_info)
+        return file_info
+
+
+    def get_asset_id_and_url(self, dandiset_id: str, file_path: str, version_id: str = "draft") -> Tuple[str, str]:
+        """
+        Get the asset id and S3 URL of a file in a dandiset, resolved with the shared DANDI API client.
+
+        Returns:
+            Tuple[str, str]: Asset id and S3 URL of the file.
+        """
+        key = (dandiset_id, version_id, file_path)
+        asset = _assets_cache.get(key, None)
+        if asset is None:
+            client = get_dandi_api_client(token=self.token)
+            remote_asset = client.get_dandiset(dandiset_id, version_id).get_asset_by_path(file_path)
+            file_s3_url = remote_asset.get_content_url(follow_redirects=1, strip_query=True)
+            if "dandiarchive-embargo" in file_s3_url:
+                file_s3_url = self.get_signed_download_url(remote_asset.base_download_url)
+            asset = (remote_asset.identifier, file_s3_url)
+            _assets_cache.set(key, asset, ttl=get_signed_url_ttl(file_s3_url, default=_assets_cache.ttl))
+        return asset
+
+
+    def get_signed_download_url(self, download_url: str) -> str:
+        """
+        Get the signed S3 URL a DANDI download URL redirects to, without downloading the file.
+
+        Args:
+            download_url (str): DANDI API download URL of an asset.
+
+        Returns:
+            str: Signed S3 URL of the file.
+        """
+        client = get_dandi_api_client(token=self.token)
+        headers = {
+            "Authorization": f'token {self.token}'
+        }
+        with client.session.get(download_url, headers=headers, allow_redirects=False, stream=True) as response:
+            if response.is_redirect:
+                return response.headers["Location"]
+            response.raise_for_status()
+            return response.url
+
+
+    def extract_nwbfile_info_h5py(self, file: h5py.File) -> dict:
+        """
+        Extracts information from an NWB file opened with h5py, reading only attributes and dataset shapes.
+
+        Args:
+            file (h5py.File): NWB file.
+
+        Returns:
+            dict: Information extracted from the NWB file, in the same format as extract_nwbfile_info.
+        """
+        file_info = dict()
+        file_info["acquisition"] = dict()
+        for k, v in file.get("acquisition", dict()).items():
+            if not isinstance(v, h5py.Group) or "data" not in v:
+                continue
+            data = v["data"]
+            rate = v["starting_time"].attrs.get("rate", None) if "starting_time" in v else None
+            file_info["acquisition"][k] = {
+                "name": k,
+                "description": decode_h5_value(v.attrs.get("description", "")),
+                "rate": float(rate) if rate is not None else None,
+                "unit": decode_h5_value(data.attrs.get("unit", "")),
+                "duration": float(data.shape[0] / rate) if rate else None,
+                "n_traces": data.shape[1] if len(data.shape) > 1 else 1,
+            }
+        file_info["subject"] = dict()
+        subject = file.get("general/subject", None)
+        if subject is not None:
+            for k, v in subject.items():
+                # Scalar datasets only, e.g. subject_id, species, age
+                if isinstance(v, h5py.Dataset) and v.shape == ():
+                    file_info["subject"][k] = decode_h5_value(v[()])
+        return file_info
 
 
     def get_nwbfile_info_ros3(self, dandiset_id: str, file_path: str) -> dict:
@@ -187,42 +388,21 @@ class DandiClient:
         return file_info
 
 
-    def get_file_url(self, dandiset_id: str, file_path: str) -> str:
+    def get_file_url(self, dandiset_id: str, file_path: str, version_id: str = "draft") -> str:
         """
         Get the S3 URL of a file in a dandiset.
+        Embargoed files are resolved to signed URLs, cached until shortly before they expire.
 
         Args:
             dandiset_id (str): Numerical ID of the dandiset. E.g. 000001
             file_path (str): File path within Dandiset. E.g. sub-000001/sub-000001.nwb
+            version_id (str): Version of the dandiset. E.g. draft
 
         Returns:
             str: S3 URL of the file.
         """
-        with DandiAPIClient(token=self.token) as client:
-            asset = client.get_dandiset(dandiset_id, "draft").get_asset_by_path(file_path)
-            return asset.get_content_url(follow_redirects=1, strip_query=True)
-    
-
-    def get_file_url_embargo(self, dandiset_id: str, file_path: str) -> str:
-        """
-        Get the S3 URL of a file in a dandiset in embargo mode.
-
-        Args:
-            dandiset_id (str): Numerical ID of the dandiset. E.g. 000001
-            file_path (str): File path within Dandiset. E.g. sub-000001/sub-000001.nwb
-
-        Returns:
-            str: S3 URL of the file.
-        """
-        with DandiAPIClient(token=self.token) as client:
-            asset = client.get_dandiset(dandiset_id, "draft").get_asset_by_path(file_path)
-            base_download_url = asset.base_download_url
-            headers = {
-                "Authorization": f'token {self.token}'
-            }
-            response = requests.get(base_download_url, headers=headers, stream=True)
-            authorized_url = response.url
-            return authorized_url
+        _, file_s3_url = self.get_asset_id_and_url(dandiset_id, file_path, version_id)
+        return file_s3_url
     
 
     def has_nwb(self, metadata: Dandiset) -> bool:
@@ -258,4 +438,33 @@ class DandiClient:
             variable_measured = assets_summary.get("variableMeasured", [])
             if variable_measured:
                 return any(v == "ElectricalSeries" for v in variable_measured)
-        return False
\ No newline at end of file
+        return False
+
+
+def decode_h5_value(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if hasattr(value, "item"):
+        # numpy scalars
+        return value.item()
+    return value
+
+
+def select_assets(assets: List[dict], prefix: str = None, glob: str = None, offset: int = 0, limit: int = None) -> Tuple[List[dict], int]:
+    """
+    Filter assets sorted by path by path prefix and glob pattern, and paginate them.
+
+    Returns:
+        Tuple[List[dict], int]: Page of assets, and total number of assets matching the filters.
+    """
+    if prefix:
+        # Assets with a prefix are contiguous in the sorted paths
+        start = bisect.bisect_left(assets, prefix, key=lambda a: a["path"])
+        end = start
+        while end < len(assets) and assets[end]["path"].startswith(prefix):
+            end += 1
+        assets = assets[start:end]
+    if glob:
+        assets = [a for a in assets if fnmatch.fnmatchcase(a["path"], glob)]
+    end = offset + limit if limit is not None else None
+    return assets[offset:end], len(assets)
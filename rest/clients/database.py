@@ -1,15 +1,260 @@
-from sqlalchemy import create_engine
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
 from contextlib import contextmanager
 import ast
 import json
 
-from db.models import User, DataSource, Run
+from db.models import User, DataSource, Run, RunGroup, RunLogChunk, Worker, SortingResult, DandisetMetadataVersion, DandisetsSync
+from db.session import get_engine
+from db.types import json_array_contains
+from core.metrics import instrumented
 
 
+def select_runs_info(
+    run_id: int = None,
+    user_id: int = None,
+    status: str = None,
+    run_at: str = None,
+    date_from: str = None,
+    date_to: str = None,
+    data_source_name: str = None,
+    group_id: int = None,
+    sorter: str = None,
+    dandiset_id: str = None,
+    asset_path: str = None,
+    after_id: int = None,
+    limit: int = None,
+    include_logs: bool = True,
+    include_metadata: bool = True,
+):
+    """
+    Build a single query for runs info, joined with their data source.
+
+    Runs are ordered by descending id, and paginated by keyset: pass the id of the last run
+    of the previous page as after_id. Logs and metadata are only loaded if requested.
+    Dates are compared to Run.last_run, stored as "%Y/%m/%d %H:%M:%S".
+    Sorter, dandiset and asset filters use the indexed columns generated from the run metadata.
+    Runs from DANDI stored with the file URL only (before the dandiset and path were stored) match neither.
+    """
+    columns = [
+        Run.id,
+        Run.run_at,
+        Run.identifier,
+        Run.description,
+        Run.last_run,
+        Run.status,
+        Run.progress,
+        Run.output_path,
+        DataSource.name.label("data_source_name"),
+    ]
+    if include_metadata:
+        columns.append(Run.metadata_.label("metadata"))
+    if include_logs:
+        columns.append(Run.logs.label("logs"))
+    query = select(*columns).outerjoin(DataSource, Run.data_source_id == DataSource.id)
+    if run_id is not None:
+        query = query.where(Run.id == run_id)
+    if user_id is not None:
+        query = query.where(Run.user_id == user_id)
+    if status is not None:
+        query = query.where(Run.status == status)
+    if run_at is not None:
+        query = query.where(Run.run_at == run_at)
+    if date_from is not None:
+        query = query.where(Run.last_run >= date_from.replace("-", "/"))
+    if date_to is not None:
+        date_to = date_to.replace("-", "/")
+        if len(date_to) == 10:
+            date_to += " 23:59:59"
+        query = query.where(Run.last_run <= date_to)
+    if data_source_name is not None:
+        query = query.where(DataSource.name == data_source_name)
+    if group_id is not None:
+        query = query.where(Run.group_id == group_id)
+    if sorter is not None:
+        query = query.where(json_array_contains(Run.sorters, sorter))
+    if dandiset_id is not None:
+        query = query.where(Run.dandiset_id == dandiset_id)
+    if asset_path is not None:
+        query = query.where(Run.asset_path == asset_path)
+    if after_id is not None:
+        query = query.where(Run.id < after_id)
+    query = query.order_by(Run.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def run_row_to_dict(row) -> dict:
+    run_info = {
+        "id": row.id,
+        "run_at": row.run_at,
+        "identifier": row.identifier,
+        "description": row.description,
+        "lastRun": row.last_run,
+        "status": row.status,
+        "dataSourceName": row.data_source_name,
+        "progress": json.loads(row.progress) if row.progress else None,
+        "outputPath": row.output_path
+    }
+    if "metadata" in row._mapping:
+        run_info["metadata"] = row._mapping["metadata"]
+    if "logs" in row._mapping:
+        run_info["logs"] = row._mapping["logs"]
+    return run_info
+
+
+def select_run_group_status_counts(group_id: int):
+    return select(Run.status, func.count(Run.id)).where(Run.group_id == group_id).group_by(Run.status)
+
+
+def run_group_to_dict(group: RunGroup, status_counts) -> dict:
+    counts = {"running": 0, "success": 0, "fail": 0}
+    counts.update({status: count for status, count in status_counts})
+    total = sum(counts.values())
+    done = counts["success"] + counts["fail"]
+    return {
+        "id": group.id,
+        "identifier": group.identifier,
+        "description": group.description,
+        "createdAt": group.created_at,
+        "jobId": group.job_id,
+        "sweepGridUrl": group.sweep_grid_url,
+        "total": total,
+        "counts": counts,
+        "done": done,
+        "progress": done / total if total > 0 else None,
+    }
+
+
+# Maximum number of lines in a chunk of the run logs store
+LOG_CHUNK_MAX_LINES = 1000
+
+
+def select_sorting_results(fingerprints: list):
+    return (
+        select(
+            SortingResult.fingerprint,
+            SortingResult.sorter_name,
+            Run.id,
+            Run.identifier,
+            Run.output_destination,
+            Run.output_path,
+        )
+        .join(Run, SortingResult.run_id == Run.id)
+        .where(SortingResult.fingerprint.in_(fingerprints), Run.status == "success")
+    )
+
+
+def sorting_result_row_to_dict(row) -> dict:
+    return {
+        "sorterName": row.sorter_name,
+        "runId": row.id,
+        "runIdentifier": row.identifier,
+        "outputDestination": row.output_destination,
+        "outputPath": row.output_path,
+    }
+
+
+def select_last_run_log_chunk(run_id: int):
+    return select(RunLogChunk).where(RunLogChunk.run_id == run_id).order_by(RunLogChunk.first_line.desc()).limit(1)
+
+
+def select_run_log_chunks(run_id: int, start: int, end: int, unit: str = "lines"):
+    """
+    Select the chunks of the run logs overlapping the range [start, end), in lines or bytes.
+    """
+    if unit == "lines":
+        first, count = RunLogChunk.first_line, RunLogChunk.line_count
+    else:
+        first, count = RunLogChunk.first_byte, RunLogChunk.byte_count
+    return (
+        select(RunLogChunk)
+        .where(RunLogChunk.run_id == run_id, first + count > start, first < end)
+        .order_by(RunLogChunk.first_line)
+    )
+
+
+def legacy_run_log_chunk(logs: str) -> RunLogChunk:
+    # Runs finished before the logs store have their logs in Run.logs only
+    content = logs + "\n" if logs and not logs.endswith("\n") else (logs or "")
+    return RunLogChunk(
+        first_line=0,
+        line_count=content.count("\n"),
+        first_byte=0,
+        byte_count=len(content.encode("utf-8")),
+        content=content,
+    )
+
+
+def get_run_logs_range(last_chunk: RunLogChunk, start: int = None, end: int = None, tail: int = None, unit: str = "lines"):
+    """
+    Resolve the requested range of the run logs, clamped to the logs size. tail takes precedence over start and end.
+    """
+    total = last_chunk.first_line + last_chunk.line_count if unit == "lines" else last_chunk.first_byte + last_chunk.byte_count
+    if tail is not None:
+        return max(total - tail, 0), total
+    start = min(max(start or 0, 0), total)
+    end = total if end is None else min(max(end, start), total)
+    return start, end
+
+
+def slice_run_logs(chunks: list, start: int, end: int, unit: str = "lines") -> str:
+    if len(chunks) == 0:
+        return ""
+    if unit == "lines":
+        lines = [line for chunk in chunks for line in chunk.content.split("\n")[:-1]]
+        offset = chunks[0].first_line
+        return "".join(line + "\n" for line in lines[start - offset:end - offset])
+    data = b"".join(chunk.content.encode("utf-8") for chunk in chunks)
+    offset = chunks[0].first_byte
+    return data[start - offset:end - offset].decode("utf-8", errors="replace")
+
+
+def run_logs_to_dict(last_chunk: RunLogChunk, chunks: list, start: int, end: int, unit: str) -> dict:
+    return {
+        "logs": slice_run_logs(chunks, start, end, unit),
+        "unit": unit,
+        "start": start,
+        "end": end,
+        "totalLines": last_chunk.first_line + last_chunk.line_count,
+        "totalBytes": last_chunk.first_byte + last_chunk.byte_count,
+    }
+
+
+def append_run_log_lines(session, run_id: int, lines: list) -> None:
+    """
+    Append new lines to the logs store of a run. Only the last chunk is rewritten, until it is full.
+    """
+    # Messages can span many lines
+    lines = [line for message in lines for line in message.rstrip("\n").split("\n")]
+    last_chunk = session.execute(select_last_run_log_chunk(run_id)).scalar_one_or_none()
+    while len(lines) > 0:
+        if last_chunk is None or last_chunk.line_count >= LOG_CHUNK_MAX_LINES:
+            last_chunk = RunLogChunk(
+                run_id=run_id,
+                first_line=last_chunk.first_line + last_chunk.line_count if last_chunk else 0,
+                line_count=0,
+                first_byte=last_chunk.first_byte + last_chunk.byte_count if last_chunk else 0,
+                byte_count=0,
+                content="",
+            )
+            session.add(last_chunk)
+        n = LOG_CHUNK_MAX_LINES - last_chunk.line_count
+        content = "".join(line + "\n" for line in lines[:n])
+        lines = lines[n:]
+        last_chunk.content += content
+        last_chunk.line_count += content.count("\n")
+        last_chunk.byte_count += len(content.encode("utf-8"))
+
+
+@instrumented("database", exclude=["session_scope"])
 class DatabaseClient:
     def __init__(self, connection_string):
-        self.engine = create_engine(connection_string)
+        # Engines (and their connection pools) are shared by all clients of the process
+        self.engine = get_engine(connection_string)
         self.Session = sessionmaker(bind=self.engine)
 
     @contextmanager
@@ -90,6 +335,26 @@ class DatabaseClient:
             session.add(run)
             return run
 
+    def create_run_group(self, identifier, description, created_at, user_id, runs):
+        """
+        Create a group of runs, with their data sources, in a single transaction.
+        Each run is a dict with the "data_source" and "run" keyword arguments of its rows.
+        """
+        with self.session_scope() as session:
+            group = RunGroup(identifier=identifier, description=description, created_at=created_at, user_id=user_id)
+            session.add(group)
+            data_sources = [DataSource(user_id=user_id, **r["data_source"]) for r in runs]
+            session.add_all(data_sources)
+            # Rows are inserted in batches, returning their ids
+            session.flush()
+            run_rows = [
+                Run(user_id=user_id, group_id=group.id, data_source_id=data_source.id, **r["run"])
+                for r, data_source in zip(runs, data_sources)
+            ]
+            session.add_all(run_rows)
+            session.flush()
+            return group, list(zip(run_rows, data_sources))
+
     def get_user_info(self, username):
         with self.session_scope() as session:
             return session.query(User).filter(User.username == username).one_or_none()
@@ -100,24 +365,203 @@ class DatabaseClient:
 
     def get_run_info(self, run_id):
         with self.session_scope() as session:
-            obj = session.query(Run).filter(Run.id == run_id).one_or_none()
-            data_source = self.get_data_source_info(data_source_id=obj.data_source_id)
-            return {
-                "run_at": obj.run_at,
-                "identifier": obj.identifier,
-                "description": obj.description,
-                "lastRun": obj.last_run,
-                "status": obj.status,
-                "dataSourceName": data_source.name,
-                "metadata": json.loads(obj.metadata_),
-                "logs": obj.logs,
-                "outputPath": obj.output_path
-            }
+            row = session.execute(select_runs_info(run_id=run_id)).one_or_none()
+            return run_row_to_dict(row) if row else None
     
-    def get_all_runs_info(self):
+    def get_all_runs_info(self, **kwargs):
+        with self.session_scope() as session:
+            return [run_row_to_dict(row) for row in session.execute(select_runs_info(**kwargs))]
+
+
+    def get_active_runs(self):
+        with self.session_scope() as session:
+            return session.execute(
+                select(
+                    Run.id, 
+                    Run.identifier, 
+                    Run.run_at, 
+                    Run.job_id, 
+                    Run.logs_cursor, 
+                    Run.metadata_.label("metadata"),
+                    Run.worker_id, 
+                    Run.dispatch_count, 
+                    Worker.endpoint.label("worker_endpoint"), 
+                    Worker.last_heartbeat.label("worker_last_heartbeat"),
+                )
+                .outerjoin(Worker, Run.worker_id == Worker.id)
+                .where(Run.status == "running")
+            ).all()
+
+    def bulk_update_runs(self, updates, new_logs=None):
+        """
+        Update many runs in a single transaction. Each update is a dict with the run "id" and the new values.
+        New log lines, by run id, are appended to the logs store in the same transaction, so that they are
+        stored together with the logs cursor they were read up to.
+        """
+        new_logs = new_logs or dict()
+        if len(updates) == 0 and len(new_logs) == 0:
+            return
+        with self.session_scope() as session:
+            for run_id, lines in new_logs.items():
+                append_run_log_lines(session, run_id=run_id, lines=lines)
+            if len(updates) > 0:
+                session.execute(update(Run), updates)
+
+    def index_sorting_results(self, run_ids, created_at):
+        """
+        Index the results of successful runs by their fingerprints, so that identical submissions reuse them.
+        The first result of each fingerprint is kept.
+        """
+        with self.session_scope() as session:
+            runs = session.execute(
+                select(Run.id, Run.result_fingerprints).where(Run.id.in_(run_ids), Run.result_fingerprints.is_not(None))
+            ).all()
+            fingerprints = {r.id: json.loads(r.result_fingerprints) for r in runs}
+            all_fingerprints = [f for run_fingerprints in fingerprints.values() for f in run_fingerprints.values()]
+            if len(all_fingerprints) == 0:
+                return
+            existing = set(session.execute(
+                select(SortingResult.fingerprint).where(SortingResult.fingerprint.in_(all_fingerprints))
+            ).scalars())
+            for run_id, run_fingerprints in fingerprints.items():
+                for sorter_name, fingerprint in run_fingerprints.items():
+                    if fingerprint not in existing:
+                        existing.add(fingerprint)
+                        session.add(SortingResult(fingerprint=fingerprint, sorter_name=sorter_name, run_id=run_id, created_at=created_at))
+
+    def run_logs_contain(self, run_id, text):
+        with self.session_scope() as session:
+            return session.execute(
+                select(RunLogChunk.id).where(RunLogChunk.run_id == run_id, RunLogChunk.content.contains(text)).limit(1)
+            ).first() is not None
+
+    def get_run_logs(self, run_id, start=None, end=None, tail=None, unit="lines"):
+        with self.session_scope() as session:
+            last_chunk = session.execute(select_last_run_log_chunk(run_id)).scalar_one_or_none()
+            if last_chunk is None:
+                last_chunk = legacy_run_log_chunk(session.execute(select(Run.logs).where(Run.id == run_id)).scalar_one_or_none())
+                start, end = get_run_logs_range(last_chunk, start, end, tail, unit)
+                return run_logs_to_dict(last_chunk, [last_chunk], start, end, unit)
+            start, end = get_run_logs_range(last_chunk, start, end, tail, unit)
+            chunks = session.execute(select_run_log_chunks(run_id, start, end, unit)).scalars().all()
+            return run_logs_to_dict(last_chunk, chunks, start, end, unit)
+
+
+    def add_dandiset_metadata_versions(self, versions):
+        """
+        Append metadata versions of dandisets. Each version is a dict with "dandiset_id", "modified" and "metadata"
+        (a dict, or None if the dandiset was removed).
+        """
+        if len(versions) == 0:
+            return
+        with self.session_scope() as session:
+            session.add_all([
+                DandisetMetadataVersion(
+                    dandiset_id=v["dandiset_id"],
+                    modified=v["modified"],
+                    metadata_=json.dumps(v["metadata"]) if v["metadata"] is not None else None,
+                )
+                for v in versions
+            ])
+
+    def get_dandiset_metadata_versions(self, after_id=0):
+        with self.session_scope() as session:
+            return session.execute(
+                select(
+                    DandisetMetadataVersion.id, 
+                    DandisetMetadataVersion.dandiset_id, 
+                    DandisetMetadataVersion.modified, 
+                    DandisetMetadataVersion.metadata_.label("metadata"),
+                )
+                .where(DandisetMetadataVersion.id > after_id)
+                .order_by(DandisetMetadataVersion.id)
+            ).all()
+
+    def get_dandisets_sync(self):
+        with self.session_scope() as session:
+            return session.execute(select(DandisetsSync).limit(1)).scalar_one_or_none()
+
+    def update_dandisets_sync(self, last_modified, synced_at):
         with self.session_scope() as session:
-            runs = session.query(Run).all()
-            return [self.get_run_info(run_id=obj.id) for obj in runs]
+            sync = session.execute(select(DandisetsSync).limit(1)).scalar_one_or_none()
+            if sync is None:
+                sync = DandisetsSync()
+                session.add(sync)
+            sync.last_modified = last_modified
+            sync.synced_at = synced_at
+
+    def claim_dandisets_sync(self, previous_synced_at, synced_at):
+        """
+        Set the sync time, only if it is still previous_synced_at, so that a single one of the processes
+        which read the same sync time claims the sync. The first sync row is created with a fixed id.
+
+        Returns:
+            bool: Whether the sync was claimed.
+        """
+        if previous_synced_at is None:
+            is_previous_sync = DandisetsSync.synced_at.is_(None)
+        else:
+            is_previous_sync = DandisetsSync.synced_at == previous_synced_at
+        try:
+            with self.session_scope() as session:
+                result = session.execute(update(DandisetsSync).where(is_previous_sync).values(synced_at=synced_at))
+                if result.rowcount > 0:
+                    return True
+                if previous_synced_at is not None or session.execute(select(DandisetsSync.id).limit(1)).first() is not None:
+                    return False
+                session.add(DandisetsSync(id=1, synced_at=synced_at))
+            return True
+        except IntegrityError:
+            # Created by another process in the meantime
+            return False
+
+
+    def upsert_worker(self, name, **resources):
+        with self.session_scope() as session:
+            worker = session.query(Worker).filter(Worker.name == name).one_or_none()
+            if worker is None:
+                worker = Worker(name=name)
+                session.add(worker)
+            for key, value in resources.items():
+                setattr(worker, key, value)
+            return worker
+
+    def get_workers(self):
+        with self.session_scope() as session:
+            return session.query(Worker).order_by(Worker.name).all()
+
+    def claim_worker(self, run_identifier, alive_since, min_free_disk=0, min_free_memory=0):
+        """
+        Assign a run to the least loaded eligible worker: with a heartbeat since alive_since and enough free disk
+        and memory, the shortest queue first, then the most free cores and memory. The workers rows are locked,
+        so that concurrent dispatches see each other's claims, and the queue depth of the worker is incremented
+        until its next heartbeat reports it.
+
+        Returns:
+            Worker: The claimed worker, or None if no worker is eligible.
+        """
+        with self.session_scope() as session:
+            worker = session.execute(
+                select(Worker)
+                .where(
+                    Worker.last_heartbeat >= alive_since,
+                    func.coalesce(Worker.free_disk, 0) >= min_free_disk,
+                    func.coalesce(Worker.free_memory, 0) >= min_free_memory,
+                )
+                .order_by(Worker.queue_depth, Worker.free_cores.desc(), Worker.free_memory.desc())
+                .limit(1)
+                .with_for_update()
+            ).scalar_one_or_none()
+            if worker is None:
+                return None
+            worker.queue_depth = (worker.queue_depth or 0) + 1
+            session.execute(
+                update(Run)
+                .where(Run.identifier == run_identifier)
+                # Logs of the new worker are read from their start
+                .values(worker_id=worker.id, dispatch_count=func.coalesce(Run.dispatch_count, 0) + 1, logs_cursor=None)
+            )
+            return worker
 
 
     def update_user(self, user_id, key, value):
@@ -140,6 +584,23 @@ class DatabaseClient:
             return None
     
 
+    def update_run_group(self, group_id, key, value):
+        with self.session_scope() as session:
+            group = session.query(RunGroup).filter(RunGroup.id == group_id).one_or_none()
+            if group:
+                group.update(key, value)
+                session.add(group)
+                return group
+            return None
+    
+
+    def get_run_group_runs(self, group_id):
+        with self.session_scope() as session:
+            return session.execute(
+                select(Run.id, Run.identifier, Run.status).where(Run.group_id == group_id).order_by(Run.identifier)
+            ).all()
+    
+
     def update_run(self, run_identifier, key, value):
         with self.session_scope() as session:
             run = session.query(Run).filter(Run.identifier == run_identifier).one_or_none()
@@ -155,5 +616,86 @@ class DatabaseClient:
             run = session.query(Run).filter(Run.identifier == run_identifier).one_or_none()
             if run:
                 session.delete(run)
-                return True
-            return False
\ No newline at end of file
+                return run.id
+            return None
+
+
+@instrumented("database")
+class AsyncDatabaseClient:
+    """
+    Async client for the paths serving requests, using a session from the pooled async engine.
+    Rows are committed as they are created, so that they are visible to background tasks right away.
+    """
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def get_user_info(self, username):
+        result = await self.session.execute(select(User).where(User.username == username))
+        return result.scalar_one_or_none()
+
+    async def create_data_source(self, name, description, user_id, source, source_data_type, source_data_paths, recording_kwargs):
+        data_source = DataSource(
+            name=name, 
+            description=description, 
+            user_id=user_id, 
+            source=source, 
+            source_data_type=source_data_type,
+            source_data_paths=source_data_paths,
+            recording_kwargs=recording_kwargs,
+        )
+        self.session.add(data_source)
+        await self.session.commit()
+        return data_source
+
+    async def create_run(self, run_at, identifier, description, last_run, status, data_source_id, metadata, user_id, output_path, output_destination, logs="", result_fingerprints=None):
+        run = Run(
+            run_at=run_at, 
+            identifier=identifier, 
+            description=description, 
+            last_run=last_run, 
+            status=status, 
+            data_source_id=data_source_id, 
+            user_id=user_id, 
+            metadata_=metadata, 
+            logs=logs,
+            output_destination=output_destination,
+            output_path=output_path,
+            result_fingerprints=result_fingerprints,
+        )
+        self.session.add(run)
+        await self.session.commit()
+        return run
+
+    async def get_sorting_results(self, fingerprints):
+        # Results of successful runs only, by fingerprint
+        result = await self.session.execute(select_sorting_results(fingerprints))
+        return {row.fingerprint: sorting_result_row_to_dict(row) for row in result}
+
+    async def get_run_info(self, run_id, **kwargs):
+        result = await self.session.execute(select_runs_info(run_id=run_id, **kwargs))
+        row = result.one_or_none()
+        return run_row_to_dict(row) if row else None
+
+    async def get_all_runs_info(self, **kwargs):
+        result = await self.session.execute(select_runs_info(**kwargs))
+        return [run_row_to_dict(row) for row in result]
+
+    async def get_run_group_info(self, group_id):
+        result = await self.session.execute(select(RunGroup).where(RunGroup.id == group_id))
+        group = result.scalar_one_or_none()
+        if group is None:
+            return None
+        result = await self.session.execute(select_run_group_status_counts(group_id))
+        return run_group_to_dict(group, result.all())
+
+    async def get_run_logs(self, run_id, start=None, end=None, tail=None, unit="lines"):
+        result = await self.session.execute(select_last_run_log_chunk(run_id))
+        last_chunk = result.scalar_one_or_none()
+        if last_chunk is None:
+            result = await self.session.execute(select(Run.logs).where(Run.id == run_id))
+            last_chunk = legacy_run_log_chunk(result.scalar_one_or_none())
+            start, end = get_run_logs_range(last_chunk, start, end, tail, unit)
+            return run_logs_to_dict(last_chunk, [last_chunk], start, end, unit)
+        start, end = get_run_logs_range(last_chunk, start, end, tail, unit)
+        result = await self.session.execute(select_run_log_chunks(run_id, start, end, unit))
+        return run_logs_to_dict(last_chunk, result.scalars().all(), start, end, unit)
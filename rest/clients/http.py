@@ -0,0 +1,193 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core.logger import logger
+from core.settings import settings
+
+
+# Responses worth retrying: rate limited, or server temporarily unavailable
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency after consecutive failures, so that a slow or failing dependency
+    fails fast instead of piling up request threads. After reset_timeout seconds, a single trial
+    request is let through: the circuit closes again if it succeeds, and stays open otherwise.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_timeout: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or settings.HTTP_CIRCUIT_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or settings.HTTP_CIRCUIT_RESET_TIMEOUT
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_request(self) -> bool:
+        """
+        Raises CircuitOpenError if the request must fail fast. Returns whether the request is the trial request.
+        """
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._trial_in_progress):
+                raise CircuitOpenError(f"Circuit open for {self.name}, failing fast")
+            if state == "half-open":
+                self._trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_in_progress = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    logger.warning(f"Opening circuit for {self.name} after {self.failures} failures")
+                self.opened_at = time.monotonic()
+
+    def end_trial(self) -> None:
+        # A trial interrupted without an outcome lets the next request try again
+        with self._lock:
+            self._trial_in_progress = False
+
+
+class ResilientSession(requests.Session):
+    """
+    Long-lived, connection-pooled HTTP session for an outbound dependency, with default timeouts,
+    retries of idempotent requests with jittered exponential backoff, and a circuit breaker.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        retries: int = None,
+        backoff: float = 0.5,
+        max_backoff: float = 10.,
+        timeout: tuple = (5, 30),
+        pool_maxsize: int = 32,
+        circuit_breaker: CircuitBreaker = None,
+    ):
+        super().__init__()
+        self.name = name
+        self.retries = retries if retries is not None else settings.HTTP_RETRIES
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(name=name)
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def get_backoff(self, attempt: int, response: requests.Response = None) -> float:
+        retry_after = response.headers.get("Retry-After", None) if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        # Full jitter, so that concurrent clients do not retry in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        retries = self.retries if method.upper() in IDEMPOTENT_METHODS else 0
+        for attempt in range(retries + 1):
+            is_trial = self.circuit_breaker.before_request()
+            response = None
+            try:
+                response = super().request(method, url, **kwargs)
+            except requests.RequestException as e:
+                self.circuit_breaker.record_failure()
+                # Only connection errors and timeouts are worth retrying
+                if attempt == retries or not isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    raise
+                logger.info(f"{self.name}: {method} {urlparse(url).path} failed ({e}), retrying")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    self.circuit_breaker.record_success()
+                    return response
+                self.circuit_breaker.record_failure()
+                if attempt == retries:
+                    return response
+                logger.info(f"{self.name}: {method} {urlparse(url).path} returned {response.status_code}, retrying")
+            finally:
+                if is_trial:
+                    self.circuit_breaker.end_trial()
+            time.sleep(self.get_backoff(attempt, response))
+
+
+def get_remote_file_size(session: requests.Session, url: str) -> int:
+    """
+    Size of a remote file, from a one byte range request, which works with signed S3 URLs where HEAD requests
+    might not. Servers ignoring the range answer with the whole file: its size is then read from Content-Length,
+    and the response closed without downloading its content.
+    """
+    with session.get(url, headers={"Range": "bytes=0-0"}, stream=True) as response:
+        response.raise_for_status()
+        # E.g. "bytes 0-0/1234", or "bytes 0-0/*" if the size is unknown
+        total = response.headers.get("Content-Range", "").rpartition("/")[-1]
+        if response.status_code == 206 and total.isdigit():
+            return int(total)
+        if response.status_code == 200 and response.headers.get("Content-Length", "").isdigit():
+            return int(response.headers["Content-Length"])
+    raise ValueError(f"Size of remote file unknown: {urlparse(url).path}")
+
+
+def get_range_content(response: requests.Response, start: int, end: int) -> bytes:
+    """
+    Content of the byte range [start, end) of a response to a range request.
+    Servers ignoring the range answer with the whole file, which the range is taken from.
+    """
+    if response.status_code == 200:
+        return response.content[start:end]
+    return response.content
+
+
+def get_signed_url_ttl(url: str, default: float, margin: float = 60.) -> float:
+    """
+    Time to live of a URL, up to default seconds: until shortly before its expiry if it is a signed S3 URL.
+    """
+    query = parse_qs(urlparse(url).query)
+    if "X-Amz-Date" in query and "X-Amz-Expires" in query:
+        signed_at = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+        expires_in = int(query["X-Amz-Expires"][0]) - (datetime.now(tz=timezone.utc) - signed_at).total_seconds()
+        return max(min(default, expires_in - margin), 0)
+    if "Expires" in query:
+        return max(min(default, int(query["Expires"][0]) - time.time() - margin), 0)
+    return default
+
+
+# Shared sessions, one per outbound dependency
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+def get_http_session(name: str, **kwargs) -> ResilientSession:
+    with _sessions_lock:
+        if name not in _sessions:
+            _sessions[name] = ResilientSession(name=name, **kwargs)
+        return _sessions[name]
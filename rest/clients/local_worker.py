@@ -1,28 +1,33 @@
-import requests
-
 from core.logger import logger
+from clients.http import get_http_session
+from core.metrics import instrumented
 from models.sorting import SortingData
 
 
+@instrumented("worker")
 class LocalWorkerClient:
 
     def __init__(self, endpoint: str = "http://worker:5000/worker"):
         self.endpoint = endpoint
         self.logger = logger
+        # Pooled connections to each worker, shared by all clients
+        self.session = get_http_session(f"worker@{endpoint}")
 
 
     def run_sorting(self, **kwargs) -> None:
         payload = SortingData(**kwargs).dict()
-        response = requests.post(self.endpoint + "/run", json=payload)
+        response = self.session.post(self.endpoint + "/run", json=payload)
         if response.status_code == 200:
             self.logger.info("Success!")
         else:
             self.logger.info(f"Error {response.status_code}: {response.content}")
+            # Not sent, so that the run is failed, or dispatched again
+            response.raise_for_status()
     
 
     def get_run_logs(self, run_identifier):
         self.logger.info("Getting logs...")
-        response = requests.get(self.endpoint + "/logs", params={"run_identifier": run_identifier})
+        response = self.session.get(self.endpoint + "/logs", params={"run_identifier": run_identifier})
         if response.status_code == 200:
             logs = response.content.decode('utf-8')
             if "Error running sorter" in logs:
@@ -32,4 +37,18 @@ class LocalWorkerClient:
             return "running", logs
         else:
             self.logger.info(f"Error {response.status_code}: {response.content}")
-            return "fail", f"Logs couldn't be retrieved. Error {response.status_code}: {response.content}"
\ No newline at end of file
+            return "fail", f"Logs couldn't be retrieved. Error {response.status_code}: {response.content}"
+
+
+    def get_run_status(self, run_identifier):
+        """
+        Get the latest progress snapshot of a run from the worker.
+        Returns (None, None) if the worker has no progress events for this run.
+        """
+        response = self.session.get(self.endpoint + "/status", params={"run_identifier": run_identifier})
+        if response.status_code == 200:
+            progress = response.json()
+            status = progress["status"]
+            return status, progress
+        self.logger.info(f"Error {response.status_code}: {response.content}")
+        return None, None
@@ -0,0 +1,265 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List
+
+import requests
+
+from core.settings import settings
+from clients.http import get_http_session, get_range_content, get_remote_file_size
+
+
+STATS_NAMES = ["hits", "misses", "bytes_from_cache", "bytes_from_remote", "bytes_evicted", "total_bytes"]
+
+
+class BlockDiskCache:
+    """
+    Block-level disk cache for remote files read over HTTP range requests.
+
+    Files are split into fixed-size blocks, each stored as a file and fetched only when read. Blocks are indexed
+    in a SQLite database (WAL mode) in the cache directory, shared by all the worker processes, which keeps their
+    last access time and the cache statistics. When the cached bytes exceed the quota, the least recently used
+    blocks are evicted, down to 90% of the quota.
+    Files are identified by their URL without query, so signed URLs of the same file share their blocks.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, block_size: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        (self.cache_dir / "blocks").mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        # Readers do not block writers, and writers of other processes wait for the lock
+        self.get_connection().execute("PRAGMA journal_mode=WAL")
+        with self.transaction() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS blocks (key TEXT, block INTEGER, size INTEGER, last_access REAL, PRIMARY KEY (key, block))")
+            connection.execute("CREATE INDEX IF NOT EXISTS blocks_last_access ON blocks (last_access)")
+            connection.execute("CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, size INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            connection.executemany("INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)", [(n,) for n in STATS_NAMES])
+
+    def get_connection(self) -> sqlite3.Connection:
+        # SQLite connections can not be shared between threads
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(self.cache_dir / "index.sqlite", timeout=30, isolation_level=None)
+        return self._local.connection
+
+    def transaction(self) -> "_Transaction":
+        return _Transaction(self.get_connection())
+
+    @property
+    def session(self) -> requests.Session:
+        # Pooled connections to S3, shared by all threads
+        return get_http_session("s3")
+
+    @staticmethod
+    def get_key(url: str) -> str:
+        return hashlib.sha1(url.split("?")[0].encode()).hexdigest()
+
+    def get_block_path(self, key: str, block: int) -> Path:
+        return self.cache_dir / "blocks" / key[:2] / f"{key}.{block}"
+
+    def get_size(self, url: str) -> int:
+        key = self.get_key(url)
+        row = self.get_connection().execute("SELECT size FROM files WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return row[0]
+        size = get_remote_file_size(self.session, url)
+        with self.transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO files (key, size) VALUES (?, ?)", (key, size))
+        return size
+
+    def get_blocks(self, url: str, blocks: List[int], size: int) -> Dict[int, bytes]:
+        """
+        Get blocks of a remote file, from the cache, or fetched with one range request per run of missing blocks.
+        """
+        key = self.get_key(url)
+        data = dict()
+        placeholders = ",".join("?" * len(blocks))
+        cached = [r[0] for r in self.get_connection().execute(
+            f"SELECT block FROM blocks WHERE key = ? AND block IN ({placeholders})", (key, *blocks)
+        )]
+        for block in cached:
+            try:
+                data[block] = self.get_block_path(key, block).read_bytes()
+            except FileNotFoundError:
+                # Evicted by another worker since
+                pass
+        hits = list(data.keys())
+        missing = [b for b in blocks if b not in data]
+        for run in get_contiguous_runs(missing):
+            start = run[0] * self.block_size
+            end = min((run[-1] + 1) * self.block_size, size)
+            response = self.session.get(url, headers={"Range": f"bytes={start}-{end - 1}"})
+            response.raise_for_status()
+            content = get_range_content(response, start, end)
+            for block in run:
+                offset = (block - run[0]) * self.block_size
+                data[block] = content[offset:offset + self.block_size]
+                self.store_block(key, block, data[block])
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany("UPDATE blocks SET last_access = ? WHERE key = ? AND block = ?", [(now, key, b) for b in hits])
+            self.increment_stats(
+                connection,
+                hits=len(hits),
+                misses=len(missing),
+                bytes_from_cache=sum(len(data[b]) for b in hits),
+                bytes_from_remote=sum(len(data[b]) for b in missing),
+            )
+        if len(missing) > 0:
+            self.evict()
+        return data
+
+    def store_block(self, key: str, block: int, content: bytes) -> None:
+        path = self.get_block_path(key, block)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written to a temporary file first, so that readers never see a partial block
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+        with self.transaction() as connection:
+            inserted = connection.execute(
+                "INSERT OR IGNORE INTO blocks (key, block, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, block, len(content), time.time()),
+            ).rowcount
+            if inserted:
+                self.increment_stats(connection, total_bytes=len(content))
+
+    def evict(self) -> None:
+        """
+        Evict the least recently used blocks, if the cached bytes exceed the quota.
+        """
+        with self.transaction() as connection:
+            total_bytes = connection.execute("SELECT value FROM stats WHERE name = 'total_bytes'").fetchone()[0]
+            if total_bytes <= self.max_bytes:
+                return
+            evicted_bytes = 0
+            target_bytes = total_bytes - int(self.max_bytes * 0.9)
+            for key, block, size in connection.execute("SELECT key, block, size FROM blocks ORDER BY last_access").fetchall():
+                if evicted_bytes >= target_bytes:
+                    break
+                connection.execute("DELETE FROM blocks WHERE key = ? AND block = ?", (key, block))
+                self.get_block_path(key, block).unlink(missing_ok=True)
+                evicted_bytes += size
+            self.increment_stats(connection, total_bytes=-evicted_bytes, bytes_evicted=evicted_bytes)
+
+    @staticmethod
+    def increment_stats(connection: sqlite3.Connection, **increments) -> None:
+        connection.executemany(
+            "UPDATE stats SET value = value + ? WHERE name = ?",
+            [(v, k) for k, v in increments.items() if v],
+        )
+
+    def get_stats(self) -> dict:
+        connection = self.get_connection()
+        stats = dict(connection.execute("SELECT name, value FROM stats").fetchall())
+        blocks = connection.execute("SELECT COUNT(*) FROM blocks").fetchone()[0]
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            **stats,
+            "hit_ratio": stats["hits"] / lookups if lookups > 0 else None,
+            "blocks": blocks,
+            "block_size": self.block_size,
+            "max_bytes": self.max_bytes,
+        }
+
+    def open(self, url: str, mode: str = "rb") -> io.BufferedReader:
+        if mode != "rb":
+            raise ValueError(f"Unsupported mode: {mode}")
+        return io.BufferedReader(CachedRemoteFile(self, url), buffer_size=self.block_size)
+
+
+class _Transaction:
+    # Runs the statements of a with block in one transaction, taking the write lock right away
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.connection.execute("BEGIN IMMEDIATE")
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+class CachedRemoteFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over a remote file, reading its blocks through a BlockDiskCache.
+    The last blocks read are also kept in memory, for the many small reads of HDF5 metadata.
+    """
+
+    def __init__(self, cache: BlockDiskCache, url: str, memory_blocks: int = 32):
+        self.cache = cache
+        self.url = url
+        self.size = cache.get_size(url)
+        self.position = 0
+        self.memory_blocks = memory_blocks
+        self._blocks = OrderedDict()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), self.size - self.position)
+        if n <= 0:
+            return 0
+        block_size = self.cache.block_size
+        first, last = self.position // block_size, (self.position + n - 1) // block_size
+        blocks = list(range(first, last + 1))
+        missing = [b for b in blocks if b not in self._blocks]
+        if len(missing) > 0:
+            self._blocks.update(self.cache.get_blocks(self.url, missing, self.size))
+        data = b"".join(self._blocks[b] for b in blocks)
+        for b in blocks:
+            self._blocks.move_to_end(b)
+        while len(self._blocks) > max(self.memory_blocks, len(blocks)):
+            self._blocks.popitem(last=False)
+        offset = self.position - first * block_size
+        buffer[:n] = data[offset:offset + n]
+        self.position += n
+        return n
+
+
+def get_contiguous_runs(blocks: List[int]) -> List[List[int]]:
+    runs = list()
+    for block in sorted(blocks):
+        if len(runs) > 0 and runs[-1][-1] == block - 1:
+            runs[-1].append(block)
+        else:
+            runs.append([block])
+    return runs
+
+
+_nwb_block_cache = None
+
+
+def get_nwb_block_cache() -> BlockDiskCache:
+    global _nwb_block_cache
+    if _nwb_block_cache is None:
+        _nwb_block_cache = BlockDiskCache(
+            cache_dir=settings.NWB_CACHE_DIR,
+            max_bytes=settings.NWB_CACHE_MAX_BYTES,
+            block_size=settings.NWB_CACHE_BLOCK_SIZE,
+        )
+    return _nwb_block_cache
@@ -0,0 +1,262 @@
+import asyncio
+import bisect
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List
+
+from fastapi.concurrency import run_in_threadpool
+
+from core.logger import logger
+from core.settings import settings
+from clients.dandi import DandiClient
+from clients.database import DatabaseClient
+
+
+DANDISETS_METADATA_PATH = "data/dandisets_metadata.json"
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def get_dandiset_summary(dandiset_id: str, metadata: dict) -> dict:
+    assets_summary = metadata.get("assetsSummary", None) or dict()
+    return {
+        "id": dandiset_id,
+        "name": metadata.get("name", ""),
+        "label": dandiset_id + " - " + metadata.get("name", ""),
+        "species": [s.get("name", "") for s in assets_summary.get("species", None) or []],
+        "modalities": sorted(set(
+            [a.get("name", "") for a in assets_summary.get("approach", None) or []]
+            + [m.get("name", "") for m in assets_summary.get("measurementTechnique", None) or []]
+            + list(assets_summary.get("variableMeasured", None) or [])
+        )),
+        "size": assets_summary.get("numberOfBytes", 0),
+        "numberOfFiles": assets_summary.get("numberOfFiles", 0),
+        "dateCreated": metadata.get("dateCreated", None),
+    }
+
+
+class DandisetsIndexSnapshot:
+    """
+    Immutable search index over the dandisets metadata. Searches are answered from memory:
+    labels are pre-sorted, and each search term is prefix-matched against a sorted vocabulary
+    pointing to the dandisets containing it (id, name, description, keywords, species, modalities).
+    """
+
+    def __init__(self, all_metadata: dict):
+        self.all_metadata = all_metadata
+        self.summaries = sorted(
+            [get_dandiset_summary(k, v) for k, v in all_metadata.items()],
+            key=lambda s: s["label"],
+        )
+        self.labels = [s["label"] for s in self.summaries]
+        self.postings = dict()
+        for position, summary in enumerate(self.summaries):
+            metadata = all_metadata[summary["id"]]
+            text = " ".join([
+                summary["label"],
+                metadata.get("description", "") or "",
+                " ".join(metadata.get("keywords", None) or []),
+                " ".join(summary["species"]),
+                " ".join(summary["modalities"]),
+            ])
+            for token in set(tokenize(text)):
+                self.postings.setdefault(token, set()).add(position)
+        self.vocabulary = sorted(self.postings.keys())
+
+    def match_term(self, term: str) -> set:
+        # Union of the dandisets with a token starting with term
+        positions = set()
+        i = bisect.bisect_left(self.vocabulary, term)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(term):
+            positions |= self.postings[self.vocabulary[i]]
+            i += 1
+        return positions
+
+    def search(
+        self,
+        search: str = None,
+        species: str = None,
+        modality: str = None,
+        min_size: int = None,
+        max_size: int = None,
+        offset: int = 0,
+        limit: int = 50,
+    ) -> dict:
+        positions = None
+        for term in tokenize(search or ""):
+            matches = self.match_term(term)
+            positions = matches if positions is None else positions & matches
+        positions = range(len(self.summaries)) if positions is None else sorted(positions)
+        results = list()
+        for position in positions:
+            summary = self.summaries[position]
+            if species and not any(species.lower() in s.lower() for s in summary["species"]):
+                continue
+            if modality and not any(modality.lower() in m.lower() for m in summary["modalities"]):
+                continue
+            if min_size is not None and summary["size"] < min_size:
+                continue
+            if max_size is not None and summary["size"] > max_size:
+                continue
+            results.append(summary)
+        return {
+            "dandisets": results[offset:offset + limit],
+            "total": len(results),
+            "offset": offset,
+            "limit": limit,
+        }
+
+
+class DandisetsIndex:
+    """
+    In-memory index of the dandisets with NWB ecephys data, served from the snapshot stored in the database.
+
+    The snapshot is made of append-only metadata versions, written as each dandiset is fetched from DANDI, so that
+    a restarted process (or another replica) serves the last snapshot right away, and an interrupted crawl resumes
+    where it stopped. Each process periodically catches up with the versions written since its last read, and the
+    first process finding the last sync older than the refresh interval fetches the dandisets modified since from DANDI.
+    Each catch up builds a new index snapshot, swapped in a single assignment, so readers never see a partial index.
+    """
+
+    def __init__(
+        self,
+        seed_path: str = DANDISETS_METADATA_PATH,
+        interval: int = None,
+        catch_up_interval: float = 60.,
+        catch_up_versions: int = 100,
+        catch_up_seconds: float = 30.,
+    ):
+        self.seed_path = Path(seed_path)
+        self.interval = interval or settings.DANDISETS_INDEX_REFRESH_INTERVAL
+        self.catch_up_interval = catch_up_interval
+        # During a crawl, the index is rebuilt every catch_up_versions fetched versions or catch_up_seconds
+        self.catch_up_versions = catch_up_versions
+        self.catch_up_seconds = catch_up_seconds
+        self.snapshot = DandisetsIndexSnapshot(dict())
+        self.modified = dict()
+        self.last_version_id = 0
+        self.last_sync = None
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._task = None
+
+    def load(self) -> None:
+        """
+        Load the last snapshot from the database, seeding it from the local metadata file if there is none yet.
+        """
+        db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+        if db_client.get_dandisets_sync() is None and self.seed_path.exists():
+            self.seed_from_file(db_client)
+        self.catch_up()
+        self.loaded = True
+        logger.info(f"Loaded dandisets index: {len(self.snapshot.all_metadata)} dandisets")
+
+    def seed_from_file(self, db_client: DatabaseClient) -> None:
+        # Metadata files written before the snapshot was stored in the database
+        with open(self.seed_path, "r") as f:
+            all_metadata = json.load(f)
+        db_client.add_dandiset_metadata_versions([
+            {"dandiset_id": k, "modified": None, "metadata": v} for k, v in all_metadata.items()
+        ])
+        file_modified = datetime.fromtimestamp(self.seed_path.stat().st_mtime, tz=timezone.utc).isoformat()
+        db_client.update_dandisets_sync(last_modified=file_modified, synced_at=file_modified)
+
+    def catch_up(self) -> None:
+        """
+        Apply the metadata versions written since the last read, by this process or any other.
+        """
+        with self._lock:
+            db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+            sync = db_client.get_dandisets_sync()
+            if sync is not None and sync.last_modified:
+                self.last_sync = datetime.fromisoformat(sync.last_modified)
+            versions = db_client.get_dandiset_metadata_versions(after_id=self.last_version_id)
+            if len(versions) == 0:
+                return
+            all_metadata = dict(self.snapshot.all_metadata)
+            changed = False
+            for v in versions:
+                self.modified[v.dandiset_id] = v.modified
+                if v.metadata is not None:
+                    all_metadata[v.dandiset_id] = json.loads(v.metadata)
+                    changed = True
+                elif all_metadata.pop(v.dandiset_id, None) is not None:
+                    changed = True
+            self.last_version_id = versions[-1].id
+            if changed:
+                self.snapshot = DandisetsIndexSnapshot(all_metadata)
+
+    def refresh(self) -> None:
+        """
+        Catch up with the snapshot, and fetch the dandisets modified since the last sync if it is older than the interval.
+        """
+        self.catch_up()
+        db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+        now = datetime.now(tz=timezone.utc)
+        sync = db_client.get_dandisets_sync()
+        previous_synced_at = sync.synced_at if sync is not None else None
+        if previous_synced_at and (now - datetime.fromisoformat(previous_synced_at)).total_seconds() < self.interval:
+            return
+        # Claim the sync, so that other replicas which read the same sync time do not fetch the same dandisets
+        if not db_client.claim_dandisets_sync(previous_synced_at=previous_synced_at, synced_at=now.isoformat()):
+            return
+
+        # Versions are stored as they are fetched, but the index is only rebuilt periodically, as each rebuild is O(N)
+        versions_since_catch_up = 0
+        caught_up_at = time.monotonic()
+
+        def store_version(dandiset_id: str, modified: str, metadata: dict):
+            nonlocal versions_since_catch_up, caught_up_at
+            db_client.add_dandiset_metadata_versions([{"dandiset_id": dandiset_id, "modified": modified, "metadata": metadata}])
+            versions_since_catch_up += 1
+            if versions_since_catch_up >= self.catch_up_versions or time.monotonic() - caught_up_at >= self.catch_up_seconds:
+                self.catch_up()
+                versions_since_catch_up = 0
+                caught_up_at = time.monotonic()
+
+        dandi_client = DandiClient(token=settings.DANDI_API_KEY)
+        updated, removed_ids, last_modified = dandi_client.get_dandisets_metadata_modified_since(
+            since=self.last_sync,
+            known_modified=self.modified,
+            callback=store_version,
+        )
+        db_client.update_dandisets_sync(
+            last_modified=last_modified.isoformat() if last_modified else None,
+            synced_at=now.isoformat(),
+        )
+        self.catch_up()
+        logger.info(f"Refreshed dandisets index: {len(updated)} updated, {len(removed_ids)} removed")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await run_in_threadpool(self.refresh)
+            except Exception as e:
+                logger.exception(f"Error refreshing dandisets index: {e}")
+            await asyncio.sleep(self.catch_up_interval)
+
+    def get_labels(self) -> List[str]:
+        return self.snapshot.labels
+
+    def search(self, **kwargs) -> dict:
+        return self.snapshot.search(**kwargs)
+
+
+dandisets_index = DandisetsIndex()
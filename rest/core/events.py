@@ -0,0 +1,116 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+
+@dataclass
+class RunEvent:
+    seq: int
+    id: str
+    event: str
+    data: dict
+
+    def to_sse(self) -> str:
+        return f"id: {self.id}\nevent: {self.event}\ndata: {json.dumps(self.data, separators=(',', ':'))}\n\n"
+
+
+@dataclass(eq=False)
+class RunEventSubscription:
+    queue: asyncio.Queue
+    lagging: bool = False
+
+
+class RunEventBroker:
+    """
+    Broadcasts run events (status changes, progress, new log lines) to the connected clients, as Server-Sent Events.
+
+    Recent events are kept in a bounded buffer, so that clients resume from their last event id after a reconnection.
+    Each client has a bounded queue: a client that does not keep up is disconnected, and resumes from the buffer
+    when it reconnects, instead of growing the server memory. Clients that can not be resumed (e.g. after a restart,
+    or when their last event is no longer buffered) get a "reset" event, and should reload the runs.
+
+    Events can be published from any thread, e.g. from the reconciler running in the threadpool.
+    """
+
+    def __init__(self, buffer_size: int = 1000, queue_size: int = 100, keepalive_interval: float = 15.):
+        # Event ids are prefixed by the process start time, so ids from a previous process are never resumed
+        self.epoch = str(int(time.time()))
+        self.queue_size = queue_size
+        self.keepalive_interval = keepalive_interval
+        self._seq = 0
+        self._buffer = deque(maxlen=buffer_size)
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def publish(self, event: str, data: dict) -> None:
+        with self._lock:
+            self._seq += 1
+            run_event = RunEvent(seq=self._seq, id=f"{self.epoch}-{self._seq}", event=event, data=data)
+            self._buffer.append(run_event)
+            loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._deliver, run_event)
+
+    def _deliver(self, run_event: RunEvent) -> None:
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.queue.put_nowait(run_event)
+            except asyncio.QueueFull:
+                subscription.lagging = True
+                self._subscriptions.discard(subscription)
+
+    def _get_replay(self, last_event_id: str):
+        # Returns the buffered events after last_event_id, or None if the client can not be resumed
+        try:
+            epoch, seq = last_event_id.split("-")
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or seq > self._seq:
+            return None
+        if len(self._buffer) > 0 and seq < self._buffer[0].seq - 1:
+            return None
+        return [e for e in self._buffer if e.seq > seq]
+
+    async def stream(self, last_event_id: str = None) -> AsyncIterator[str]:
+        """
+        Stream events as SSE messages, starting after last_event_id if given.
+        """
+        subscription = RunEventSubscription(queue=asyncio.Queue(maxsize=self.queue_size))
+        with self._lock:
+            self._loop = asyncio.get_running_loop()
+            replay = self._get_replay(last_event_id) if last_event_id else []
+            self._subscriptions.add(subscription)
+            last_seq = self._seq
+        try:
+            yield "retry: 3000\n\n"
+            if replay is None:
+                yield RunEvent(seq=last_seq, id=f"{self.epoch}-{last_seq}", event="reset", data=dict()).to_sse()
+                replay = []
+            for run_event in replay:
+                yield run_event.to_sse()
+            while not subscription.lagging:
+                try:
+                    run_event = await asyncio.wait_for(subscription.queue.get(), timeout=self.keepalive_interval)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing idle connections, and detects disconnected clients
+                    yield ": keepalive\n\n"
+                    continue
+                # Events published while subscribing are both replayed and delivered
+                if run_event.seq <= last_seq:
+                    continue
+                yield run_event.to_sse()
+        finally:
+            self._subscriptions.discard(subscription)
+
+    @property
+    def subscribers_count(self) -> int:
+        return len(self._subscriptions)
+
+
+run_event_broker = RunEventBroker()
@@ -0,0 +1,235 @@
+import contextvars
+import functools
+import inspect
+import threading
+import time
+from typing import Sequence
+
+from core.logger import logger
+from core.settings import settings
+
+
+# Latency buckets, in seconds, from fast database reads to slow remote reads
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60.)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labelnames: Sequence[str], labels: tuple, extra: dict = None) -> str:
+    pairs = list(zip(labelnames, labels)) + list((extra or dict()).items())
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(k + '="' + escape_label_value(v) + '"' for k, v in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # By labels: [count per bucket (non cumulative, the last one for +Inf), sum]
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, *labels, value: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            entry = self._values.get(labels, None)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    In-memory metrics of a process, exposed in the Prometheus text format.
+    Each worker process has its own registry, so each should be scraped (or the service run with one process).
+    """
+
+    def __init__(self):
+        self.metrics = list()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds",
+    "Time to the response start of HTTP requests, by route template",
+    labelnames=("method", "route", "status"),
+))
+dependency_call_duration = registry.register(Histogram(
+    "dependency_call_duration_seconds",
+    "Duration of calls to the service dependencies (database, AWS, DANDI, worker)",
+    labelnames=("dependency", "operation"),
+))
+dependency_calls = registry.register(Counter(
+    "dependency_calls_total",
+    "Calls to the service dependencies, by outcome (ok or error)",
+    labelnames=("dependency", "operation", "outcome"),
+))
+
+# Dependency calls of the current request, only collected when requests are traced
+_request_trace = contextvars.ContextVar("request_trace", default=None)
+# Set during an instrumented call, so that the instrumented calls it makes are not counted again
+_in_dependency_call = contextvars.ContextVar("in_dependency_call", default=False)
+
+
+def record_dependency_call(dependency: str, operation: str, duration: float, error: bool) -> None:
+    dependency_call_duration.observe(dependency, operation, value=duration)
+    dependency_calls.inc(dependency, operation, "error" if error else "ok")
+    trace = _request_trace.get()
+    if trace is not None:
+        trace.append(f"{dependency}.{operation}={duration * 1000:.1f}ms{' (error)' if error else ''}")
+
+
+def instrument_function(func, dependency: str, operation: str):
+    """
+    Time the calls of a function to a dependency. Only the outermost instrumented call is recorded,
+    e.g. DandiClient.get_file_url and not the DandiClient.get_asset_id_and_url call it makes.
+    """
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if _in_dependency_call.get():
+                return await func(*args, **kwargs)
+            token = _in_dependency_call.set(True)
+            start = time.perf_counter()
+            error = True
+            try:
+                result = await func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                record_dependency_call(dependency, operation, time.perf_counter() - start, error)
+                _in_dependency_call.reset(token)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _in_dependency_call.get():
+            return func(*args, **kwargs)
+        token = _in_dependency_call.set(True)
+        start = time.perf_counter()
+        error = True
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            record_dependency_call(dependency, operation, time.perf_counter() - start, error)
+            _in_dependency_call.reset(token)
+    return wrapper
+
+
+def instrumented(dependency: str, exclude: Sequence[str] = ()):
+    """
+    Class decorator timing the calls of the public methods of a client to a dependency.
+    Methods of the class itself are instrumented, not generator methods nor static or class methods.
+    """
+    def decorator(cls):
+        for name, attribute in list(vars(cls).items()):
+            if name.startswith("_") or name in exclude:
+                continue
+            if not inspect.isfunction(attribute) or inspect.isgeneratorfunction(attribute):
+                continue
+            setattr(cls, name, instrument_function(attribute, dependency=dependency, operation=name))
+        return cls
+    return decorator
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing the HTTP requests, up to the response start, so that streamed responses
+    (e.g. Server-Sent Events) are timed to their first byte. Requests are labelled by route template,
+    and optionally traced to the logs with their dependency calls.
+    """
+
+    def __init__(self, app, trace_requests: bool = None):
+        self.app = app
+        self.trace_requests = trace_requests if trace_requests is not None else settings.METRICS_TRACE_REQUESTS
+        self._routes = None
+
+    def get_route(self, scope) -> str:
+        if self._routes is None:
+            self._routes = {r.endpoint: r.path for r in scope["app"].routes if hasattr(r, "endpoint")}
+        # The endpoint is set on the scope by the router, so only matched routes make a label
+        return self._routes.get(scope.get("endpoint", None), "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        trace = list() if self.trace_requests else None
+        token = _request_trace.set(trace)
+        recorded = False
+
+        def record(status: int):
+            nonlocal recorded
+            recorded = True
+            duration = time.perf_counter() - start
+            http_request_duration.observe(scope["method"], self.get_route(scope), str(status), value=duration)
+            if trace is not None:
+                logger.info(f"{scope['method']} {scope['path']} {status} {duration * 1000:.1f}ms {' '.join(trace)}")
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                record(message["status"])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            if not recorded:
+                record(500)
+            raise
+        finally:
+            _request_trace.reset(token)
@@ -0,0 +1,212 @@
+import asyncio
+import json
+from datetime import datetime
+
+from fastapi.concurrency import run_in_threadpool
+
+from core.logger import logger
+from core.settings import settings
+from clients.database import DatabaseClient
+from clients.aws import AWSClient
+from clients.local_worker import LocalWorkerClient
+from core.events import run_event_broker
+from core.workers import DEFAULT_WORKER_ENDPOINT, NoWorkerAvailableError, dispatch_local_run, get_alive_since, get_run_payload, is_worker_lost
+
+
+map_aws_batch_status_to_rest_status = {
+    "SUBMITTED": "running",
+    "PENDING": "running",
+    "RUNNABLE": "running",
+    "STARTING": "running",
+    "RUNNING": "running",
+    "SUCCEEDED": "success",
+    "FAILED": "fail",
+}
+
+
+def get_latest_progress_from_logs(logs: str):
+    """Get the latest progress snapshot logged by the worker, if any"""
+    for line in reversed(logs.splitlines()):
+        if "PROGRESS {" in line:
+            try:
+                return json.loads(line[line.index("PROGRESS {") + len("PROGRESS "):])
+            except json.JSONDecodeError:
+                continue
+    return None
+
+
+class RunStatusReconciler:
+    """
+    Periodically refreshes the status of all active runs, so that API reads only hit the database.
+
+    AWS Batch job ids are resolved once (from a single listing of the queue) and stored on the run,
+    jobs are described in batches of 100, and all status changes are written in one bulk update.
+    CloudWatch logs are ingested incrementally from a cursor stored on the run, and appended to the logs store.
+    Local runs are reconciled from the worker they were dispatched to, and dispatched again if its heartbeats stopped.
+    Their logs are ingested once finished, from the line offset stored on the run.
+    """
+
+    def __init__(self, interval: int = None):
+        self.interval = interval or settings.RUN_RECONCILER_INTERVAL
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await run_in_threadpool(self.reconcile_once)
+            except Exception as e:
+                logger.exception(f"Error reconciling runs status: {e}")
+            await asyncio.sleep(self.interval)
+
+    def reconcile_once(self):
+        db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+        active_runs = db_client.get_active_runs()
+        if len(active_runs) == 0:
+            return
+        updates = list()
+        new_logs = dict()
+        aws_runs = [r for r in active_runs if r.run_at == "aws"]
+        local_runs = [r for r in active_runs if r.run_at == "local"]
+        if len(aws_runs) > 0:
+            updates.extend(self.reconcile_aws_runs(aws_runs, db_client=db_client, new_logs=new_logs))
+        if len(local_runs) > 0:
+            updates.extend(self.reconcile_local_runs(local_runs, db_client=db_client, new_logs=new_logs))
+        db_client.bulk_update_runs(updates, new_logs=new_logs)
+        succeeded_run_ids = [u["id"] for u in updates if u.get("status") == "success"]
+        if len(succeeded_run_ids) > 0:
+            db_client.index_sorting_results(succeeded_run_ids, created_at=datetime.now().strftime("%Y/%m/%d %H:%M:%S"))
+        self.publish_events(updates, new_logs)
+        logger.info(f"Reconciled {len(active_runs)} active runs, {len(updates)} updated, {sum(len(v) for v in new_logs.values())} new log lines")
+
+    def reconcile_aws_runs(self, runs, db_client: DatabaseClient, new_logs: dict):
+        aws_client = AWSClient()
+        updates = list()
+
+        # Resolve missing job ids once, and cache them on the run
+        job_ids = {r.id: r.job_id for r in runs}
+        if any(job_id is None for job_id in job_ids.values()):
+            job_ids_by_name = aws_client.list_job_ids_by_name_prefix(
+                job_queue=settings.AWS_BATCH_JOB_QUEUE,
+                prefix="sorting-",
+            )
+            for r in runs:
+                if job_ids[r.id] is None and f"sorting-{r.identifier}" in job_ids_by_name:
+                    job_ids[r.id] = job_ids_by_name[f"sorting-{r.identifier}"]
+                    updates.append({"id": r.id, "job_id": job_ids[r.id]})
+
+        runs_by_job_id = {job_ids[r.id]: r for r in runs if job_ids[r.id] is not None}
+        jobs = aws_client.describe_jobs(job_ids=list(runs_by_job_id.keys()))
+        for job in jobs:
+            run = runs_by_job_id[job["jobId"]]
+            status = map_aws_batch_status_to_rest_status[job["status"]]
+            run_update = {"id": run.id}
+            log_stream_name = job.get("container", dict()).get("logStreamName", None)
+            lines = list()
+            if log_stream_name is not None:
+                # Only the events written since the stored cursor are read
+                try:
+                    lines, logs_cursor = aws_client.get_log_stream_events_since(
+                        log_stream_name=log_stream_name,
+                        next_token=run.logs_cursor,
+                    )
+                    if len(lines) > 0:
+                        new_logs[run.id] = lines
+                        run_update["logs_cursor"] = logs_cursor
+                        progress = get_latest_progress_from_logs("\n".join(lines))
+                        if progress is not None:
+                            run_update["progress"] = json.dumps(progress)
+                except Exception as e:
+                    logger.exception(f"Error getting run logs: {run.identifier}. {e}")
+                    if status != "running":
+                        # Retry on next pass, so the logs of a finished run are complete
+                        status = "running"
+            if status == "success":
+                if any("Error running sorter" in line for line in lines) or db_client.run_logs_contain(run.id, "Error running sorter"):
+                    status = "fail"
+            if status != "running":
+                run_update["status"] = status
+            if len(run_update) > 1:
+                updates.append(run_update)
+        return self.merge_updates(updates)
+
+    def reconcile_local_runs(self, runs, db_client: DatabaseClient, new_logs: dict):
+        updates = list()
+        alive_since = get_alive_since()
+        for r in runs:
+            try:
+                if is_worker_lost(r, alive_since=alive_since):
+                    run_update = self.requeue_local_run(r, db_client=db_client, new_logs=new_logs)
+                    if run_update is not None:
+                        updates.append(run_update)
+                    continue
+                local_worker_client = LocalWorkerClient(endpoint=r.worker_endpoint or DEFAULT_WORKER_ENDPOINT)
+                # Status comes from the structured progress snapshot, logs are only fetched once the run is finished
+                status, progress = local_worker_client.get_run_status(run_identifier=r.identifier)
+                if status is None:
+                    # No progress reported yet, or the worker did not answer: still running
+                    continue
+                run_update = {"id": r.id}
+                if progress is not None:
+                    run_update["progress"] = json.dumps(progress)
+                if status != "running":
+                    _, run_logs = local_worker_client.get_run_logs(run_identifier=r.identifier)
+                    run_update["status"] = status
+                    # The worker serves the whole log, only the lines after the stored offset are appended
+                    lines = run_logs.rstrip("\n").split("\n") if run_logs else list()
+                    logs_offset = int(r.logs_cursor or 0)
+                    if len(lines) > logs_offset:
+                        new_logs[r.id] = lines[logs_offset:]
+                        run_update["logs_cursor"] = str(len(lines))
+                if len(run_update) > 1:
+                    updates.append(run_update)
+            except Exception as e:
+                logger.exception(f"Error getting run status: {r.identifier}. {e}")
+        return updates
+
+    @staticmethod
+    def requeue_local_run(run, db_client: DatabaseClient, new_logs: dict):
+        # Sent to another worker, unless it was already dispatched too many times
+        if (run.dispatch_count or 0) >= settings.WORKER_MAX_DISPATCHES:
+            new_logs[run.id] = [f"Worker lost, run failed after {run.dispatch_count} dispatches"]
+            return {"id": run.id, "status": "fail"}
+        try:
+            endpoint = dispatch_local_run(db_client=db_client, run_identifier=run.identifier, payload=get_run_payload(run))
+        except NoWorkerAvailableError:
+            # Kept on the lost worker, and dispatched on a next pass
+            logger.info(f"No worker available to dispatch run again: {run.identifier}")
+            return None
+        new_logs[run.id] = [f"Worker lost, run dispatched again to {endpoint}"]
+        return None
+
+    @staticmethod
+    def publish_events(updates, new_logs, max_lines_per_event: int = 500):
+        # Push the stored changes to the connected clients
+        for u in updates:
+            data = {"id": u["id"]}
+            if "status" in u:
+                data["status"] = u["status"]
+            if "progress" in u:
+                data["progress"] = json.loads(u["progress"])
+            if len(data) > 1:
+                run_event_broker.publish("run", data)
+        for run_id, lines in new_logs.items():
+            for i in range(0, len(lines), max_lines_per_event):
+                run_event_broker.publish("logs", {"id": run_id, "lines": lines[i:i + max_lines_per_event]})
+
+    @staticmethod
+    def merge_updates(updates):
+        merged = dict()
+        for u in updates:
+            merged.setdefault(u["id"], dict()).update(u)
+        return list(merged.values())
@@ -0,0 +1,73 @@
+import hashlib
+import json
+from urllib.parse import urlparse, urlunparse
+
+from clients.aws import AWSClient
+from models.sorting import SortingData
+
+
+# Settings of a sorting job that determine its results. Outputs destination and path do not, nor does where it runs
+FINGERPRINT_FIELDS = [
+    "source",
+    "source_data_type",
+    "subject_metadata",
+    "recording_kwargs",
+    "test_with_toy_recording",
+    "test_with_subrecording",
+    "test_subrecording_n_frames",
+]
+
+
+def normalize_source_url(url: str) -> str:
+    # Signed URLs of the same file differ by their query only
+    parsed = urlparse(url)
+    if parsed.scheme in ("http", "https"):
+        return urlunparse(parsed._replace(query="", fragment=""))
+    return url
+
+
+def get_source_digests(source_data_paths: dict) -> dict:
+    """
+    Digests of the source files, by path name. S3 objects are identified by their ETag, while DANDI files
+    are served from content-addressed blob URLs, already identifying their content.
+    """
+    digests = dict()
+    aws_client = None
+    for name, path in (source_data_paths or dict()).items():
+        if isinstance(path, str) and path.startswith("s3://"):
+            aws_client = aws_client or AWSClient()
+            digests[name] = aws_client.get_s3_object_etag(path)
+    return digests
+
+
+def get_fingerprint(spec: dict) -> str:
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_sorting_fingerprints(data: SortingData, digests: dict) -> dict:
+    """
+    Fingerprint of the results of each sorter of a sorting job: a hash of its canonical spec, made of
+    the source files (by URL and digest), the preprocessing settings, and the sorter name and parameters.
+
+    Returns:
+        dict: The fingerprint of each sorter, by sorter name.
+    """
+    job = json.loads(data.json())
+    source_spec = {field: job.get(field) for field in FINGERPRINT_FIELDS}
+    source_spec["source_data_paths"] = {
+        name: normalize_source_url(path) if isinstance(path, str) else path
+        for name, path in (job.get("source_data_paths") or dict()).items()
+    }
+    source_spec["source_digests"] = digests
+    sorters_kwargs = job.get("sorters_kwargs") or dict()
+    fingerprints = dict()
+    for sorter_name in job.get("sorters_names_list") or list():
+        # Sorter names are case insensitive for the worker
+        sorter_name = sorter_name.lower().strip()
+        fingerprints[sorter_name] = get_fingerprint({
+            **source_spec,
+            "sorter_name": sorter_name,
+            "sorter_kwargs": sorters_kwargs.get(sorter_name, dict()),
+        })
+    return fingerprints
@@ -11,9 +11,68 @@ class Settings:
     AWS_BATCH_JOB_QUEUE = os.environ.get("AWS_BATCH_JOB_QUEUE", None)
     AWS_BATCH_JOB_DEFINITION = os.environ.get("AWS_BATCH_JOB_DEFINITION", None)
     SORTING_LOGS_S3_BUCKET = os.environ.get("SORTING_LOGS_S3_BUCKET", None)
+    # Job specs are stored as JSON documents, and passed to the jobs by reference
+    SORTING_JOB_SPECS_S3_BUCKET = os.environ.get("SORTING_JOB_SPECS_S3_BUCKET", SORTING_LOGS_S3_BUCKET)
+    # Custom AWS endpoint, e.g. a moto server to run without AWS. Unset or empty for AWS
+    AWS_ENDPOINT_URL = os.environ.get("AWS_ENDPOINT_URL") or None
 
     WORKER_DEPLOY_MODE = os.environ.get("WORKER_DEPLOY_MODE", "compose")
 
+    # Database connection pool, shared by all requests of a process
+    DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+    DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 20))
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+
+    # Background reconciliation of active runs status
+    RUN_RECONCILER_ENABLED = os.environ.get("RUN_RECONCILER_ENABLED", "True").lower() in ('true', '1', 't')
+    RUN_RECONCILER_INTERVAL = int(os.environ.get("RUN_RECONCILER_INTERVAL", 30))
+
+    # Background refresh of the dandisets index, fetching only dandisets modified since the last sync
+    DANDISETS_INDEX_REFRESH_INTERVAL = int(os.environ.get("DANDISETS_INDEX_REFRESH_INTERVAL", 3600))
+
+    # Block-level disk cache for remote NWB reads, shared by all workers
+    NWB_CACHE_DIR = os.environ.get("NWB_CACHE_DIR", "data/nwb-block-cache")
+    NWB_CACHE_MAX_BYTES = int(os.environ.get("NWB_CACHE_MAX_BYTES", 2 * 1024**3))
+    NWB_CACHE_BLOCK_SIZE = int(os.environ.get("NWB_CACHE_BLOCK_SIZE", 64 * 1024))
+
+    # Bulk submissions: maximum runs per submission, and throttling of the jobs submitted in the background
+    SORTING_BULK_MAX_RUNS = int(os.environ.get("SORTING_BULK_MAX_RUNS", 1000))
+    SORTING_SUBMIT_CONCURRENCY = int(os.environ.get("SORTING_SUBMIT_CONCURRENCY", 4))
+    SORTING_SUBMIT_INTERVAL = float(os.environ.get("SORTING_SUBMIT_INTERVAL", 0.5))
+
+    # Parameter sweeps, submitted as AWS Batch array jobs (2 to 10000 children), with their grid stored on S3
+    SORTING_SWEEP_MAX_SIZE = int(os.environ.get("SORTING_SWEEP_MAX_SIZE", 10000))
+    SORTING_SWEEPS_S3_BUCKET = os.environ.get("SORTING_SWEEPS_S3_BUCKET", os.environ.get("SORTING_LOGS_S3_BUCKET", None))
+
+    # Logs each request with its duration and the timings of its dependency calls
+    METRICS_TRACE_REQUESTS = os.environ.get("METRICS_TRACE_REQUESTS", "False").lower() in ('true', '1', 't')
+
+    # Concurrent calls to each dependency from async routes, each in its own bounded set of threads
+    DANDI_CONCURRENCY = int(os.environ.get("DANDI_CONCURRENCY", 16))
+    NWB_READS_CONCURRENCY = int(os.environ.get("NWB_READS_CONCURRENCY", 8))
+    AWS_CONCURRENCY = int(os.environ.get("AWS_CONCURRENCY", 8))
+    WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))
+
+    # Unit summaries of finished runs, from their exported sortings, cached per run on disk
+    UNIT_SUMMARY_CACHE_DIR = os.environ.get("UNIT_SUMMARY_CACHE_DIR", "data/unit-summary-cache")
+    UNIT_SUMMARY_MAX_MATRIX_SIZE = int(os.environ.get("UNIT_SUMMARY_MAX_MATRIX_SIZE", 1_000_000))
+    UNIT_SUMMARY_CONCURRENCY = int(os.environ.get("UNIT_SUMMARY_CONCURRENCY", 2))
+    # Results folder of the local worker, if mounted, to summarize the sortings of local runs
+    SORTING_RESULTS_LOCAL_DIR = os.environ.get("SORTING_RESULTS_LOCAL_DIR", None)
+
+    # Local workers pool: workers without a heartbeat for WORKER_HEARTBEAT_TIMEOUT seconds are considered gone, and
+    # their runs dispatched again, up to WORKER_MAX_DISPATCHES times. Workers with less free disk or memory (bytes) are skipped
+    WORKER_HEARTBEAT_TIMEOUT = int(os.environ.get("WORKER_HEARTBEAT_TIMEOUT", 60))
+    WORKER_MAX_DISPATCHES = int(os.environ.get("WORKER_MAX_DISPATCHES", 3))
+    WORKER_MIN_FREE_DISK = int(os.environ.get("WORKER_MIN_FREE_DISK", 0))
+    WORKER_MIN_FREE_MEMORY = int(os.environ.get("WORKER_MIN_FREE_MEMORY", 0))
+
+    # Outbound HTTP calls: retries of idempotent requests, and circuit breaker per dependency
+    HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+    HTTP_CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("HTTP_CIRCUIT_FAILURE_THRESHOLD", 5))
+    HTTP_CIRCUIT_RESET_TIMEOUT = float(os.environ.get("HTTP_CIRCUIT_RESET_TIMEOUT", 30))
+
 
 class DevSettings(Settings):
     DEBUG = True
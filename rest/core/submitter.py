@@ -0,0 +1,63 @@
+import asyncio
+from typing import Callable
+
+from fastapi.concurrency import run_in_threadpool
+
+from core.logger import logger
+from core.settings import settings
+
+
+class ThrottledSubmitter:
+    """
+    Submits sorting jobs in the background, from a queue, so that a bulk submission returns right away
+    and does not flood AWS Batch or the worker: at most max_concurrency submissions run at a time,
+    and they are started at least min_interval seconds apart.
+    """
+
+    def __init__(self, max_concurrency: int = None, min_interval: float = None):
+        self.max_concurrency = max_concurrency or settings.SORTING_SUBMIT_CONCURRENCY
+        self.min_interval = min_interval if min_interval is not None else settings.SORTING_SUBMIT_INTERVAL
+        self.queue = asyncio.Queue()
+        self._running = set()
+        self._task = None
+
+    def submit(self, func: Callable, *args, **kwargs) -> None:
+        self.queue.put_nowait((func, args, kwargs))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run_forever(self):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        while True:
+            func, args, kwargs = await self.queue.get()
+            await semaphore.acquire()
+            task = asyncio.create_task(self._run(semaphore, func, args, kwargs))
+            # Keeps a reference to running submissions, which the event loop does not
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            await asyncio.sleep(self.min_interval)
+
+    async def _run(self, semaphore: asyncio.Semaphore, func: Callable, args: tuple, kwargs: dict):
+        try:
+            await run_in_threadpool(func, *args, **kwargs)
+        except Exception as e:
+            logger.exception(f"Error submitting sorting job: {e}")
+        finally:
+            semaphore.release()
+            self.queue.task_done()
+
+    @property
+    def pending_count(self) -> int:
+        return self.queue.qsize() + len(self._running)
+
+
+run_submitter = ThrottledSubmitter()
@@ -0,0 +1,280 @@
+import io
+import json
+import os
+import shutil
+import struct
+import threading
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from core.settings import settings
+from clients.aws import AWSClient
+from clients.http import get_http_session, get_range_content, get_remote_file_size
+
+
+class RangedRemoteFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over a remote file, each read being a single HTTP range request.
+    Unlike the NWB block cache, nothing is stored: exported sortings are read once, then summarized.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.session = get_http_session("s3")
+        self.size = get_remote_file_size(self.session, url)
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), self.size - self.position)
+        if n <= 0:
+            return 0
+        response = self.session.get(self.url, headers={"Range": f"bytes={self.position}-{self.position + n - 1}"})
+        response.raise_for_status()
+        content = get_range_content(response, self.position, self.position + n)
+        buffer[:len(content)] = content
+        self.position += len(content)
+        return len(content)
+
+
+def read_npy_header(fileobj, offset: int, max_header_size: int = 64 * 1024):
+    """
+    Read the header of a .npy file at offset: its shape, order, dtype and data offset.
+    Returns None for header formats other than 1.0 and 2.0.
+    """
+    fileobj.seek(offset)
+    stream = io.BytesIO(fileobj.read(max_header_size))
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    else:
+        return None
+    return shape, fortran_order, dtype, offset + stream.tell()
+
+
+def read_npz_arrays(fileobj, names: list, chunk_size: int = 64 * 1024**2) -> dict:
+    """
+    Read arrays of a .npz file, reading only the zip directory and the members of the arrays.
+    Members of uncompressed files (np.savez) are read straight into their arrays, in large ranged reads.
+    """
+    arrays = dict()
+    with zipfile.ZipFile(fileobj) as zf:
+        for name in names:
+            info = zf.getinfo(f"{name}.npy")
+            header = None
+            if info.compress_type == zipfile.ZIP_STORED:
+                # Data starts after the local file header: 30 bytes, then the file name and extra field
+                fileobj.seek(info.header_offset)
+                local_header = fileobj.read(30)
+                name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+                member_offset = info.header_offset + 30 + name_length + extra_length
+                header = read_npy_header(fileobj, member_offset)
+            if header is None:
+                with zf.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            shape, fortran_order, dtype, data_offset = header
+            array = np.empty(shape, dtype=dtype, order="F" if fortran_order else "C")
+            view = memoryview(array.reshape(-1, order="A").view(np.uint8))
+            fileobj.seek(data_offset)
+            for start in range(0, len(view), chunk_size):
+                chunk = view[start:start + chunk_size]
+                read = 0
+                while read < len(chunk):
+                    n = fileobj.readinto(chunk[read:])
+                    if not n:
+                        raise EOFError(f"Unexpected end of file reading {name}")
+                    read += n
+            arrays[name] = array
+    return arrays
+
+
+def read_exported_sorting(fileobj) -> dict:
+    """
+    Read the spike trains of a sorting exported by the worker (spikeinterface NPZ format), in a single array
+    of spike samples sorted by unit then time, the segments laid out one after the other.
+    """
+    header = read_npz_arrays(fileobj, ["unit_ids", "num_segment", "sampling_frequency"])
+    unit_ids = header["unit_ids"]
+    num_segments = int(header["num_segment"][0])
+    names = [n for i in range(num_segments) for n in (f"spike_indexes_seg{i}", f"spike_labels_seg{i}")]
+    segments = read_npz_arrays(fileobj, names)
+    # Unit labels are unit ids, mapped to their index
+    order = np.argsort(unit_ids, kind="stable")
+    spike_samples = list()
+    spike_units = list()
+    offset = 0
+    for i in range(num_segments):
+        samples = segments[f"spike_indexes_seg{i}"].astype(np.int64)
+        labels = segments[f"spike_labels_seg{i}"]
+        spike_samples.append(samples + offset)
+        spike_units.append(order[np.searchsorted(unit_ids, labels, sorter=order)].astype(np.int32))
+        # Segments durations are not exported, each lasts up to its last spike
+        offset += int(samples.max()) + 1 if len(samples) > 0 else 0
+    spike_samples = np.concatenate(spike_samples) if num_segments > 0 else np.zeros(0, dtype=np.int64)
+    spike_units = np.concatenate(spike_units) if num_segments > 0 else np.zeros(0, dtype=np.int32)
+    by_unit = np.lexsort((spike_samples, spike_units))
+    return {
+        "unit_ids": unit_ids,
+        "sampling_frequency": float(header["sampling_frequency"][0]),
+        "num_samples": offset,
+        "spike_samples": spike_samples[by_unit],
+        "spike_units": spike_units[by_unit],
+    }
+
+
+def compute_unit_summary(sorting: dict, bin_size: float, isi_threshold_ms: float) -> dict:
+    """
+    Summary of each unit of a sorting: spike count, firing rate, ISI violation ratio (fraction of its
+    inter-spike intervals shorter than the threshold), and firing rate in bins of bin_size seconds.
+    Spikes are expected sorted by unit then time.
+    """
+    unit_ids = sorting["unit_ids"]
+    fs = sorting["sampling_frequency"]
+    spike_samples = sorting["spike_samples"]
+    spike_units = sorting["spike_units"]
+    num_units = len(unit_ids)
+    duration = sorting["num_samples"] / fs
+
+    spike_counts = np.bincount(spike_units, minlength=num_units)
+    firing_rates = spike_counts / duration if duration > 0 else np.zeros(num_units)
+
+    # Intervals between consecutive spikes of the same unit
+    same_unit = spike_units[1:] == spike_units[:-1]
+    violations = same_unit & (np.diff(spike_samples) < isi_threshold_ms * fs / 1000)
+    violation_counts = np.bincount(spike_units[1:][violations], minlength=num_units)
+    isi_counts = np.maximum(spike_counts - 1, 0)
+    isi_violation_ratios = np.divide(violation_counts, isi_counts, out=np.zeros(num_units), where=isi_counts > 0)
+
+    bin_samples = bin_size * fs
+    num_bins = max(int(np.ceil(sorting["num_samples"] / bin_samples)), 1)
+    if num_units * num_bins > settings.UNIT_SUMMARY_MAX_MATRIX_SIZE:
+        raise ValueError(f"Bin size too small: {num_units} units x {num_bins} bins, at most {settings.UNIT_SUMMARY_MAX_MATRIX_SIZE} values")
+    bins = np.minimum((spike_samples / bin_samples).astype(np.int64), num_bins - 1)
+    binned_counts = np.bincount(spike_units.astype(np.int64) * num_bins + bins, minlength=num_units * num_bins)
+    binned_rates = binned_counts.reshape(num_units, num_bins) / bin_size
+
+    return {
+        "unitIds": unit_ids.tolist(),
+        "samplingFrequency": fs,
+        "duration": duration,
+        "spikeCount": spike_counts.tolist(),
+        "firingRate": firing_rates.round(4).tolist(),
+        "isiViolationRatio": isi_violation_ratios.round(4).tolist(),
+        "isiThresholdMs": isi_threshold_ms,
+        "binSize": bin_size,
+        "binnedFiringRate": binned_rates.round(4).tolist(),
+    }
+
+
+class UnitSummaryCache:
+    """
+    Per-run cache of unit summaries. Exported sortings are read once, and their spike trains stored on disk,
+    sorted by unit, so that summaries at any resolution are computed from memory-mapped arrays.
+    The last summaries computed are also kept in memory.
+    """
+
+    def __init__(self, cache_dir: str, max_summaries: int = 16):
+        self.cache_dir = Path(cache_dir)
+        self.max_summaries = max_summaries
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_sorting_path(self, run_id: int, sorter_name: str) -> Path:
+        return self.cache_dir / str(run_id) / sorter_name
+
+    def load_sorting(self, run_id: int, sorter_name: str, open_exported_sorting) -> dict:
+        path = self.get_sorting_path(run_id, sorter_name)
+        if not (path / "meta.json").exists():
+            with open_exported_sorting() as fileobj:
+                sorting = read_exported_sorting(fileobj)
+            # Written to a temporary folder first, so that readers never see a partial sorting
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.mkdir(parents=True, exist_ok=True)
+            np.save(tmp_path / "unit_ids.npy", sorting["unit_ids"])
+            np.save(tmp_path / "spike_samples.npy", sorting["spike_samples"])
+            np.save(tmp_path / "spike_units.npy", sorting["spike_units"])
+            (tmp_path / "meta.json").write_text(json.dumps({
+                "sampling_frequency": sorting["sampling_frequency"],
+                "num_samples": sorting["num_samples"],
+            }))
+            try:
+                os.replace(tmp_path, path)
+            except OSError:
+                # Already stored by another request
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        meta = json.loads((path / "meta.json").read_text())
+        return {
+            "unit_ids": np.load(path / "unit_ids.npy"),
+            "sampling_frequency": meta["sampling_frequency"],
+            "num_samples": meta["num_samples"],
+            "spike_samples": np.load(path / "spike_samples.npy", mmap_mode="r"),
+            "spike_units": np.load(path / "spike_units.npy", mmap_mode="r"),
+        }
+
+    def get_summary_json(self, run_id: int, sorter_name: str, open_exported_sorting, bin_size: float, isi_threshold_ms: float) -> bytes:
+        # Kept encoded, as encoding large firing rate matrices takes longer than computing them
+        key = (run_id, sorter_name, bin_size, isi_threshold_ms)
+        with self._lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+                return self._summaries[key]
+        sorting = self.load_sorting(run_id, sorter_name, open_exported_sorting)
+        summary = json.dumps(compute_unit_summary(sorting, bin_size=bin_size, isi_threshold_ms=isi_threshold_ms)).encode("utf-8")
+        with self._lock:
+            self._summaries[key] = summary
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+        return summary
+
+
+# Exported by the worker, then uploaded to S3 under the output path, with the same path
+EXPORTED_SORTING_FILE_NAME = "sorting_cached.npz"
+
+
+def get_exported_sorting_path(run_identifier: str, sorter_name: str) -> str:
+    return f"/results/sorting/{run_identifier}_{sorter_name}/sorter_exported/{EXPORTED_SORTING_FILE_NAME}"
+
+
+def open_exported_sorting(run_identifier: str, sorter_name: str, output_destination: str, output_path: str):
+    path = get_exported_sorting_path(run_identifier, sorter_name)
+    if output_destination == "s3":
+        output_path_parsed = output_path.split("s3://")[-1]
+        bucket_name, _, bucket_folder = output_path_parsed.partition("/")
+        s3_url = f"s3://{bucket_name}/{bucket_folder}{path}"
+        return RangedRemoteFile(AWSClient().get_presigned_url(s3_url))
+    if output_destination == "local" and settings.SORTING_RESULTS_LOCAL_DIR:
+        return open(Path(settings.SORTING_RESULTS_LOCAL_DIR) / path.removeprefix("/results/"), "rb")
+    raise ValueError(f"Exported sorting not available for output destination: {output_destination}")
+
+
+_unit_summary_cache = None
+
+
+def get_unit_summary_cache() -> UnitSummaryCache:
+    global _unit_summary_cache
+    if _unit_summary_cache is None:
+        _unit_summary_cache = UnitSummaryCache(cache_dir=settings.UNIT_SUMMARY_CACHE_DIR)
+    return _unit_summary_cache
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+
+from core.logger import logger
+from core.settings import settings
+from clients.database import DatabaseClient
+from clients.dandi import DandiClient
+from clients.local_worker import LocalWorkerClient
+
+
+# Worker of the deployments where no worker registers itself
+DEFAULT_WORKER_ENDPOINT = "http://worker:5000/worker"
+
+
+class NoWorkerAvailableError(Exception):
+    pass
+
+
+def get_heartbeat_time(now: datetime = None) -> str:
+    # Stored as ISO strings, which compare in the same order as the times
+    return (now or datetime.now(tz=timezone.utc)).isoformat(timespec="seconds")
+
+
+def get_alive_since() -> str:
+    # Workers without a heartbeat since then are considered gone
+    return get_heartbeat_time(datetime.now(tz=timezone.utc) - timedelta(seconds=settings.WORKER_HEARTBEAT_TIMEOUT))
+
+
+def dispatch_local_run(db_client: DatabaseClient, run_identifier: str, payload: dict) -> str:
+    """
+    Send a local run to the least loaded eligible worker, recorded as the owner of the run.
+    Without any registered worker, runs are sent to the default worker.
+
+    Returns:
+        str: The endpoint of the worker the run was sent to.
+    """
+    worker = db_client.claim_worker(
+        run_identifier=run_identifier,
+        alive_since=get_alive_since(),
+        min_free_disk=settings.WORKER_MIN_FREE_DISK,
+        min_free_memory=settings.WORKER_MIN_FREE_MEMORY,
+    )
+    if worker is None:
+        if len(db_client.get_workers()) > 0:
+            raise NoWorkerAvailableError(f"No worker available for run: {run_identifier}")
+        endpoint = DEFAULT_WORKER_ENDPOINT
+    else:
+        endpoint = worker.endpoint
+        logger.info(f"Dispatching run {run_identifier} to worker {worker.name}")
+    LocalWorkerClient(endpoint=endpoint).run_sorting(**payload)
+    return endpoint
+
+
+def get_run_payload(run) -> dict:
+    """
+    Sorting payload of an active run, from its stored metadata, to dispatch it again.
+    Files of bulk submissions from a dandiset are stored by path, and resolved to their URL again.
+    """
+    payload = dict(run.metadata)
+    payload["run_identifier"] = run.identifier
+    source_data_paths = payload.get("source_data_paths") or dict()
+    if payload.get("source") == "dandi" and "file" not in source_data_paths and "dandiset_id" in source_data_paths:
+        file_url = DandiClient(token=settings.DANDI_API_KEY).get_file_url(
+            dandiset_id=source_data_paths["dandiset_id"],
+            file_path=source_data_paths["path"],
+            version_id=source_data_paths.get("version_id", "draft"),
+        )
+        payload["source_data_paths"] = {"file": file_url}
+    return payload
+
+
+def is_worker_lost(run, alive_since: str) -> bool:
+    # Runs of registered workers whose heartbeats stopped
+    return run.worker_id is not None and (run.worker_last_heartbeat is None or run.worker_last_heartbeat < alive_since)
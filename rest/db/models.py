@@ -1,7 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Enum
+from sqlalchemy import create_engine, Column, Integer, BigInteger, Float, String, ForeignKey, Enum, Computed, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
+from db.types import JSONDocument
+
 
 Base = declarative_base()
 
@@ -24,12 +26,16 @@ class DataSource(Base):
     description = Column(String)
     source = Column(Enum('dandi', 's3', 'local', name='source'))
     source_data_type = Column(Enum('nwb', 'spikeglx', name='source_data_type'))
-    source_data_paths = Column(String)
-    recording_kwargs = Column(String)
+    source_data_paths = Column(JSONDocument)
+    recording_kwargs = Column(JSONDocument)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User', back_populates='data_sources')
     runs = relationship('Run', back_populates='data_source', cascade='all, delete-orphan')
 
+    __table_args__ = (
+        Index('ix_data_source_source_data_paths', 'source_data_paths', postgresql_using='gin'),
+    )
+
     def update(self, key, value):
         setattr(self, key, value)
 
@@ -38,18 +44,130 @@ class Run(Base):
     __tablename__ = 'run'
     id = Column(Integer, primary_key=True)
     run_at = Column(Enum('local', 'aws', name='run_at'))
-    identifier = Column(String)
+    identifier = Column(String, index=True)
     description = Column(String)
     last_run = Column(String)
-    status = Column(Enum('running', 'success', 'fail', name='status'))
+    status = Column(Enum('running', 'success', 'fail', name='status'), index=True)
     data_source_id = Column(Integer, ForeignKey('data_source.id'))
     data_source = relationship('DataSource', back_populates='runs')
-    user_id = Column(Integer, ForeignKey('user.id'))
+    user_id = Column(Integer, ForeignKey('user.id'), index=True)
     user = relationship('User', back_populates='runs')
-    metadata_ = Column("metadata", String)
+    metadata_ = Column("metadata", JSONDocument)
+    # Generated from the metadata, to filter runs by sorter, dandiset or asset
+    sorters = Column(JSONDocument, Computed("metadata -> 'sorters_names_list'", persisted=True))
+    dandiset_id = Column(String, Computed("metadata -> 'source_data_paths' ->> 'dandiset_id'", persisted=True), index=True)
+    asset_path = Column(String, Computed("metadata -> 'source_data_paths' ->> 'path'", persisted=True), index=True)
     logs = Column(String)
+    progress = Column(String)
+    job_id = Column(String)
+    logs_cursor = Column(String)
+    log_chunks = relationship('RunLogChunk', back_populates='run', cascade='all, delete-orphan')
     output_destination = Column(String)
     output_path = Column(String)
+    group_id = Column(Integer, ForeignKey('run_group.id'), index=True)
+    group = relationship('RunGroup', back_populates='runs')
+    # Local runs: the worker the run was dispatched to, and how many times it was (re-)dispatched
+    worker_id = Column(Integer, ForeignKey('worker.id'), index=True)
+    worker = relationship('Worker', back_populates='runs')
+    dispatch_count = Column(Integer, default=0)
+    # Fingerprints of the sorters run by this run, by sorter name, indexed as reusable results once it succeeds
+    result_fingerprints = Column(String)
+    sorting_results = relationship('SortingResult', back_populates='run', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        Index('ix_run_metadata', 'metadata', postgresql_using='gin'),
+        Index('ix_run_sorters', 'sorters', postgresql_using='gin'),
+    )
 
     def update(self, key, value):
-        setattr(self, key, value)
\ No newline at end of file
+        setattr(self, key, value)
+
+
+class RunGroup(Base):
+    """
+    A group of runs submitted together by a bulk submission, e.g. one run per NWB file of a dandiset,
+    so that the progress of the whole batch can be tracked. Parameter sweeps are submitted as a single
+    AWS Batch array job, whose id is stored on the group, and each child job on its own run.
+    """
+    __tablename__ = 'run_group'
+    id = Column(Integer, primary_key=True)
+    identifier = Column(String, index=True)
+    description = Column(String)
+    created_at = Column(String)
+    user_id = Column(Integer, ForeignKey('user.id'))
+    job_id = Column(String)
+    sweep_grid_url = Column(String)
+    runs = relationship('Run', back_populates='group')
+
+    def update(self, key, value):
+        setattr(self, key, value)
+
+
+class Worker(Base):
+    """
+    A local sorting worker, registered by its heartbeats, with the resources it last reported.
+    Local runs are dispatched to the least loaded worker with a recent heartbeat.
+    """
+    __tablename__ = 'worker'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, index=True)
+    endpoint = Column(String)
+    cpu_count = Column(Integer)
+    free_cores = Column(Float)
+    total_memory = Column(BigInteger)
+    free_memory = Column(BigInteger)
+    free_disk = Column(BigInteger)
+    queue_depth = Column(Integer)
+    last_heartbeat = Column(String)
+    runs = relationship('Run', back_populates='worker')
+
+
+class SortingResult(Base):
+    """
+    A sorter output of a successful run, indexed by the fingerprint of its input, preprocessing and sorter
+    parameters, so that identical submissions link to it instead of sorting again.
+    """
+    __tablename__ = 'sorting_result'
+    id = Column(Integer, primary_key=True)
+    fingerprint = Column(String, unique=True, index=True)
+    sorter_name = Column(String)
+    run_id = Column(Integer, ForeignKey('run.id'), index=True)
+    run = relationship('Run', back_populates='sorting_results')
+    created_at = Column(String)
+
+
+class RunLogChunk(Base):
+    """
+    A chunk of consecutive log lines of a run. Logs are ingested incrementally and appended to the last chunk
+    until it is full, so that ingestion cost follows the new lines and any range of lines (or bytes) can be read
+    without loading the full logs.
+    """
+    __tablename__ = 'run_log_chunk'
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey('run.id'), index=True)
+    run = relationship('Run', back_populates='log_chunks')
+    first_line = Column(Integer)
+    line_count = Column(Integer)
+    first_byte = Column(Integer)
+    byte_count = Column(Integer)
+    content = Column(String)
+
+
+class DandisetMetadataVersion(Base):
+    """
+    A version of the metadata of a dandiset, written as soon as it is fetched from DANDI. Versions are append-only,
+    and the latest version of each dandiset makes up the snapshot served by the dandisets index. A NULL metadata
+    marks a dandiset removed from the index.
+    """
+    __tablename__ = 'dandiset_metadata_version'
+    id = Column(Integer, primary_key=True)
+    dandiset_id = Column(String, index=True)
+    modified = Column(String)
+    metadata_ = Column("metadata", String)
+
+
+class DandisetsSync(Base):
+    __tablename__ = 'dandisets_sync'
+    id = Column(Integer, primary_key=True)
+    last_modified = Column(String)
+    synced_at = Column(String)
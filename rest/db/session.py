@@ -0,0 +1,99 @@
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
+from typing import AsyncIterator, Iterator
+
+from core.settings import settings
+
+
+# Process-wide engines, each one holding its own connection pool
+_engines = dict()
+_async_engines = dict()
+
+
+def get_engine_kwargs(connection_string: str) -> dict:
+    if connection_string.startswith("sqlite"):
+        return dict()
+    return dict(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+
+def get_async_connection_string(connection_string: str) -> str:
+    # Any driver (or none) of a backend is swapped for its async driver, e.g. postgres:// or postgresql+psycopg2://
+    url = make_url(connection_string)
+    if url.get_backend_name() == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    elif url.get_backend_name() in ("postgresql", "postgres"):
+        url = url.set(drivername="postgresql+asyncpg")
+    return url.render_as_string(hide_password=False)
+
+
+def get_engine(connection_string: str = None) -> Engine:
+    """
+    Get the application-scoped engine for a connection string, creating it on first use.
+    """
+    connection_string = connection_string or settings.DB_CONNECTION_STRING
+    if connection_string not in _engines:
+        _engines[connection_string] = create_engine(connection_string, **get_engine_kwargs(connection_string))
+    return _engines[connection_string]
+
+
+def get_async_engine(connection_string: str = None) -> AsyncEngine:
+    """
+    Get the application-scoped async engine (asyncpg) for a connection string, creating it on first use.
+    """
+    connection_string = get_async_connection_string(connection_string or settings.DB_CONNECTION_STRING)
+    if connection_string not in _async_engines:
+        _async_engines[connection_string] = create_async_engine(connection_string, **get_engine_kwargs(connection_string))
+    return _async_engines[connection_string]
+
+
+def get_sessionmaker(connection_string: str = None) -> sessionmaker:
+    return sessionmaker(bind=get_engine(connection_string), expire_on_commit=False)
+
+
+def get_async_sessionmaker(connection_string: str = None) -> async_sessionmaker:
+    return async_sessionmaker(bind=get_async_engine(connection_string), expire_on_commit=False)
+
+
+def get_db_session() -> Iterator[Session]:
+    """
+    FastAPI dependency yielding a session from the pooled engine.
+    """
+    session = get_sessionmaker()()
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+async def get_async_db_session() -> AsyncIterator[AsyncSession]:
+    """
+    FastAPI dependency yielding an async session from the pooled async engine.
+    """
+    async with get_async_sessionmaker()() as session:
+        try:
+            yield session
+            await session.commit()
+        except:
+            await session.rollback()
+            raise
+
+
+async def dispose_engines() -> None:
+    for engine in _engines.values():
+        engine.dispose()
+    for engine in _async_engines.values():
+        await engine.dispose()
+    _engines.clear()
+    _async_engines.clear()
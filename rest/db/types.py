@@ -0,0 +1,33 @@
+from sqlalchemy import JSON, Boolean, String, cast
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+
+# JSON documents, stored as JSONB on PostgreSQL, so that they can be indexed and queried by their content
+JSONDocument = JSON().with_variant(JSONB(), "postgresql")
+
+
+class json_array_contains(FunctionElement):
+    """
+    Whether a JSON array column contains a value, e.g. json_array_contains(Run.sorters, "kilosort3").
+    On PostgreSQL, it is a containment query (@>), which GIN indexes of the column serve.
+    """
+    type = Boolean()
+    name = "json_array_contains"
+    inherit_cache = True
+
+    def __init__(self, column, value):
+        super().__init__(column, cast(value, String))
+
+
+@compiles(json_array_contains, "postgresql")
+def compile_json_array_contains_postgresql(element, compiler, **kw):
+    column, value = element.clauses
+    return f"{compiler.process(column, **kw)} @> jsonb_build_array({compiler.process(value, **kw)})"
+
+
+@compiles(json_array_contains)
+def compile_json_array_contains(element, compiler, **kw):
+    column, value = element.clauses
+    return f"EXISTS (SELECT 1 FROM json_each({compiler.process(column, **kw)}) WHERE json_each.value = {compiler.process(value, **kw)})"
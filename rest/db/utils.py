@@ -1,12 +1,16 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Enum, inspect
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Enum, JSON, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.schema import CreateColumn
+import ast
+import json
 
-from db.models import Base, User, DataSource, Run
+from db.models import Base, User, DataSource, Run, RunGroup, RunLogChunk, Worker, SortingResult
+from db.session import get_engine
 
 
 def initialize_db(db: str):
-    engine = create_engine(db)
+    engine = get_engine(db)
     existing_tables = inspect(engine).get_table_names()
 
     print("############  existing tables  ############")
@@ -32,11 +36,91 @@ def initialize_db(db: str):
         Session = sessionmaker(bind=engine)
         with Session.begin() as session:
             session.add(admin_user)
+    else:
+        # Create tables introduced after the database was first created
+        Base.metadata.create_all(engine)
+        migrate_json_columns(engine)
+        add_missing_columns(engine)
+        add_missing_indexes(engine)
+
+
+def add_missing_columns(engine):
+    # Add columns introduced after the tables were first created
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = [c["name"] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    print(f"Adding column {table.name}.{column.name}")
+                    column_spec = str(CreateColumn(column).compile(dialect=engine.dialect))
+                    if column.computed is not None and engine.dialect.name == "sqlite":
+                        # SQLite only adds virtual generated columns to existing tables
+                        column_spec = column_spec.replace(" STORED", " VIRTUAL")
+                    connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column_spec}'))
+
+
+# Columns first stored as text, now JSON documents
+JSON_COLUMNS = [("run", "metadata"), ("data_source", "source_data_paths"), ("data_source", "recording_kwargs")]
+
+
+def parse_legacy_json(value):
+    # Stored as JSON, or as the repr of a Python dict
+    if value is None:
+        return None
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return None
+
+
+def migrate_json_columns(engine, batch_size: int = 1000):
+    """
+    Convert the text columns of JSON documents to JSON (JSONB on PostgreSQL), rewriting the values stored as
+    the repr of Python dicts as JSON first. Values that can not be parsed are cleared.
+    SQLite columns keep their declared type, their values only are rewritten.
+
+    Runs from a DANDI file submitted before the dandiset and path were stored only have the (content-addressed)
+    URL of the file, which does not identify them: their dandiset_id and asset_path columns stay NULL, so that
+    the dandiset and asset filters do not match them.
+    """
+    inspector = inspect(engine)
+    for table_name, column_name in JSON_COLUMNS:
+        column_types = {c["name"]: c["type"] for c in inspector.get_columns(table_name)}
+        if column_name not in column_types or isinstance(column_types[column_name], JSON):
+            continue
+        print(f"Migrating column {table_name}.{column_name} to JSON")
+        with engine.begin() as connection:
+            rows = connection.execute(text(f'SELECT id, "{column_name}" FROM "{table_name}" WHERE "{column_name}" IS NOT NULL')).all()
+            updates = list()
+            for row_id, value in rows:
+                parsed = parse_legacy_json(value)
+                migrated = json.dumps(parsed) if parsed is not None else None
+                if migrated != value:
+                    updates.append({"id": row_id, "value": migrated})
+            for i in range(0, len(updates), batch_size):
+                connection.execute(text(f'UPDATE "{table_name}" SET "{column_name}" = :value WHERE id = :id'), updates[i:i + batch_size])
+            if engine.dialect.name == "postgresql":
+                connection.execute(text(f'ALTER TABLE "{table_name}" ALTER COLUMN "{column_name}" TYPE JSONB USING "{column_name}"::jsonb'))
+
+
+def add_missing_indexes(engine):
+    # Create indexes introduced after the tables were first created
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
 
 def run_clear_db(db: str):
     # Check if the user table exists
     engine = create_engine(db)
+    RunLogChunk.__table__.drop(engine, checkfirst=True)
+    SortingResult.__table__.drop(engine, checkfirst=True)
     Run.__table__.drop(engine)
+    RunGroup.__table__.drop(engine, checkfirst=True)
+    Worker.__table__.drop(engine, checkfirst=True)
     DataSource.__table__.drop(engine)
-    User.__table__.drop(engine)
\ No newline at end of file
+    User.__table__.drop(engine)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List
 from enum import Enum
 
 
@@ -40,4 +40,26 @@ class SortingData(BaseModel):
     test_with_toy_recording: bool = None
     test_with_subrecording: bool = None
     test_subrecording_n_frames: int = None
-    log_to_file: bool = None
\ No newline at end of file
+    log_to_file: bool = None
+    # Link to the results of identical jobs already completed, and only run the sorters without any
+    reuse_results: bool = True
+
+class BulkSortingData(BaseModel):
+    # Settings shared by all runs. Their source data paths are expanded from the dandiset or the S3 prefix
+    sorting: SortingData
+    dandiset_id: str = None
+    version_id: str = "draft"
+    s3_prefix: str = None
+    glob: str = None
+    group_identifier: str = None
+    group_description: str = None
+
+
+
+class SweepSortingData(BaseModel):
+    # Settings shared by all runs, and grid of sorters kwargs to sweep: {sorter_name: {param: [values]}}.
+    # Each combination is merged into the shared sorters_kwargs
+    sorting: SortingData
+    sorters_kwargs_grid: Dict[str, Dict[str, list]]
+    group_identifier: str = None
+    group_description: str = None
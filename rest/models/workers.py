@@ -0,0 +1,13 @@
+from pydantic import BaseModel
+
+
+class WorkerHeartbeat(BaseModel):
+    # Resources of a local worker, sent periodically. Sizes are in bytes
+    name: str
+    endpoint: str
+    cpu_count: int = None
+    free_cores: float = None
+    total_memory: int = None
+    free_memory: int = None
+    free_disk: int = None
+    queue_depth: int = 0
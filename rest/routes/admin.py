@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from core.block_cache import get_nwb_block_cache
+
+
+router = APIRouter()
+
+
+@router.get("/cache-stats", response_description="Get NWB cache stats", tags=["admin"])
+def route_get_cache_stats() -> JSONResponse:
+    return JSONResponse({
+        "message": "Success",
+        "nwb_cache": get_nwb_block_cache().get_stats(),
+    })
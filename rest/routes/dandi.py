@@ -1,9 +1,13 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
-from typing import List
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
+from typing import List, Optional
+import hashlib
 
-from clients.dandi import DandiClient
+from clients.dandi import DandiClient, select_assets
+from clients.http import CircuitOpenError
+from clients.async_clients import AsyncClient
 from core.settings import settings
+from core.dandisets_index import dandisets_index
 
 
 router = APIRouter()
@@ -12,40 +16,99 @@ router = APIRouter()
 # TODO - proper input/output data models
 @router.get("/get-dandisets-labels", response_description="Get Dandisets Labels", tags=["dandi"])
 def route_get_dandisets_labels() -> JSONResponse:
-    try:
-        dandi_client = DandiClient(token=settings.DANDI_API_KEY)
-        labels = sorted(dandi_client.get_all_dandisets_labels())
-    except Exception as e:
-        raise HTTPException(status_code=500, detail="Internal server error")
-    return JSONResponse(content={"labels": labels})
+    # Labels are kept sorted in memory by the dandisets index
+    return JSONResponse(content={"labels": dandisets_index.get_labels()})
+
+
+@router.get("/search-dandisets", response_description="Search Dandisets", tags=["dandi"])
+def route_search_dandisets(
+    search: Optional[str] = None,
+    species: Optional[str] = None,
+    modality: Optional[str] = None,
+    min_size: Optional[int] = Query(default=None, ge=0),
+    max_size: Optional[int] = Query(default=None, ge=0),
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=50, ge=1, le=1000),
+) -> JSONResponse:
+    results = dandisets_index.search(
+        search=search,
+        species=species,
+        modality=modality,
+        min_size=min_size,
+        max_size=max_size,
+        offset=offset,
+        limit=limit,
+    )
+    return JSONResponse(content=results)
 
 
 # TODO - proper input/output data models
 @router.get("/get-dandiset-metadata", response_description="Get Dandisets Metadata", tags=["dandi"])
-def route_get_dandiset_metadata(dandiset_id: str) -> JSONResponse:
+async def route_get_dandiset_metadata(
+    dandiset_id: str, 
+    version_id: str = "draft",
+    limit: int = Query(default=1000, ge=1, le=10000),
+) -> JSONResponse:
     try:
-        dandi_client = DandiClient(token=settings.DANDI_API_KEY)
-        metadata = dandi_client.get_dandiset_metadata(dandiset_id)
+        dandi_client = AsyncClient(DandiClient(token=settings.DANDI_API_KEY), dependency="dandi")
+        metadata = await dandi_client.get_dandiset_metadata(dandiset_id, version_id)
         cleaned_metadata = {
             "name": metadata["name"],
             "url": metadata["url"],
             "description": metadata["description"],
         }
-        list_of_files = dandi_client.list_dandiset_files(dandiset_id)
+        # First page of files only, the following pages are available from /get-dandiset-assets
+        _, assets = await dandi_client.list_dandiset_assets(dandiset_id, version_id)
+        assets_page, total = select_assets(assets, limit=limit)
+        list_of_files = [a["path"] for a in assets_page]
+    except CircuitOpenError:
+        raise HTTPException(status_code=503, detail="DANDI API unavailable, retry later")
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+    return JSONResponse(content={"metadata": cleaned_metadata, "list_of_files": list_of_files, "total_files": total})
+
+
+@router.get("/get-dandiset-assets", response_description="Get Dandiset Assets", tags=["dandi"])
+async def route_get_dandiset_assets(
+    request: Request,
+    dandiset_id: str,
+    version_id: str = "draft",
+    prefix: Optional[str] = None,
+    glob: Optional[str] = None,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=100, ge=1, le=10000),
+) -> Response:
+    try:
+        dandi_client = AsyncClient(DandiClient(token=settings.DANDI_API_KEY), dependency="dandi")
+        modified, assets = await dandi_client.list_dandiset_assets(dandiset_id, version_id)
+    except CircuitOpenError:
+        raise HTTPException(status_code=503, detail="DANDI API unavailable, retry later")
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Internal server error")
-    return JSONResponse(content={"metadata": cleaned_metadata, "list_of_files": list_of_files})
+    # Pages change only with the dandiset version, so clients can revalidate them with If-None-Match
+    etag = '"' + hashlib.sha1(f"{dandiset_id}:{version_id}:{modified}:{prefix}:{glob}:{offset}:{limit}".encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache" if version_id == "draft" else "public, max-age=86400"}
+    if request.headers.get("if-none-match", None) == etag:
+        return Response(status_code=304, headers=headers)
+    assets_page, total = select_assets(assets, prefix=prefix, glob=glob, offset=offset, limit=limit)
+    return JSONResponse(
+        content={"assets": assets_page, "total": total, "offset": offset, "limit": limit},
+        headers=headers,
+    )
 
 
 # TODO - proper input/output data models
 @router.get("/get-nwbfile-info", response_description="Get NWB file Info", tags=["dandi"])
-async def route_get_nwbfile_info(dandiset_id: str, file_path: str) -> JSONResponse:
+async def route_get_nwbfile_info(dandiset_id: str, file_path: str, version_id: str = "draft") -> JSONResponse:
     try:
-        dandi_client = DandiClient(token=settings.DANDI_API_KEY)
-        # file_info = dandi_client.get_nwbfile_info_ros3(dandiset_id, file_path)
-        file_info = dandi_client.get_nwbfile_info_fsspec(dandiset_id, file_path)
+        # Remote reads have their own limit, so that slow files do not hold up the other DANDI requests
+        dandi_client = AsyncClient(DandiClient(token=settings.DANDI_API_KEY), dependency="nwb")
+        file_info = await dandi_client.get_nwbfile_info_h5py(dandiset_id, file_path, version_id)
+    except CircuitOpenError:
+        raise HTTPException(status_code=503, detail="DANDI API unavailable, retry later")
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Internal server error")
-    return JSONResponse(content={"file_info": file_info})
\ No newline at end of file
+    return JSONResponse(content={"file_info": file_info})
@@ -1,88 +1,211 @@
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Depends, Query, Header
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
+from typing import Optional, Literal
+import functools
+import requests
 
 from core.logger import logger
 from core.settings import settings
-from clients.database import DatabaseClient
-from clients.aws import AWSClient
-from clients.local_worker import LocalWorkerClient
+from clients.database import DatabaseClient, AsyncDatabaseClient
+from db.session import get_async_db_session
+from core.events import run_event_broker
+from clients.async_clients import run_in_dependency_pool
+from core.unit_summary import get_unit_summary_cache, open_exported_sorting
 
 
 router = APIRouter()
 
-map_aws_batch_status_to_rest_status = {
-    "SUBMITTED": "running",
-    "PENDING": "running",
-    "RUNNABLE": "running",
-    "STARTING": "running",
-    "RUNNING": "running",
-    "SUCCEEDED": "success",
-    "FAILED": "fail",
-}
-
-
-def get_run_info(run_id: str):
-    db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
-    run_info = db_client.get_run_info(run_id=run_id)
-    if run_info["status"] == "running":
-        # Get status and logs
-        logger.info(f"Getting run status and logs: {run_info['identifier']}")
-        try:
-            if run_info["run_at"] == "aws":
-                aws_client = AWSClient()
-                status, run_logs = aws_client.get_job_status_and_logs_by_name(job_name=f"sorting-{run_info['identifier']}", job_queue=settings.AWS_BATCH_JOB_QUEUE)
-                status = map_aws_batch_status_to_rest_status[status]
-                if status == "success":
-                    if "Error running sorter" in run_logs:
-                        status = "fail"
-            elif run_info["run_at"] == "local":
-                local_worker_client = LocalWorkerClient()
-                status, run_logs = local_worker_client.get_run_logs(run_identifier=run_info['identifier'])
-            else:
-                status = "running"
-                run_logs = "No logs for this run"
-        except Exception as e:
-            logger.exception(f"Error getting run logs: {run_info['identifier']}. {e}")
-            run_logs = f"Error getting run logs: {run_info['identifier']}. {e}"
-            status = "running"
-        run_info["status"] = status
-        db_client.update_run(run_identifier=run_info["identifier"], key="status", value=status)
-        db_client.update_run(run_identifier=run_info["identifier"], key="logs", value=run_logs)
-        run_info["logs"] = run_logs
-    return run_info
+# Number of log lines returned with the run info
+RUN_INFO_LOGS_TAIL_LINES = 1000
 
 
 @router.get("/list", response_description="Get runs", tags=["runs"])
-def route_get_runs_list() -> JSONResponse:
+async def route_get_runs_list(
+    status: Optional[str] = None,
+    run_at: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    data_source: Optional[str] = None,
+    group_id: Optional[int] = None,
+    sorter: Optional[str] = None,
+    dandiset_id: Optional[str] = None,
+    asset_path: Optional[str] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    include_logs: bool = False,
+    include_metadata: bool = False,
+    session: AsyncSession = Depends(get_async_db_session),
+) -> JSONResponse:
     logger.info("Getting runs list")
-    db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
-    user = db_client.get_user_info(username="admin")
-    runs = [
-        get_run_info(run_id=obj.id) for obj in db_client.query_runs_by_user(user_id=user.id)
-    ]
+    db_client = AsyncDatabaseClient(session=session)
+    user = await db_client.get_user_info(username="admin")
+    runs = await db_client.get_all_runs_info(
+        user_id=user.id,
+        status=status,
+        run_at=run_at,
+        date_from=date_from,
+        date_to=date_to,
+        data_source_name=data_source,
+        group_id=group_id,
+        sorter=sorter,
+        dandiset_id=dandiset_id,
+        asset_path=asset_path,
+        after_id=after_id,
+        limit=limit,
+        include_logs=include_logs,
+        include_metadata=include_metadata,
+    )
     return JSONResponse({
         "message": "Success",
-        "runs": runs
+        "runs": runs,
+        "next_after_id": runs[-1]["id"] if len(runs) == limit else None,
     })
 
 
 @router.get("/info", response_description="Get run", tags=["runs"])
-def route_get_run_info(run_id: str) -> JSONResponse:
+async def route_get_run_info(run_id: int, session: AsyncSession = Depends(get_async_db_session)) -> JSONResponse:
     logger.info(f"Getting run info: {run_id}")
-    run_info = get_run_info(run_id=run_id)
+    db_client = AsyncDatabaseClient(session=session)
+    run_info = await db_client.get_run_info(run_id=run_id, include_logs=False)
+    if run_info is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    # Full logs are available from /logs, by range
+    run_logs = await db_client.get_run_logs(run_id=run_id, tail=RUN_INFO_LOGS_TAIL_LINES)
+    run_info["logs"] = run_logs["logs"]
     return JSONResponse({
         "message": "Success",
         "run": run_info
     })
 
 
+@router.get("/group", response_description="Get run group progress", tags=["runs"])
+async def route_get_run_group(group_id: int, session: AsyncSession = Depends(get_async_db_session)) -> JSONResponse:
+    # Runs of the group are listed by /list, filtered by group_id
+    db_client = AsyncDatabaseClient(session=session)
+    group_info = await db_client.get_run_group_info(group_id=group_id)
+    if group_info is None:
+        raise HTTPException(status_code=404, detail="Run group not found")
+    return JSONResponse({
+        "message": "Success",
+        "group": group_info,
+    })
+
+
+@router.get("/units-summary", response_description="Get run units summary", tags=["runs"])
+async def route_get_run_units_summary(
+    run_id: int,
+    sorter_name: str,
+    bin_size: float = Query(default=1., gt=0),
+    isi_threshold_ms: float = Query(default=1.5, gt=0),
+    session: AsyncSession = Depends(get_async_db_session),
+) -> Response:
+    """
+    Get the summary of each unit found by a sorter of a finished run: spike count, firing rate, ISI violation ratio,
+    and firing rate in bins of bin_size seconds. Summaries are computed from the exported sorting, and cached.
+    """
+    logger.info(f"Getting run units summary: {run_id} {sorter_name}")
+    db_client = AsyncDatabaseClient(session=session)
+    run_info = await db_client.get_run_info(run_id=run_id, include_logs=False)
+    if run_info is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    if run_info["status"] != "success":
+        raise HTTPException(status_code=400, detail="Run not finished successfully")
+    sorter_name = sorter_name.lower().strip()
+    # Metadata of legacy runs might not be parseable, and is then NULL
+    metadata = run_info["metadata"] or dict()
+    # Sorters run by the run, and sorters whose results it reused from another run
+    if "sorters_names_list" not in metadata and "reused_results" not in metadata:
+        raise HTTPException(status_code=409, detail="Sorters of the run unknown")
+    sorters_names = (metadata.get("sorters_names_list") or list()) + [r["sorterName"] for r in metadata.get("reused_results", [])]
+    if sorter_name not in [s.lower().strip() for s in sorters_names]:
+        raise HTTPException(status_code=404, detail="Sorter not found in run")
+    source = {
+        "run_id": run_id,
+        "run_identifier": run_info["identifier"],
+        "output_destination": metadata.get("output_destination"),
+        "output_path": run_info["outputPath"],
+    }
+    # Results reused from another run are read from that run
+    for result in metadata.get("reused_results", []):
+        if result["sorterName"] == sorter_name:
+            source = {
+                "run_id": result["runId"],
+                "run_identifier": result["runIdentifier"],
+                "output_destination": result["outputDestination"],
+                "output_path": result["outputPath"],
+            }
+    try:
+        summary = await run_in_dependency_pool(
+            "unit_summary",
+            get_unit_summary_cache().get_summary_json,
+            run_id=source["run_id"],
+            sorter_name=sorter_name,
+            open_exported_sorting=functools.partial(
+                open_exported_sorting,
+                run_identifier=source["run_identifier"],
+                sorter_name=sorter_name,
+                output_destination=source["output_destination"],
+                output_path=source["output_path"],
+            ),
+            bin_size=bin_size,
+            isi_threshold_ms=isi_threshold_ms,
+        )
+    except (FileNotFoundError, requests.HTTPError) as e:
+        logger.info(f"Exported sorting not found: {run_id} {sorter_name}. {e}")
+        raise HTTPException(status_code=404, detail="Exported sorting not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=b'{"message": "Success", "summary": ' + summary + b'}', media_type="application/json")
+
+
+@router.get("/logs", response_description="Get run logs", tags=["runs"])
+async def route_get_run_logs(
+    run_id: int,
+    start: Optional[int] = Query(default=None, ge=0),
+    end: Optional[int] = Query(default=None, ge=0),
+    tail: Optional[int] = Query(default=None, ge=0),
+    unit: Literal["lines", "bytes"] = "lines",
+    session: AsyncSession = Depends(get_async_db_session),
+) -> JSONResponse:
+    """
+    Get the range [start, end) of the run logs, in lines or bytes, or only its last tail lines (or bytes).
+    Pass the returned end as start to only get the logs written since.
+    """
+    logger.info(f"Getting run logs: {run_id}")
+    db_client = AsyncDatabaseClient(session=session)
+    run_logs = await db_client.get_run_logs(run_id=run_id, start=start, end=end, tail=tail, unit=unit)
+    return JSONResponse({
+        "message": "Success",
+        **run_logs
+    })
+
+
+@router.get("/events", response_description="Stream runs events", tags=["runs"])
+async def route_get_runs_events(
+    last_event_id: Optional[str] = None,
+    last_event_id_header: Optional[str] = Header(default=None, alias="Last-Event-ID"),
+) -> StreamingResponse:
+    """
+    Server-Sent Events stream of run changes: "run" (status and progress), "logs" (new log lines),
+    "run_created", "run_deleted", and "reset" when the client can not be resumed and should reload the runs.
+    Browsers resume from the last received event automatically, with the Last-Event-ID header.
+    """
+    return StreamingResponse(
+        run_event_broker.stream(last_event_id=last_event_id_header or last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.delete("/{run_identifier}", response_description="Delete run", tags=["runs"])
 def route_delete_run(run_identifier: str) -> JSONResponse:
     logger.info(f"Deleting run: {run_identifier}")
     db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
-    response = db_client.delete_run(run_identifier=run_identifier)
-    if response:
+    run_id = db_client.delete_run(run_identifier=run_identifier)
+    if run_id:
+        run_event_broker.publish("run_deleted", {"id": run_id})
         return JSONResponse({
             "message": "Success"
         })  
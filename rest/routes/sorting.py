@@ -1,14 +1,24 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.responses import JSONResponse
 from datetime import datetime
+from typing import List
+import fnmatch
+import itertools
+import json
 
 from core.logger import logger
 from core.settings import settings
-from clients.dandi import DandiClient
+from clients.dandi import DandiClient, select_assets
 from clients.aws import AWSClient
-from clients.local_worker import LocalWorkerClient
-from clients.database import DatabaseClient
-from models.sorting import SortingData
+from clients.database import DatabaseClient, AsyncDatabaseClient
+from clients.async_clients import run_in_dependency_pool
+from db.session import get_async_db_session
+from core.events import run_event_broker
+from core.submitter import run_submitter
+from core.workers import dispatch_local_run
+from core.results_cache import get_source_digests, get_sorting_fingerprints
+from models.sorting import SortingData, BulkSortingData, SweepSortingData
 
 
 router = APIRouter()
@@ -21,67 +31,389 @@ def sorting_background_task(payload, run_identifier):
     try:
         logger.info(f"Run job at: {run_at}")
         if run_at == "local":
-            client_local_worker = LocalWorkerClient()
-            client_local_worker.run_sorting(**payload)
+            dispatch_local_run(db_client=db_client, run_identifier=run_identifier, payload=payload)
         elif run_at == "aws":
-            job_kwargs = {k.upper(): v for k, v in payload.items()}
-            job_kwargs["DANDI_API_KEY"] = settings.DANDI_API_KEY
             client_aws = AWSClient()
-            client_aws.submit_job(
-                job_name=f"sorting-{run_identifier}",
+            job_name = f"sorting-{run_identifier}"
+            job_kwargs = client_aws.put_job_spec(job_name=job_name, job_spec=payload)
+            job_kwargs["RUN_IDENTIFIER"] = run_identifier
+            job_kwargs["DANDI_API_KEY"] = settings.DANDI_API_KEY
+            response = client_aws.submit_job(
+                job_name=job_name,
                 job_queue=settings.AWS_BATCH_JOB_QUEUE,
                 job_definition=settings.AWS_BATCH_JOB_DEFINITION,
                 job_kwargs=job_kwargs,
             )
+            db_client.update_run(run_identifier=run_identifier, key="job_id", value=response["jobId"])
         db_client.update_run(run_identifier=run_identifier, key="status", value="running")
     except Exception as e:
         logger.exception(f"Error running sorting job: {run_identifier}.\n {e}")
-        db_client.update_run(run_identifier=run_identifier, key="status", value="fail")
+        mark_run_failed(db_client, run_identifier)
+
+
+def mark_run_failed(db_client: DatabaseClient, run_identifier: str) -> None:
+    run = db_client.update_run(run_identifier=run_identifier, key="status", value="fail")
+    if run:
+        run_event_broker.publish("run", {"id": run.id, "status": "fail"})
+
+
+def bulk_sorting_background_task(payload, run_identifier, data_source_id, dandi_asset=None):
+    # Dandiset files are resolved to their URL only when submitted, not to make one DANDI API call per run upfront
+    if dandi_asset is not None:
+        db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+        try:
+            dandi_client = DandiClient(token=settings.DANDI_API_KEY)
+            file_url = dandi_client.get_file_url(**dandi_asset)
+        except Exception as e:
+            logger.exception(f"Error resolving dandiset file of sorting job: {run_identifier}.\n {e}")
+            mark_run_failed(db_client, run_identifier)
+            return
+        # The dandiset and path are kept, to filter runs by them
+        payload = {**payload, "source_data_paths": {**payload["source_data_paths"], "file": file_url}}
+        db_client.update_data_source(data_source_id=data_source_id, key="source_data_paths", value=payload["source_data_paths"])
+    sorting_background_task(payload=payload, run_identifier=run_identifier)
+
+
+def expand_bulk_sources(data: BulkSortingData) -> List[dict]:
+    """
+    Expand a bulk submission into the source of each run: one per NWB file of the dandiset,
+    or one per NWB file (or SpikeGLX .bin and .meta pair) under the S3 prefix, matching the glob if given.
+    """
+    if (data.dandiset_id is None) == (data.s3_prefix is None):
+        raise ValueError("Either dandiset_id or s3_prefix should be given")
+    if data.dandiset_id is not None:
+        dandi_client = DandiClient(token=settings.DANDI_API_KEY)
+        _, assets = dandi_client.list_dandiset_assets(data.dandiset_id, data.version_id)
+        assets, _ = select_assets(assets, glob=data.glob)
+        return [
+            {
+                "source": "dandi",
+                "source_data_type": "nwb",
+                "source_data_paths": {"dandiset_id": data.dandiset_id, "version_id": data.version_id, "path": a["path"]},
+                "dandi_asset": {"dandiset_id": data.dandiset_id, "file_path": a["path"], "version_id": data.version_id},
+            }
+            for a in assets
+        ]
+    bucket_name, keys = AWSClient().list_s3_keys(data.s3_prefix)
+    if data.glob:
+        keys = [k for k in keys if fnmatch.fnmatchcase(k, data.glob)]
+    sources = list()
+    if data.sorting.source_data_type == "spikeglx":
+        keys_set = set(keys)
+        for key in sorted(keys):
+            meta_key = key[:-len(".bin")] + ".meta"
+            if key.endswith(".bin") and meta_key in keys_set:
+                sources.append({
+                    "source": "s3",
+                    "source_data_type": "spikeglx",
+                    "source_data_paths": {"file_bin": f"s3://{bucket_name}/{key}", "file_meta": f"s3://{bucket_name}/{meta_key}"},
+                })
+    else:
+        for key in sorted(keys):
+            if key.endswith(".nwb"):
+                sources.append({
+                    "source": "s3",
+                    "source_data_type": "nwb",
+                    "source_data_paths": {"file": f"s3://{bucket_name}/{key}"},
+                })
+    return sources
+
+
+async def get_reusable_results(db_client: AsyncDatabaseClient, data: SortingData):
+    """
+    Get the fingerprints of the sorters of a job, and the results already completed for any of them.
+
+    Returns:
+        Tuple: The fingerprint of each sorter, and the reusable result of each sorter with one, by sorter name.
+    """
+    try:
+        digests = await run_in_dependency_pool("aws", get_source_digests, data.source_data_paths)
+    except Exception as e:
+        # Jobs whose source can not be identified are neither reused nor indexed
+        logger.warning(f"Error getting source digests, results will not be reused: {e}")
+        return dict(), dict()
+    fingerprints = get_sorting_fingerprints(data, digests=digests)
+    if not data.reuse_results or len(fingerprints) == 0:
+        return fingerprints, dict()
+    results = await db_client.get_sorting_results(list(fingerprints.values()))
+    return fingerprints, {s: results[f] for s, f in fingerprints.items() if f in results}
 
 
 @router.post("/run", response_description="Run Sorting", tags=["sorting"])
-async def route_run_sorting(data: SortingData, background_tasks: BackgroundTasks) -> JSONResponse:
+async def route_run_sorting(
+    data: SortingData, 
+    background_tasks: BackgroundTasks,
+    session: AsyncSession = Depends(get_async_db_session),
+) -> JSONResponse:
     if not data.run_identifier:
         run_identifier = datetime.now().strftime("%Y%m%d%H%M%S")
     else:
         run_identifier = data.run_identifier
     try:
         # Create Database entries
-        db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
-        user = db_client.get_user_info(username="admin")
-        data_source = db_client.create_data_source(
+        db_client = AsyncDatabaseClient(session=session)
+        user = await db_client.get_user_info(username="admin")
+
+        # Results of identical jobs already completed are linked to, and only the other sorters are run
+        fingerprints, reused_results = await get_reusable_results(db_client, data)
+        job_data = data.copy(update={
+            "sorters_names_list": [s for s in fingerprints if s not in reused_results] if len(reused_results) > 0 else data.sorters_names_list,
+        })
+        reuse_only = len(fingerprints) > 0 and len(reused_results) == len(fingerprints)
+        metadata = json.loads(job_data.json())
+        if len(reused_results) > 0:
+            metadata["reused_results"] = list(reused_results.values())
+        data_source = await db_client.create_data_source(
             name=data.run_identifier,
             description=data.run_description,
             user_id=user.id,
             source=data.source,
             source_data_type=data.source_data_type,
-            source_data_paths=str(data.source_data_paths),
-            recording_kwargs=str(data.recording_kwargs),
+            source_data_paths=data.source_data_paths,
+            recording_kwargs=data.recording_kwargs,
         )
-        run = db_client.create_run(
+        run = await db_client.create_run(
             run_at=data.run_at,
             identifier=run_identifier,
             description=data.run_description,
             last_run=datetime.now().strftime("%Y/%m/%d %H:%M:%S"),
-            status="running",
+            status="success" if reuse_only else "running",
             data_source_id=data_source.id,
             user_id=user.id,
-            metadata=str(data.json()),
+            metadata=metadata,
             output_destination=data.output_destination,
             output_path=data.output_path,
+            logs="\n".join(f"Results of {r['sorterName']} reused from run {r['runIdentifier']}" for r in reused_results.values()) if reuse_only else "",
+            result_fingerprints=json.dumps({s: f for s, f in fingerprints.items() if s not in reused_results}) if not reuse_only else None,
         )
 
+        run_event_broker.publish("run_created", {
+            "id": run.id,
+            "run_at": run.run_at,
+            "identifier": run.identifier,
+            "description": run.description,
+            "lastRun": run.last_run,
+            "status": run.status,
+            "dataSourceName": data_source.name,
+            "progress": None,
+            "outputPath": run.output_path,
+        })
+
         # Run sorting job
-        background_tasks.add_task(
-            sorting_background_task, 
-            payload=data.dict(), 
-            run_identifier=run_identifier
-        )
+        if not reuse_only:
+            background_tasks.add_task(
+                sorting_background_task, 
+                payload={**job_data.dict(), "run_identifier": run_identifier}, 
+                run_identifier=run_identifier
+            )
 
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Internal server error")
     return JSONResponse(content={
-        "message": "Sorting job submitted",
+        "message": "Sorting results reused" if reuse_only else "Sorting job submitted",
         "run_identifier": run.identifier,
-    })
\ No newline at end of file
+        "reused_results": list(reused_results.values()),
+    })
+
+
+
+def sweep_background_task(payload, group_id, group_identifier, grid):
+    # Store the grid once, and submit all the sweep runs as a single array job
+    db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+    runs = db_client.get_run_group_runs(group_id=group_id)
+    try:
+        sweep_grid_url = f"s3://{settings.SORTING_SWEEPS_S3_BUCKET}/sweeps/{group_identifier}.json"
+        client_aws = AWSClient()
+        client_aws.put_s3_json(sweep_grid_url, grid)
+        db_client.update_run_group(group_id=group_id, key="sweep_grid_url", value=sweep_grid_url)
+        job_name = f"sorting-{group_identifier}"
+        job_kwargs = client_aws.put_job_spec(job_name=job_name, job_spec=payload)
+        job_kwargs["RUN_IDENTIFIER"] = group_identifier
+        job_kwargs["SWEEP_GRID_URL"] = sweep_grid_url
+        job_kwargs["DANDI_API_KEY"] = settings.DANDI_API_KEY
+        response = client_aws.submit_job(
+            job_name=job_name,
+            job_queue=settings.AWS_BATCH_JOB_QUEUE,
+            job_definition=settings.AWS_BATCH_JOB_DEFINITION,
+            job_kwargs=job_kwargs,
+            array_size=len(grid),
+        )
+        db_client.update_run_group(group_id=group_id, key="job_id", value=response["jobId"])
+        # Child jobs are reconciled as any other job, by their own id
+        db_client.bulk_update_runs([
+            {"id": r.id, "job_id": f"{response['jobId']}:{i}"} for i, r in enumerate(runs)
+        ])
+    except Exception as e:
+        logger.exception(f"Error running sorting sweep: {group_identifier}.\n {e}")
+        db_client.bulk_update_runs([{"id": r.id, "status": "fail"} for r in runs])
+        for r in runs:
+            run_event_broker.publish("run", {"id": r.id, "status": "fail"})
+
+
+def expand_sorters_kwargs_grid(sorters_kwargs: dict, sorters_kwargs_grid: dict) -> List[dict]:
+    """
+    Expand a grid of sorters kwargs, {sorter_name: {param: [values]}}, into the sorters kwargs of each combination.
+    """
+    axes = [(sorter_name, param, values) for sorter_name, params in sorters_kwargs_grid.items() for param, values in params.items()]
+    grid = list()
+    for combination in itertools.product(*[values for _, _, values in axes]):
+        combination_kwargs = {k: dict(v) for k, v in (sorters_kwargs or dict()).items()}
+        for (sorter_name, param, _), value in zip(axes, combination):
+            combination_kwargs.setdefault(sorter_name, dict())[param] = value
+        grid.append(combination_kwargs)
+    return grid
+
+
+def create_group_runs(db_client: DatabaseClient, sorting: SortingData, group_identifier: str, group_description: str, runs_updates: List[dict]):
+    """
+    Create a group of runs in one transaction, each from the shared sorting settings updated with its own values,
+    and publish their creation.
+
+    Returns:
+        Tuple: The group, and the (run, data source, run data) of each run.
+    """
+    user = db_client.get_user_info(username="admin")
+    now = datetime.now()
+    runs = list()
+    runs_data = list()
+    for i, run_updates in enumerate(runs_updates):
+        run_identifier = f"{group_identifier}-{i:04d}"
+        run_data = sorting.copy(update={**run_updates, "run_identifier": run_identifier})
+        runs_data.append(run_data)
+        runs.append({
+            "data_source": {
+                "name": run_identifier,
+                "description": sorting.run_description,
+                "source": run_data.source,
+                "source_data_type": run_data.source_data_type,
+                "source_data_paths": run_data.source_data_paths,
+                "recording_kwargs": run_data.recording_kwargs,
+            },
+            "run": {
+                "run_at": run_data.run_at,
+                "identifier": run_identifier,
+                "description": sorting.run_description,
+                "last_run": now.strftime("%Y/%m/%d %H:%M:%S"),
+                "status": "running",
+                "metadata_": json.loads(run_data.json()),
+                "logs": "",
+                "output_destination": run_data.output_destination,
+                "output_path": run_data.output_path,
+            },
+        })
+    group, created = db_client.create_run_group(
+        identifier=group_identifier,
+        description=group_description,
+        created_at=now.strftime("%Y/%m/%d %H:%M:%S"),
+        user_id=user.id,
+        runs=runs,
+    )
+    for run, data_source in created:
+        run_event_broker.publish("run_created", {
+            "id": run.id,
+            "run_at": run.run_at,
+            "identifier": run.identifier,
+            "description": run.description,
+            "lastRun": run.last_run,
+            "status": run.status,
+            "dataSourceName": data_source.name,
+            "progress": None,
+            "outputPath": run.output_path,
+        })
+    return group, [(run, data_source, run_data) for (run, data_source), run_data in zip(created, runs_data)]
+
+
+@router.post("/run-bulk", response_description="Run Sorting in bulk", tags=["sorting"])
+async def route_run_sorting_bulk(data: BulkSortingData) -> JSONResponse:
+    group_identifier = data.group_identifier or datetime.now().strftime("%Y%m%d%H%M%S")
+    try:
+        sources = await run_in_dependency_pool("dandi" if data.dandiset_id is not None else "aws", expand_bulk_sources, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+    if len(sources) == 0:
+        raise HTTPException(status_code=400, detail="No source files found")
+    if len(sources) > settings.SORTING_BULK_MAX_RUNS:
+        raise HTTPException(status_code=400, detail=f"Too many runs: {len(sources)}, the maximum is {settings.SORTING_BULK_MAX_RUNS}")
+
+    try:
+        # Create all Database entries in one transaction
+        db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+        group, created = await run_in_dependency_pool(
+            "database",
+            create_group_runs,
+            db_client=db_client,
+            sorting=data.sorting,
+            group_identifier=group_identifier,
+            group_description=data.group_description,
+            runs_updates=[
+                {k: source[k] for k in ["source", "source_data_type", "source_data_paths"]}
+                for source in sources
+            ],
+        )
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+    # Run sorting jobs, throttled
+    for source, (run, data_source, run_data) in zip(sources, created):
+        run_submitter.submit(
+            bulk_sorting_background_task,
+            payload=run_data.dict(),
+            run_identifier=run.identifier,
+            data_source_id=data_source.id,
+            dandi_asset=source.get("dandi_asset", None),
+        )
+    return JSONResponse(content={
+        "message": "Sorting jobs submitted",
+        "group_id": group.id,
+        "group_identifier": group.identifier,
+        "run_identifiers": [run.identifier for run, _, _ in created],
+    })
+
+
+@router.post("/run-sweep", response_description="Run Sorting parameter sweep", tags=["sorting"])
+async def route_run_sorting_sweep(data: SweepSortingData) -> JSONResponse:
+    if data.sorting.run_at != "aws":
+        raise HTTPException(status_code=400, detail="Parameter sweeps run on AWS only")
+    grid = expand_sorters_kwargs_grid(data.sorting.sorters_kwargs, data.sorters_kwargs_grid)
+    # AWS Batch array jobs have 2 to 10000 children
+    if len(grid) < 2:
+        raise HTTPException(status_code=400, detail="A parameter sweep needs at least 2 combinations")
+    if len(grid) > min(settings.SORTING_SWEEP_MAX_SIZE, 10000):
+        raise HTTPException(status_code=400, detail=f"Too many combinations: {len(grid)}, the maximum is {min(settings.SORTING_SWEEP_MAX_SIZE, 10000)}")
+    group_identifier = data.group_identifier or datetime.now().strftime("%Y%m%d%H%M%S")
+
+    try:
+        # Create all Database entries in one transaction, one run per combination
+        db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+        group, created = await run_in_dependency_pool(
+            "database",
+            create_group_runs,
+            db_client=db_client,
+            sorting=data.sorting,
+            group_identifier=group_identifier,
+            group_description=data.group_description,
+            runs_updates=[{"sorters_kwargs": combination_kwargs} for combination_kwargs in grid],
+        )
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+    # Submit the sweep as a single array job
+    run_submitter.submit(
+        sweep_background_task,
+        payload=data.sorting.dict(),
+        group_id=group.id,
+        group_identifier=group.identifier,
+        grid=grid,
+    )
+    return JSONResponse(content={
+        "message": "Sorting sweep submitted",
+        "group_id": group.id,
+        "group_identifier": group.identifier,
+        "run_identifiers": [run.identifier for run, _, _ in created],
+    })
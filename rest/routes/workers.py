@@ -0,0 +1,46 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from core.settings import settings
+from clients.database import DatabaseClient
+from core.workers import get_heartbeat_time, get_alive_since
+from models.workers import WorkerHeartbeat
+
+
+router = APIRouter()
+
+
+@router.post("/heartbeat", response_description="Register worker heartbeat", tags=["workers"])
+def route_worker_heartbeat(data: WorkerHeartbeat) -> JSONResponse:
+    # Workers register themselves with their first heartbeat
+    db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+    worker = db_client.upsert_worker(**data.dict(), last_heartbeat=get_heartbeat_time())
+    return JSONResponse({
+        "message": "Success",
+        "worker_id": worker.id,
+    })
+
+
+@router.get("/list", response_description="Get workers", tags=["workers"])
+def route_get_workers_list() -> JSONResponse:
+    db_client = DatabaseClient(connection_string=settings.DB_CONNECTION_STRING)
+    alive_since = get_alive_since()
+    return JSONResponse({
+        "message": "Success",
+        "workers": [
+            {
+                "id": w.id,
+                "name": w.name,
+                "endpoint": w.endpoint,
+                "cpuCount": w.cpu_count,
+                "freeCores": w.free_cores,
+                "totalMemory": w.total_memory,
+                "freeMemory": w.free_memory,
+                "freeDisk": w.free_disk,
+                "queueDepth": w.queue_depth,
+                "lastHeartbeat": w.last_heartbeat,
+                "alive": w.last_heartbeat is not None and w.last_heartbeat >= alive_since,
+            }
+            for w in db_client.get_workers()
+        ],
+    })
@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Modules of the app are imported from the rest folder, as when it runs, with their caches out of the tree
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+_cache_dir = tempfile.mkdtemp(prefix="rest-tests-")
+os.environ.setdefault("NWB_CACHE_DIR", os.path.join(_cache_dir, "nwb-block-cache"))
+os.environ.setdefault("UNIT_SUMMARY_CACHE_DIR", os.path.join(_cache_dir, "unit-summary-cache"))
+
+from clients.database import DatabaseClient
+from db.models import Base
+
+
+@pytest.fixture
+def db_client(tmp_path):
+    db_client = DatabaseClient(connection_string=f"sqlite:///{tmp_path / 'test.db'}")
+    Base.metadata.create_all(db_client.engine)
+    return db_client
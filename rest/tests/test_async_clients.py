@@ -0,0 +1,68 @@
+import asyncio
+import threading
+
+import anyio
+import httpx
+import pytest
+
+import clients.async_clients
+from clients.dandi import DandiClient
+from core.settings import settings
+from main import app
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def slow_nwb_reads(monkeypatch):
+    # NWB reads block until released, at most one at a time, while DANDI listings answer right away
+    monkeypatch.setattr(settings, "NWB_READS_CONCURRENCY", 1)
+    monkeypatch.setattr(clients.async_clients, "_limiters", dict())
+    started = list()
+    release = threading.Event()
+
+    def get_nwbfile_info_h5py(self, dandiset_id, file_path, version_id="draft"):
+        started.append(file_path)
+        release.wait(timeout=10)
+        return {"file_path": file_path}
+
+    def list_dandiset_assets(self, dandiset_id, version_id="draft"):
+        return "2023-01-01T00:00:00Z", [{"path": "sub-1/sub-1_ecephys.nwb", "size": 1}]
+
+    monkeypatch.setattr(DandiClient, "get_nwbfile_info_h5py", get_nwbfile_info_h5py)
+    monkeypatch.setattr(DandiClient, "list_dandiset_assets", list_dandiset_assets)
+    yield started, release
+    release.set()
+
+
+async def wait_until(condition, timeout: float = 5):
+    with anyio.fail_after(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+
+@pytest.mark.anyio
+async def test_slow_dependency_does_not_block_other_routes(slow_nwb_reads):
+    started, release = slow_nwb_reads
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        nwb_params = {"dandiset_id": "000001", "version_id": "draft"}
+        first = asyncio.create_task(client.get("/api/dandi/get-nwbfile-info", params={**nwb_params, "file_path": "a.nwb"}))
+        second = asyncio.create_task(client.get("/api/dandi/get-nwbfile-info", params={**nwb_params, "file_path": "b.nwb"}))
+        await wait_until(lambda: len(started) == 1)
+
+        with anyio.fail_after(5):
+            response = await client.get("/api/dandi/get-dandiset-assets", params={"dandiset_id": "000001"})
+        assert response.status_code == 200
+        assert response.json()["total"] == 1
+        assert not first.done() and not second.done()
+        # The second read waits for a slot of the NWB reads pool
+        assert len(started) == 1
+
+        release.set()
+        responses = await asyncio.gather(first, second)
+        assert [r.status_code for r in responses] == [200, 200]
+        assert sorted(started) == ["a.nwb", "b.nwb"]
@@ -0,0 +1,62 @@
+import boto3
+import pytest
+from moto import mock_aws
+from moto.server import ThreadedMotoServer
+
+from clients.aws import AWSClient
+from core.settings import settings
+
+
+@pytest.fixture
+def moto_server(monkeypatch):
+    for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        monkeypatch.setenv(key, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+def test_aws_client_uses_endpoint_url(moto_server, monkeypatch):
+    monkeypatch.setattr(settings, "AWS_ENDPOINT_URL", moto_server)
+    monkeypatch.setattr(settings, "SORTING_LOGS_S3_BUCKET", "sorting-logs")
+    aws_client = AWSClient()
+    aws_client.client_s3.create_bucket(Bucket="sorting-logs")
+    aws_client.client_s3.put_object(Bucket="sorting-logs", Key="run-1.log", Body=b"line 1\nline 2\n")
+
+    assert aws_client.get_run_logs_s3("run-1") == "line 1\nline 2\n"
+    # Stored on the server at the endpoint
+    s3 = boto3.client("s3", endpoint_url=moto_server)
+    assert s3.get_object(Bucket="sorting-logs", Key="run-1.log")["Body"].read() == b"line 1\nline 2\n"
+
+
+@pytest.fixture
+def logs_bucket(monkeypatch):
+    for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        monkeypatch.setenv(key, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(settings, "SORTING_LOGS_S3_BUCKET", "sorting-logs")
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="sorting-logs")
+        s3.put_object(Bucket="sorting-logs", Key="run-1.log", Body=b"0123456789")
+        yield s3
+
+
+@pytest.mark.parametrize("kwargs, expected", [
+    (dict(), "0123456789"),
+    (dict(tail=3), "789"),
+    (dict(tail=20), "0123456789"),
+    (dict(start=2, end=5), "234"),
+    (dict(start=7), "789"),
+    (dict(end=2), "01"),
+    # Empty ranges, read without any request
+    (dict(tail=0), ""),
+    (dict(tail=-1), ""),
+    (dict(start=5, end=5), ""),
+    (dict(start=6, end=2), ""),
+])
+def test_get_run_logs_s3_ranges(logs_bucket, kwargs, expected):
+    assert AWSClient().get_run_logs_s3("run-1", **kwargs) == expected
@@ -0,0 +1,90 @@
+import io
+
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import core.unit_summary
+from clients.http import get_remote_file_size
+from core.block_cache import BlockDiskCache
+from core.unit_summary import RangedRemoteFile
+
+
+CONTENT = bytes(range(256)) * 40
+
+
+class FakeRemoteFile:
+    """Session serving CONTENT, honouring range requests or not, and keeping the responses it made"""
+
+    def __init__(self, ranges: bool = True, content_range_total: str = None):
+        self.ranges = ranges
+        self.content_range_total = content_range_total
+        self.responses = list()
+
+    def get(self, url, headers=None, stream=False, **kwargs):
+        response = requests.Response()
+        response.url = url
+        response.headers = CaseInsensitiveDict()
+        range_header = (headers or dict()).get("Range", None)
+        if self.ranges and range_header is not None:
+            start, end = (int(v) for v in range_header.removeprefix("bytes=").split("-"))
+            body = CONTENT[start:end + 1]
+            response.status_code = 206
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{self.content_range_total or len(CONTENT)}"
+        else:
+            body = CONTENT
+            response.status_code = 200
+        response.headers["Content-Length"] = str(len(body))
+        response.raw = io.BytesIO(body)
+        self.responses.append(response)
+        return response
+
+
+def test_remote_file_size_from_content_range():
+    session = FakeRemoteFile()
+    assert get_remote_file_size(session, "https://bucket.s3.amazonaws.com/file.nwb?X-Amz-Signature=1") == len(CONTENT)
+    assert session.responses[0].raw.closed
+
+
+def test_remote_file_size_when_ranges_are_ignored():
+    session = FakeRemoteFile(ranges=False)
+    assert get_remote_file_size(session, "https://example.org/file.nwb") == len(CONTENT)
+    # Closed without reading the whole file
+    response = session.responses[0]
+    assert response.raw.closed
+    assert response._content is False
+
+
+def test_remote_file_size_unknown():
+    with pytest.raises(ValueError):
+        get_remote_file_size(FakeRemoteFile(content_range_total="*"), "https://example.org/file.nwb")
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_block_cache_reads(tmp_path, monkeypatch, ranges):
+    session = FakeRemoteFile(ranges=ranges)
+    monkeypatch.setattr(BlockDiskCache, "session", property(lambda self: session))
+    cache = BlockDiskCache(cache_dir=str(tmp_path), max_bytes=1024 * 1024, block_size=1000)
+    url = "https://bucket.s3.amazonaws.com/file.nwb"
+    size = cache.get_size(url)
+    assert size == len(CONTENT)
+    blocks = cache.get_blocks(url, [2, 3, 10], size=size)
+    assert blocks == {2: CONTENT[2000:3000], 3: CONTENT[3000:4000], 10: CONTENT[10000:]}
+    # Then read from the cache, signed URLs of the same file included
+    requests_made = len(session.responses)
+    assert cache.get_size(url + "?X-Amz-Signature=2") == size
+    assert cache.get_blocks(url + "?X-Amz-Signature=2", [3], size=size) == {3: CONTENT[3000:4000]}
+    assert len(session.responses) == requests_made
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_ranged_remote_file_reads(monkeypatch, ranges):
+    session = FakeRemoteFile(ranges=ranges)
+    monkeypatch.setattr(core.unit_summary, "get_http_session", lambda name: session)
+    fileobj = RangedRemoteFile("https://bucket.s3.amazonaws.com/sorting_cached.npz")
+    assert fileobj.size == len(CONTENT)
+    fileobj.seek(5000)
+    assert fileobj.read(100) == CONTENT[5000:5100]
+    fileobj.seek(-10, io.SEEK_END)
+    assert fileobj.read(100) == CONTENT[-10:]
+    assert fileobj.read(100) == b""
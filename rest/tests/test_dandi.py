@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+import pytest
+
+import clients.dandi
+from clients.dandi import DandiClient
+
+
+SIGNED_URL = "https://dandiarchive-embargo.s3.amazonaws.com/blobs/a/b/c?X-Amz-Date=20990101T000000Z&X-Amz-Expires=3600"
+
+
+@pytest.fixture
+def dandi_api(monkeypatch):
+    # DANDI API client serving one public and one embargoed asset, counting the lookups
+    lookups = list()
+    urls = {
+        "public.nwb": "https://dandiarchive.s3.amazonaws.com/blobs/d/e/f",
+        "embargoed.nwb": "https://dandiarchive-embargo.s3.amazonaws.com/blobs/a/b/c",
+    }
+
+    def get_asset_by_path(path):
+        lookups.append(path)
+        return SimpleNamespace(
+            identifier=f"asset-{path}",
+            get_content_url=lambda **kwargs: urls[path],
+            base_download_url=f"https://api.dandiarchive.org/api/assets/asset-{path}/download/",
+        )
+
+    api_client = SimpleNamespace(get_dandiset=lambda dandiset_id, version_id: SimpleNamespace(get_asset_by_path=get_asset_by_path))
+    monkeypatch.setattr(clients.dandi, "get_dandi_api_client", lambda token=None: api_client)
+    monkeypatch.setattr(DandiClient, "get_signed_download_url", lambda self, download_url: SIGNED_URL)
+    monkeypatch.setattr(clients.dandi, "_assets_cache", clients.dandi.TTLCache(maxsize=16, ttl=300))
+    return lookups
+
+
+def test_get_file_url(dandi_api):
+    dandi_client = DandiClient(token="token")
+    assert dandi_client.get_file_url("000001", "public.nwb") == "https://dandiarchive.s3.amazonaws.com/blobs/d/e/f"
+    # Embargoed files are resolved to their signed URL
+    assert dandi_client.get_file_url("000001", "embargoed.nwb") == SIGNED_URL
+    # Then served from the cache
+    assert dandi_client.get_file_url("000001", "embargoed.nwb") == SIGNED_URL
+    assert dandi_api == ["public.nwb", "embargoed.nwb"]
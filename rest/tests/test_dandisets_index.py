@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+
+import core.dandisets_index
+from core.dandisets_index import DandisetsIndex, DandisetsIndexSnapshot
+from core.settings import settings
+
+
+def test_dandisets_sync_is_claimed_once(db_client):
+    assert db_client.claim_dandisets_sync(previous_synced_at=None, synced_at="2024-01-01T00:00:00+00:00")
+    # Other replicas read the same sync time, and lose the claim
+    assert not db_client.claim_dandisets_sync(previous_synced_at=None, synced_at="2024-01-01T00:00:01+00:00")
+    assert db_client.claim_dandisets_sync(previous_synced_at="2024-01-01T00:00:00+00:00", synced_at="2024-01-02T00:00:00+00:00")
+    assert not db_client.claim_dandisets_sync(previous_synced_at="2024-01-01T00:00:00+00:00", synced_at="2024-01-02T00:00:01+00:00")
+    assert db_client.get_dandisets_sync().synced_at == "2024-01-02T00:00:00+00:00"
+
+
+def test_refresh_rebuilds_the_index_periodically(db_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DB_CONNECTION_STRING", str(db_client.engine.url))
+    crawls = list()
+
+    def get_dandisets_metadata_modified_since(self, since=None, known_modified=None, callback=None):
+        crawls.append(since)
+        for i in range(250):
+            callback(f"{i:06d}", "2024-01-01T00:00:00Z", {"name": f"Dandiset {i}"})
+        return dict(), list(), datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    snapshots = list()
+
+    class CountedSnapshot(DandisetsIndexSnapshot):
+        def __init__(self, all_metadata):
+            snapshots.append(len(all_metadata))
+            super().__init__(all_metadata)
+
+    monkeypatch.setattr(core.dandisets_index.DandiClient, "get_dandisets_metadata_modified_since", get_dandisets_metadata_modified_since)
+    monkeypatch.setattr(core.dandisets_index, "DandisetsIndexSnapshot", CountedSnapshot)
+    index = DandisetsIndex(seed_path=tmp_path / "missing.json", interval=3600, catch_up_versions=100)
+    snapshots.clear()
+    index.refresh()
+
+    assert len(crawls) == 1
+    assert snapshots == [100, 200, 250]
+    assert index.search(search="dandiset 249")["total"] == 1
+
+    # Synced recently: another replica does not crawl again
+    other_index = DandisetsIndex(seed_path=tmp_path / "missing.json", interval=3600)
+    other_index.refresh()
+    assert len(crawls) == 1
+    assert len(other_index.get_labels()) == 250
+
+
+def test_stale_sync_is_crawled_by_a_single_replica(db_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DB_CONNECTION_STRING", str(db_client.engine.url))
+    stale = (datetime.now(tz=timezone.utc) - timedelta(days=1)).isoformat()
+    db_client.update_dandisets_sync(last_modified=None, synced_at=stale)
+    crawls = list()
+
+    def get_dandisets_metadata_modified_since(self, since=None, known_modified=None, callback=None):
+        crawls.append(since)
+        return dict(), list(), None
+
+    monkeypatch.setattr(core.dandisets_index.DandiClient, "get_dandisets_metadata_modified_since", get_dandisets_metadata_modified_since)
+    # Both replicas read the stale sync before either claims it
+    first, second = DandisetsIndex(seed_path=tmp_path / "missing.json"), DandisetsIndex(seed_path=tmp_path / "missing.json")
+    monkeypatch.setattr(db_client.__class__, "get_dandisets_sync", lambda self: type("Sync", (), {"synced_at": stale, "last_modified": None})())
+    first.refresh()
+    second.refresh()
+    assert len(crawls) == 1
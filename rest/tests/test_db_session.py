@@ -0,0 +1,46 @@
+import httpx
+import pytest
+
+from core.settings import settings
+from db.models import Run, User
+from db.session import dispose_engines, get_async_connection_string, get_engine
+from main import app
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def test_engines_are_shared_by_connection_string(tmp_path):
+    connection_string = f"sqlite:///{tmp_path / 'test.db'}"
+    assert get_engine(connection_string) is get_engine(connection_string)
+    assert get_engine(connection_string) is not get_engine(f"sqlite:///{tmp_path / 'other.db'}")
+
+
+def test_async_connection_string():
+    assert get_async_connection_string("postgresql+psycopg2://u:p@db/runs") == "postgresql+asyncpg://u:p@db/runs"
+    assert get_async_connection_string("postgresql://u:p@db:5432/runs") == "postgresql+asyncpg://u:p@db:5432/runs"
+    assert get_async_connection_string("postgres://u:p@db/runs") == "postgresql+asyncpg://u:p@db/runs"
+    assert get_async_connection_string("postgresql+asyncpg://u:p@db/runs") == "postgresql+asyncpg://u:p@db/runs"
+    assert get_async_connection_string("sqlite+pysqlite:///runs.db") == "sqlite+aiosqlite:///runs.db"
+    assert get_async_connection_string("sqlite:///runs.db") == "sqlite+aiosqlite:///runs.db"
+
+
+@pytest.mark.anyio
+async def test_runs_list_reads_from_the_pooled_async_engine(db_client, monkeypatch):
+    monkeypatch.setattr(settings, "DB_CONNECTION_STRING", str(db_client.engine.url))
+    with db_client.session_scope() as session:
+        user = User(username="admin", password="admin")
+        session.add(user)
+        session.flush()
+        session.add_all([Run(run_at="local", identifier=f"run-{i}", status="success", user_id=user.id) for i in range(3)])
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/api/runs/list", params={"limit": 2})
+        assert response.status_code == 200
+        assert [r["identifier"] for r in response.json()["runs"]] == ["run-2", "run-1"]
+        next_page = await client.get("/api/runs/list", params={"limit": 2, "after_id": response.json()["next_after_id"]})
+        assert [r["identifier"] for r in next_page.json()["runs"]] == ["run-0"]
+    await dispose_engines()
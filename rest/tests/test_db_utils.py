@@ -0,0 +1,69 @@
+import json
+
+from sqlalchemy import inspect, text
+
+from clients.database import DatabaseClient
+from db.utils import initialize_db, parse_legacy_json
+
+
+LEGACY_SCHEMA = [
+    'CREATE TABLE "user" (id INTEGER PRIMARY KEY, username VARCHAR, password VARCHAR)',
+    """CREATE TABLE data_source (
+        id INTEGER PRIMARY KEY, name VARCHAR, description VARCHAR, source VARCHAR, source_data_type VARCHAR,
+        source_data_paths VARCHAR, recording_kwargs VARCHAR, user_id INTEGER REFERENCES "user" (id)
+    )""",
+    """CREATE TABLE run (
+        id INTEGER PRIMARY KEY, run_at VARCHAR, identifier VARCHAR, description VARCHAR, last_run VARCHAR, status VARCHAR,
+        data_source_id INTEGER REFERENCES data_source (id), user_id INTEGER REFERENCES "user" (id), metadata VARCHAR,
+        logs VARCHAR, output_destination VARCHAR, output_path VARCHAR
+    )""",
+]
+
+BLOB_URL = "https://dandiarchive.s3.amazonaws.com/blobs/2a3/b4c/2a3b4c5d-6e7f"
+
+
+def insert_legacy_run(connection, run_id: int, metadata: str):
+    connection.execute(
+        text("INSERT INTO run (id, run_at, identifier, status, user_id, metadata) VALUES (:id, 'local', :identifier, 'success', 1, :metadata)"),
+        {"id": run_id, "identifier": f"run-{run_id}", "metadata": metadata},
+    )
+
+
+def test_parse_legacy_json():
+    assert parse_legacy_json('{"file": "s3://bucket/file.nwb"}') == {"file": "s3://bucket/file.nwb"}
+    assert parse_legacy_json("{'file': 's3://bucket/file.nwb', 'test': True}") == {"file": "s3://bucket/file.nwb", "test": True}
+    assert parse_legacy_json("not a document") is None
+    assert parse_legacy_json(None) is None
+
+
+def test_migrated_runs_are_filtered_by_their_generated_columns(tmp_path):
+    connection_string = f"sqlite:///{tmp_path / 'legacy.db'}"
+    db_client = DatabaseClient(connection_string=connection_string)
+    with db_client.engine.begin() as connection:
+        for statement in LEGACY_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text("""INSERT INTO "user" (id, username, password) VALUES (1, 'admin', 'admin')"""))
+        # Stored as the repr of Python dicts: a DANDI file by URL only, then with its dandiset and path
+        insert_legacy_run(connection, 1, repr({"source": "dandi", "source_data_paths": {"file": BLOB_URL}, "sorters_names_list": ["kilosort3"]}))
+        insert_legacy_run(connection, 2, json.dumps({
+            "source": "dandi",
+            "source_data_paths": {"file": BLOB_URL, "dandiset_id": "000123", "path": "sub-1/sub-1_ecephys.nwb"},
+            "sorters_names_list": ["kilosort3", "ironclust"],
+        }))
+        insert_legacy_run(connection, 3, "not a document")
+
+    initialize_db(connection_string)
+
+    columns = [c["name"] for c in inspect(db_client.engine).get_columns("run")]
+    assert {"sorters", "dandiset_id", "asset_path", "logs_cursor"} <= set(columns)
+    runs = {r["id"]: r for r in db_client.get_all_runs_info(user_id=1)}
+    assert runs[1]["metadata"]["source_data_paths"] == {"file": BLOB_URL}
+    assert runs[3]["metadata"] is None
+
+    assert [r["id"] for r in db_client.get_all_runs_info(sorter="kilosort3")] == [2, 1]
+    assert [r["id"] for r in db_client.get_all_runs_info(sorter="ironclust")] == [2]
+    # Runs stored with the file URL only do not identify their dandiset: their columns stay NULL
+    assert [r["id"] for r in db_client.get_all_runs_info(dandiset_id="000123")] == [2]
+    assert [r["id"] for r in db_client.get_all_runs_info(asset_path="sub-1/sub-1_ecephys.nwb")] == [2]
+    with db_client.session_scope() as session:
+        assert session.execute(text("SELECT dandiset_id, asset_path FROM run WHERE id = 1")).one() == (None, None)
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+import requests
+
+from clients.http import CircuitBreaker, CircuitOpenError, ResilientSession
+
+
+def make_half_open_session(monkeypatch, send):
+    circuit_breaker = CircuitBreaker(name="test", failure_threshold=1, reset_timeout=30)
+    circuit_breaker.failures = 1
+    circuit_breaker.opened_at = time.monotonic() - 60
+    session = ResilientSession(name="test", retries=0, circuit_breaker=circuit_breaker)
+    monkeypatch.setattr(requests.Session, "request", lambda self, method, url, **kwargs: send())
+    return session, circuit_breaker
+
+
+def make_response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
+
+
+def test_half_open_trial_success_closes_circuit(monkeypatch):
+    session, circuit_breaker = make_half_open_session(monkeypatch, lambda: make_response(200))
+    assert circuit_breaker.state == "half-open"
+    assert session.get("http://dependency/").status_code == 200
+    assert circuit_breaker.state == "closed"
+
+
+def test_half_open_trial_request_exception_opens_circuit(monkeypatch):
+    def send():
+        raise requests.TooManyRedirects("too many redirects")
+    session, circuit_breaker = make_half_open_session(monkeypatch, send)
+    with pytest.raises(requests.TooManyRedirects):
+        session.get("http://dependency/")
+    assert circuit_breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        session.get("http://dependency/")
+
+
+def test_half_open_trial_interrupted_lets_next_request_try(monkeypatch):
+    def send():
+        raise ValueError("not an HTTP failure")
+    session, circuit_breaker = make_half_open_session(monkeypatch, send)
+    with pytest.raises(ValueError):
+        session.get("http://dependency/")
+    assert circuit_breaker.state == "half-open"
+    # Not failing fast: a new trial is let through
+    with pytest.raises(ValueError):
+        session.get("http://dependency/")
+
+
+def test_half_open_allows_a_single_trial():
+    circuit_breaker = CircuitBreaker(name="test", failure_threshold=1, reset_timeout=30)
+    circuit_breaker.record_failure()
+    circuit_breaker.opened_at = time.monotonic() - 60
+    circuit_breaker.before_request()
+    with pytest.raises(CircuitOpenError):
+        circuit_breaker.before_request()
@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import clients.dandi
+from clients.dandi import DandiClient
+from core.metrics import Counter, Histogram, MetricsRegistry, instrumented
+from main import app
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def get_sample(metrics_text: str, sample: str) -> float:
+    for line in metrics_text.splitlines():
+        name, _, value = line.rpartition(" ")
+        if name == sample:
+            return float(value)
+    return 0.
+
+
+def test_histogram_and_counter_render():
+    registry = MetricsRegistry()
+    histogram = registry.register(Histogram("call_duration_seconds", "Calls", labelnames=("dependency",), buckets=(0.1, 1.)))
+    counter = registry.register(Counter("calls_total", "Calls", labelnames=("dependency",)))
+    for value in [0.05, 0.5, 5.]:
+        histogram.observe("dandi", value=value)
+    counter.inc('say "hi"\n')
+    text = registry.render()
+    assert get_sample(text, 'call_duration_seconds_bucket{dependency="dandi",le="0.1"}') == 1
+    assert get_sample(text, 'call_duration_seconds_bucket{dependency="dandi",le="1.0"}') == 2
+    assert get_sample(text, 'call_duration_seconds_bucket{dependency="dandi",le="+Inf"}') == 3
+    assert get_sample(text, 'call_duration_seconds_count{dependency="dandi"}') == 3
+    assert get_sample(text, 'call_duration_seconds_sum{dependency="dandi"}') == 5.55
+    assert get_sample(text, 'calls_total{dependency="say \\"hi\\"\\n"}') == 1
+
+
+@pytest.mark.anyio
+async def test_nested_calls_are_counted_once():
+    @instrumented("nested-test")
+    class Client:
+        def outer(self):
+            return self.inner() + 1
+
+        def inner(self):
+            return 1
+
+        async def outer_async(self):
+            return self.inner() + 1
+
+    from core.metrics import registry
+    assert Client().outer() == 2
+    assert await Client().outer_async() == 2
+    assert Client().inner() == 1
+    text = registry.render()
+    assert get_sample(text, 'dependency_calls_total{dependency="nested-test",operation="outer",outcome="ok"}') == 1
+    assert get_sample(text, 'dependency_calls_total{dependency="nested-test",operation="outer_async",outcome="ok"}') == 1
+    assert get_sample(text, 'dependency_calls_total{dependency="nested-test",operation="inner",outcome="ok"}') == 1
+
+
+@pytest.mark.anyio
+async def test_metrics_scrape_after_a_stubbed_dandi_call(monkeypatch):
+    # The DANDI API client is stubbed, the DandiClient calls it as it would DANDI
+    asset = SimpleNamespace(identifier="asset-1", get_content_url=lambda **kwargs: "https://dandiarchive.s3.amazonaws.com/blobs/a/b/c")
+    dandiset = SimpleNamespace(get_asset_by_path=lambda path: asset)
+    monkeypatch.setattr(clients.dandi, "get_dandi_api_client", lambda token=None: SimpleNamespace(get_dandiset=lambda dandiset_id, version_id: dandiset))
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        before = (await client.get("/metrics")).text
+        url = DandiClient().get_file_url("000001", "sub-1/sub-1_ecephys.nwb", version_id="metrics-test")
+        response = await client.get("/metrics")
+    assert url == "https://dandiarchive.s3.amazonaws.com/blobs/a/b/c"
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+    def delta(sample):
+        return get_sample(response.text, sample) - get_sample(before, sample)
+
+    assert delta('dependency_calls_total{dependency="dandi",operation="get_file_url",outcome="ok"}') == 1
+    assert delta('dependency_call_duration_seconds_count{dependency="dandi",operation="get_file_url"}') == 1
+    # Made by get_file_url, so already timed by it
+    assert delta('dependency_calls_total{dependency="dandi",operation="get_asset_id_and_url",outcome="ok"}') == 0
+    # The first scrape is timed by route
+    assert delta('http_request_duration_seconds_count{method="GET",route="/metrics",status="200"}') == 1
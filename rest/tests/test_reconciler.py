@@ -0,0 +1,193 @@
+import time
+from types import SimpleNamespace
+
+import boto3
+import pytest
+from moto import mock_aws
+from sqlalchemy import event
+
+import core.reconciler
+from clients.aws import AWSClient
+from core.reconciler import RunStatusReconciler
+from core.settings import settings
+from db.models import Run
+
+
+class FakeLocalWorkerClient:
+    status = None
+    progress = None
+    logs = ""
+    logs_calls = 0
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+
+    def get_run_status(self, run_identifier):
+        return self.status, self.progress
+
+    def get_run_logs(self, run_identifier):
+        type(self).logs_calls += 1
+        return "running", self.logs
+
+
+def make_local_run(logs_cursor=None):
+    return SimpleNamespace(
+        id=1,
+        identifier="run-1",
+        run_at="local",
+        worker_id=None,
+        worker_endpoint=None,
+        worker_last_heartbeat=None,
+        dispatch_count=1,
+        logs_cursor=logs_cursor,
+    )
+
+
+def reconcile_local_run(monkeypatch, run, status, progress=None, logs=""):
+    fake_client = type("FakeClient", (FakeLocalWorkerClient,), dict(status=status, progress=progress, logs=logs, logs_calls=0))
+    monkeypatch.setattr(core.reconciler, "LocalWorkerClient", fake_client)
+    new_logs = dict()
+    updates = RunStatusReconciler().reconcile_local_runs([run], db_client=None, new_logs=new_logs)
+    return updates, new_logs, fake_client.logs_calls
+
+
+def test_local_run_without_status_is_still_running(monkeypatch):
+    updates, new_logs, logs_calls = reconcile_local_run(monkeypatch, make_local_run(), status=None, logs="line 1\n")
+    assert updates == []
+    assert new_logs == {}
+    assert logs_calls == 0
+
+
+def test_running_local_run_only_updates_progress(monkeypatch):
+    progress = {"status": "running", "step": "sorting"}
+    updates, new_logs, logs_calls = reconcile_local_run(monkeypatch, make_local_run(), status="running", progress=progress)
+    assert updates == [{"id": 1, "progress": '{"status": "running", "step": "sorting"}'}]
+    assert new_logs == {}
+    assert logs_calls == 0
+
+
+def test_finished_local_run_ingests_logs_after_offset(monkeypatch):
+    logs = "line 1\nline 2\nline 3\nSorting job completed successfully!\n"
+    updates, new_logs, _ = reconcile_local_run(monkeypatch, make_local_run(logs_cursor="2"), status="success", logs=logs)
+    assert updates == [{"id": 1, "status": "success", "logs_cursor": "4"}]
+    assert new_logs == {1: ["line 3", "Sorting job completed successfully!"]}
+
+
+def test_finished_local_run_without_new_logs(monkeypatch):
+    updates, new_logs, _ = reconcile_local_run(monkeypatch, make_local_run(logs_cursor="2"), status="fail", logs="line 1\nline 2\n")
+    assert updates == [{"id": 1, "status": "fail"}]
+    assert new_logs == {}
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    # Batch jobs of the mocked account succeed right away, without running any container
+    for key in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]:
+        monkeypatch.setenv(key, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(settings, "AWS_BATCH_JOB_QUEUE", "sorting-queue")
+    with mock_aws(config={"batch": {"use_docker": False}}):
+        role_arn = boto3.client("iam").create_role(RoleName="batch-role", AssumeRolePolicyDocument="{}")["Role"]["Arn"]
+        batch = boto3.client("batch")
+        compute_environment_arn = batch.create_compute_environment(
+            computeEnvironmentName="sorting-compute", type="UNMANAGED", state="ENABLED", serviceRole=role_arn,
+        )["computeEnvironmentArn"]
+        batch.create_job_queue(
+            jobQueueName="sorting-queue", state="ENABLED", priority=1,
+            computeEnvironmentOrder=[{"order": 1, "computeEnvironment": compute_environment_arn}],
+        )
+        batch.register_job_definition(
+            jobDefinitionName="sorting-job", type="container",
+            containerProperties={"image": "sorting", "vcpus": 1, "memory": 128, "command": ["true"]},
+        )
+        boto3.client("logs").create_log_group(logGroupName="/aws/batch/job")
+        yield batch
+
+
+def submit_sorting_jobs(batch, identifiers: list, logs: list = None) -> dict:
+    job_ids = dict()
+    for identifier in identifiers:
+        job_ids[identifier] = batch.submit_job(jobName=f"sorting-{identifier}", jobQueue="sorting-queue", jobDefinition="sorting-job")["jobId"]
+    if logs is not None:
+        logs_client = boto3.client("logs")
+        for job in batch.describe_jobs(jobs=list(job_ids.values()))["jobs"]:
+            log_stream_name = job["container"]["logStreamName"]
+            logs_client.create_log_stream(logGroupName="/aws/batch/job", logStreamName=log_stream_name)
+            logs_client.put_log_events(
+                logGroupName="/aws/batch/job",
+                logStreamName=log_stream_name,
+                logEvents=[{"timestamp": int(time.time() * 1000), "message": message} for message in logs],
+            )
+    return job_ids
+
+
+@pytest.fixture
+def batch_calls(monkeypatch):
+    # Jobs of each AWS Batch call made by the reconciler
+    calls = {"DescribeJobs": list(), "ListJobs": list()}
+
+    class RecordingAWSClient(AWSClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            for operation in calls:
+                self.client_batch.meta.events.register(
+                    f"provide-client-params.batch.{operation}",
+                    lambda params, operation=operation, **kwargs: calls[operation].append(params.get("jobs")),
+                )
+
+    monkeypatch.setattr(core.reconciler, "AWSClient", RecordingAWSClient)
+    return calls
+
+
+def make_aws_run(run_id: int, identifier: str, job_id: str = None):
+    return SimpleNamespace(id=run_id, identifier=identifier, run_at="aws", job_id=job_id, logs_cursor=None)
+
+
+def test_aws_jobs_are_described_in_batches_of_100(aws, batch_calls):
+    identifiers = [f"run-{i}" for i in range(150)]
+    job_ids = submit_sorting_jobs(aws, identifiers)
+    runs = [make_aws_run(i, identifier, job_id=job_ids[identifier]) for i, identifier in enumerate(identifiers)]
+
+    updates = RunStatusReconciler().reconcile_aws_runs(runs, db_client=None, new_logs=dict())
+
+    assert [len(jobs) for jobs in batch_calls["DescribeJobs"]] == [100, 50]
+    assert batch_calls["ListJobs"] == []
+    # Jobs without logs yet are kept running, to be retried on the next pass
+    assert updates == []
+
+
+def test_aws_job_ids_are_resolved_once(aws, batch_calls, db_client):
+    job_ids = submit_sorting_jobs(aws, ["run-1", "run-2"], logs=["Sorting job completed successfully!"])
+    runs = [make_aws_run(1, "run-1"), make_aws_run(2, "run-2")]
+
+    updates = RunStatusReconciler().reconcile_aws_runs(runs, db_client=db_client, new_logs=dict())
+
+    assert len(batch_calls["ListJobs"]) == 1
+    assert sorted((u["id"], u["job_id"], u["status"]) for u in updates) == [(1, job_ids["run-1"], "success"), (2, job_ids["run-2"], "success")]
+
+    # Once stored on the runs, job ids are not listed again
+    batch_calls["ListJobs"].clear()
+    runs = [make_aws_run(1, "run-1", job_id=job_ids["run-1"]), make_aws_run(2, "run-2", job_id=job_ids["run-2"])]
+    RunStatusReconciler().reconcile_aws_runs(runs, db_client=db_client, new_logs=dict())
+    assert batch_calls["ListJobs"] == []
+
+
+def test_aws_runs_are_updated_in_a_single_bulk_update(aws, batch_calls, db_client, monkeypatch):
+    identifiers = [f"run-{i}" for i in range(1, 4)]
+    submit_sorting_jobs(aws, identifiers, logs=["sorting", "Sorting job completed successfully!"])
+    with db_client.session_scope() as session:
+        for identifier in identifiers:
+            session.add(Run(run_at="aws", identifier=identifier, status="running"))
+    monkeypatch.setattr(settings, "DB_CONNECTION_STRING", str(db_client.engine.url))
+
+    statements = list()
+    event.listen(db_client.engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    RunStatusReconciler().reconcile_once()
+
+    assert len([s for s in statements if s.startswith("UPDATE run ")]) == 1
+    assert len(batch_calls["DescribeJobs"]) == 1
+    with db_client.session_scope() as session:
+        runs = session.query(Run).order_by(Run.id).all()
+        assert [r.status for r in runs] == ["success"] * 3
+        assert all(r.job_id is not None and r.logs_cursor is not None for r in runs)
+    assert db_client.get_run_logs(runs[0].id)["logs"] == "sorting\nSorting job completed successfully!\n"
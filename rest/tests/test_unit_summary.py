@@ -0,0 +1,89 @@
+import json
+
+import httpx
+import numpy as np
+import pytest
+
+import core.unit_summary
+from core.settings import settings
+from core.unit_summary import UnitSummaryCache, compute_unit_summary, read_exported_sorting, read_npz_arrays
+from db.models import Run, User
+from db.session import dispose_engines
+from main import app
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def write_exported_sorting(path, savez=np.savez):
+    # Layout of spikeinterface NpzFolderSorting: spikes of all units of a segment, in time order, labelled by unit id
+    path.parent.mkdir(parents=True, exist_ok=True)
+    savez(
+        path,
+        unit_ids=np.array([3, 7]),
+        num_segment=np.array([1]),
+        sampling_frequency=np.array([1000.]),
+        spike_indexes_seg0=np.array([0, 1, 100, 500, 1500, 1999]),
+        spike_labels_seg0=np.array([3, 3, 7, 3, 3, 7]),
+    )
+
+
+@pytest.mark.parametrize("savez", [np.savez, np.savez_compressed])
+def test_read_npz_arrays(tmp_path, savez):
+    write_exported_sorting(tmp_path / "sorting_cached.npz", savez=savez)
+    with open(tmp_path / "sorting_cached.npz", "rb") as f:
+        arrays = read_npz_arrays(f, ["unit_ids", "spike_labels_seg0"])
+    np.testing.assert_array_equal(arrays["unit_ids"], [3, 7])
+    np.testing.assert_array_equal(arrays["spike_labels_seg0"], [3, 3, 7, 3, 3, 7])
+
+
+def test_compute_unit_summary(tmp_path):
+    write_exported_sorting(tmp_path / "sorting_cached.npz")
+    with open(tmp_path / "sorting_cached.npz", "rb") as f:
+        sorting = read_exported_sorting(f)
+    np.testing.assert_array_equal(sorting["spike_samples"], [0, 1, 500, 1500, 100, 1999])
+    np.testing.assert_array_equal(sorting["spike_units"], [0, 0, 0, 0, 1, 1])
+
+    summary = compute_unit_summary(sorting, bin_size=1., isi_threshold_ms=1.5)
+    assert summary["unitIds"] == [3, 7]
+    assert summary["duration"] == 2.
+    assert summary["spikeCount"] == [4, 2]
+    assert summary["firingRate"] == [2., 1.]
+    # Unit 3 intervals: 1, 499 and 1000 samples, of which one is shorter than 1.5 ms
+    assert summary["isiViolationRatio"] == [0.3333, 0.]
+    assert summary["binnedFiringRate"] == [[3., 1.], [1., 1.]]
+
+    assert compute_unit_summary(sorting, bin_size=0.5, isi_threshold_ms=1.5)["binnedFiringRate"] == [[4., 2., 0., 2.], [2., 0., 0., 2.]]
+
+
+@pytest.mark.anyio
+async def test_units_summary_route(db_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DB_CONNECTION_STRING", str(db_client.engine.url))
+    monkeypatch.setattr(settings, "SORTING_RESULTS_LOCAL_DIR", str(tmp_path / "results"))
+    monkeypatch.setattr(settings, "UNIT_SUMMARY_MAX_MATRIX_SIZE", 100)
+    monkeypatch.setattr(core.unit_summary, "_unit_summary_cache", UnitSummaryCache(cache_dir=tmp_path / "cache"))
+    write_exported_sorting(tmp_path / "results" / "sorting" / "run-1_kilosort3" / "sorter_exported" / "sorting_cached.npz")
+    with db_client.session_scope() as session:
+        user = User(username="admin", password="admin")
+        session.add(user)
+        session.flush()
+        metadata = {"sorters_names_list": ["kilosort3"], "output_destination": "local"}
+        session.add(Run(id=1, run_at="local", identifier="run-1", status="success", user_id=user.id, metadata_=metadata, output_path="local"))
+        # Legacy metadata that could not be parsed
+        session.add(Run(id=2, run_at="local", identifier="run-2", status="success", user_id=user.id, metadata_=None))
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.get("/api/runs/units-summary", params={"run_id": 1, "sorter_name": "kilosort3"})
+        assert response.status_code == 200
+        assert json.loads(response.content)["summary"]["spikeCount"] == [4, 2]
+        # 2 units x 200 bins are more values than allowed
+        response = await client.get("/api/runs/units-summary", params={"run_id": 1, "sorter_name": "kilosort3", "bin_size": 0.01})
+        assert response.status_code == 400
+        response = await client.get("/api/runs/units-summary", params={"run_id": 1, "sorter_name": "ironclust"})
+        assert response.status_code == 404
+        response = await client.get("/api/runs/units-summary", params={"run_id": 2, "sorter_name": "kilosort3"})
+        assert response.status_code == 409
+    await dispose_engines()